@@ -9,21 +9,65 @@ and sells it to the CentralAgent or other prosumers.
 
 
 from abc import ABC, abstractmethod
+from collections import deque
+
 import numpy as np
 
 from enums import OrderType
 from order import Order
 
+# Sales ledger class, running totals of the energy an agent sold
+class SalesLedger():
+    __slots__ = ('volume', 'value', 'n_trades', 'last_price', 'history')
+
+    # Initialize the ledger
+    def __init__(self, history_size=0):
+        """
+        :param history_size: the number of most recent trades to keep for diagnostics (0 to keep none)
+        """
+        self.volume = 0
+        self.value = 0
+        self.n_trades = 0
+        self.last_price = None
+        self.history = deque(maxlen=history_size) if history_size > 0 else None
+
+    # Method to record a sale
+    def record(self, amount, price, n_trades=1):
+        """
+        Record a sale of energy
+        :param amount: the amount of energy sold
+        :param price: the price per kWh
+        :param n_trades: the number of trades the sale consists of
+        """
+        self.volume += amount
+        self.value += price * amount
+        self.n_trades += n_trades
+        self.last_price = price
+
+        if self.history is not None:
+            self.history.append((amount, price))
+
+    # Method to get the volume weighted sell price
+    def average_price(self):
+        return self.value / self.volume
+
+    # Method to reset the running totals, the trade history is kept
+    def reset(self):
+        self.volume = 0
+        self.value = 0
+        self.n_trades = 0
+        self.last_price = None
+
 # Base agent class
 class BaseAgent(ABC):
+    __slots__ = ('id', 'sell_price', 'balance', 'sales')
 
     # Intialize the agent
-    def __init__(self, id, sell_price):
+    def __init__(self, id, sell_price, history_size=0):
         self.id = id
         self.sell_price = sell_price
         self.balance = 0
-        self.total_sold_energy_list = []
-        self.total_sold_energy_price_list = []
+        self.sales = SalesLedger(history_size)
 
 
     # Order creation method
@@ -33,10 +77,11 @@ class BaseAgent(ABC):
 
 # Central agent class
 class CentralAgent(BaseAgent):
+    __slots__ = ('energy_bought', 'energy_sold', 'buy_price')
 
     # Initialize the central agent
-    def __init__(self, id, sell_price, buy_price):
-        super().__init__(id, sell_price)
+    def __init__(self, id, sell_price, buy_price, history_size=0):
+        super().__init__(id, sell_price, history_size)
         self.energy_bought = 0
         self.energy_sold = 0
         self.buy_price = buy_price
@@ -47,10 +92,11 @@ class CentralAgent(BaseAgent):
 
 # Prosumer agent class
 class ProsumerAgent(BaseAgent):
+    __slots__ = ('n_panels', 'base_energy_demand', 'energy_demand', 'energy_production', 'energy_bought', 'energy_balance', 'sensitivity', 'house_type')
 
     # Initialize the prosumer agent
-    def __init__(self, id, sell_price, n_panels, base_energy_demand, sensitivity, house_type):
-        super().__init__(id, sell_price)
+    def __init__(self, id, sell_price, n_panels, base_energy_demand, sensitivity, house_type, history_size=0):
+        super().__init__(id, sell_price, history_size)
         self.n_panels = n_panels
         self.base_energy_demand = base_energy_demand
         self.energy_demand = base_energy_demand
@@ -86,29 +132,27 @@ class ProsumerAgent(BaseAgent):
         return None
     
     # Method to update the agent
-    def update(self, daily_energy_level, average_price, iteration):
+    def update(self, daily_energy_level, average_price, iteration, rng=None, demand_share=1, noise=None):
 
         # Reset agent & calculate energy production, demand and balance
+        # (demand_share is the part of the daily demand that falls in the current interval,
+        # noise is the demand noise of a pre-drawn scenario)
         self.reset()
         self.energy_production = self.create_energy(daily_energy_level)
-        self.energy_demand = calculate_seasonal_demand(iteration, self.base_energy_demand)
+        self.energy_demand = calculate_seasonal_demand(iteration, self.base_energy_demand, rng=rng, noise=noise) * demand_share
         self.energy_balance = self.energy_production - self.energy_demand
 
         # Calculate sold energy and price to update sell price
-        if len(self.total_sold_energy_list) > 0:
-            actual_sold_price = 0
-            for idx, price in enumerate(self.total_sold_energy_price_list):
-                actual_sold_price += price*self.total_sold_energy_list[idx]
-            actual_sold_price /= sum(self.total_sold_energy_list)
+        if self.sales.n_trades > 0:
+            actual_sold_price = self.sales.average_price()
 
             if actual_sold_price > average_price:
                 self.sell_price = self.sell_price + self.sensitivity
             else:
                 self.sell_price = max(0,self.sell_price - self.sensitivity)
 
-        #reset lists
-        self.total_sold_energy_list = []
-        self.total_sold_energy_price_list = []
+        #reset sales
+        self.sales.reset()
 
     # Method to reset the agent
     def reset(self):
@@ -123,7 +167,10 @@ class ProsumerAgent(BaseAgent):
 
 
 # Sinusoidal function over 365 days
-def calculate_seasonal_demand(iteration, own_demand_base):
+def calculate_seasonal_demand(iteration, own_demand_base, size=None, rng=None, noise=None):
+    if rng is None:
+        rng = np.random.default_rng()
+
     days_in_year = 365
     phase_shift = np.pi  # Shift by π to make the peak in winter and the trough in summer
     seasonality = np.sin((2 * np.pi * (iteration % days_in_year) / days_in_year) + phase_shift)
@@ -131,6 +178,7 @@ def calculate_seasonal_demand(iteration, own_demand_base):
     seasonal_effect = 0.3 * seasonality
     
     # Add some random noise to the seasonality for variability at 2%
-    random_noise = np.random.normal(loc=0, scale=0.02)
+    # (size draws one value per agent when own_demand_base is an array of agents, noise replaces the draw)
+    random_noise = rng.normal(loc=0, scale=0.02, size=size) if noise is None else noise
     
     return own_demand_base * (1 + seasonal_effect + random_noise)
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Analysis functions for the results of the simulation.
+Results are handled as dense (run, timestep, metric) arrays, as written by the ResultStore, so averages over runs,
+rolling confidence intervals, energy shares and final-state statistics are single vectorized operations instead of
+loops over runs and timesteps. Runs that stopped early in steady state have missing values (NaN) after their last
+timestep, which the averages skip and the final values take from the last timestep of every run. The cumulative
+average balance of such a run is extended to the end instead (see SteadyState.extend), so its average and final
+value do not drop when runs stop. From the notebook in the analysis folder, add '../src' to sys.path to import it.
+"""
+
+import os
+import warnings
+
+import numpy as np
+
+from results import METRICS, load_results, result_name
+
+# Defaults of the plots in the notebook: rolling window size and z value of the 95% confidence interval
+WS = 10
+Z = 1.96
+
+
+# Get the index of a metric
+def metric_index(metric):
+    """
+    Get the position of a metric in the last axis of a results array
+    :param metric: name of the metric, e.g. 'average balance'
+    """
+    return METRICS.index(metric)
+
+
+# Load results as an array
+def load(source, mmap=False):
+    """
+    Load results as a (run, timestep, metric) array
+    :param source: path of a results file, or a DataFrame in the long csv format
+    :param mmap: memory-map the data instead of reading it (npy files only)
+    """
+    if isinstance(source, str):
+        return load_results(source, mmap)[0]
+    return from_dataframe(source)
+
+
+# Convert a DataFrame to a results array
+def from_dataframe(frame):
+    """
+    Convert a DataFrame in the long csv format (one row per run and timestep) to a (run, timestep, metric) array
+    :param frame: the DataFrame
+    """
+    frame = frame.sort_values(['run', 'timestep'])
+    n_runs = frame['run'].nunique()
+    return frame[METRICS].to_numpy(dtype=float).reshape(n_runs, -1, len(METRICS))
+
+
+# Average over runs
+def avg_over_runs(data, metric):
+    """
+    Calculates the average over all runs of a metric for every timestep, skipping the runs that already stopped
+    :param data: the (run, timestep, metric) array
+    :param metric: name of the metric
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(data[:, :, metric_index(metric)], axis=0)
+
+
+# Rolling mean and confidence interval
+def rolling_ci(series, window=WS, z=Z):
+    """
+    Centered rolling mean and confidence interval z * rolling std / sqrt(window) along the last axis, with the same
+    windows as pandas rolling(window, center=True, min_periods=1)
+    :param series: array with the timesteps on the last axis
+    :param window: the window size
+    :param z: z value of the confidence interval
+    """
+    series = np.asarray(series, dtype=float)
+    n_steps = series.shape[-1]
+
+    # Window of timestep i covers [i - window // 2, i + (window - 1) // 2], clipped to the series
+    idx = np.arange(n_steps)
+    start = np.clip(idx - window // 2, 0, n_steps)
+    end = np.clip(idx + (window - 1) // 2 + 1, 0, n_steps)
+    count = end - start
+
+    zeros = np.zeros(series.shape[:-1] + (1,))
+    cum = np.concatenate((zeros, np.cumsum(series, axis=-1)), axis=-1)
+    cum_sq = np.concatenate((zeros, np.cumsum(series ** 2, axis=-1)), axis=-1)
+
+    mean = (cum[..., end] - cum[..., start]) / count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (cum_sq[..., end] - cum_sq[..., start] - count * mean ** 2) / (count - 1)
+    std = np.sqrt(np.maximum(var, 0))
+
+    return mean, z * std / np.sqrt(window)
+
+
+# Green energy
+def green_energy(data):
+    """
+    Green energy per run and timestep as in the notebook: the total energy produced minus the energy bought from the
+    central agent (grey energy)
+    :param data: the (run, timestep, metric) array
+    """
+    return data[:, :, metric_index('total energy produced')] - data[:, :, metric_index('total central energy bought')]
+
+
+# Green energy used
+def green_energy_used(data):
+    """
+    Part of the energy demand per run and timestep that was not bought from the central agent: the energy demand
+    minus the grey energy. Unlike green_energy it leaves out the surplus that is produced but sold to the central
+    agent.
+    :param data: the (run, timestep, metric) array
+    """
+    return data[:, :, metric_index('total energy demand')] - data[:, :, metric_index('total central energy bought')]
+
+
+# Share of green energy
+def green_share(data):
+    """
+    Share of the energy demand per run and timestep that is covered by green energy, see green_energy_used
+    :param data: the (run, timestep, metric) array
+    """
+    demand = data[:, :, metric_index('total energy demand')]
+    return np.divide(green_energy_used(data), demand, out=np.zeros_like(demand), where=demand > 0)
+
+
+# Final values of every run
+def final_values(data, metric):
+    """
+    The value of a metric at the last timestep of every run, for runs that stopped early the last timestep they
+    simulated
+    :param data: the (run, timestep, metric) array
+    :param metric: name of the metric
+    """
+    values = np.asarray(data[:, -1, metric_index(metric)])
+    stopped = np.isnan(values)
+    if stopped.any():
+        series = np.asarray(data[stopped, :, metric_index(metric)])
+        last = series.shape[1] - 1 - np.argmax(~np.isnan(series[:, ::-1]), axis=1)
+        values = values.copy()
+        values[stopped] = series[np.arange(len(series)), last]
+    return values
+
+
+# Values of a run that decide the convergence of a simulation
+def run_values(results, metrics):
+    """
+    The final value of every metric of a single run, for 'green energy share' the share of the energy demand of the
+    whole run that was covered by green energy (see green_energy_used)
+    :param results: the (timestep, metric) array of the run
+    :param metrics: names of the metrics
+    """
+    data = results[np.newaxis]
+    values = []
+    for metric in metrics:
+        if metric == 'green energy share':
+            demand = np.nansum(data[:, :, metric_index('total energy demand')])
+            values.append(np.nansum(green_energy_used(data)) / demand if demand > 0 else 0)
+        else:
+            values.append(final_values(data, metric)[0])
+    return np.array(values)
+
+
+# Statistics of the final state
+def final_stats(data, metric, z=Z):
+    """
+    Mean, standard deviation and confidence interval of the final value of a metric over the runs
+    :param data: the (run, timestep, metric) array
+    :param metric: name of the metric
+    :param z: z value of the confidence interval
+    """
+    values = final_values(data, metric)
+    std = values.std(ddof=1) if len(values) > 1 else np.nan
+    return {'mean': values.mean(), 'std': std, 'ci': z * std / np.sqrt(len(values)), 'n_runs': len(values)}
+
+
+# Compare the final state of two simulations
+def compare_final(data_a, data_b, metric):
+    """
+    Independent t-test on the final value of a metric of two simulations, returns the t statistic and p value
+    :param data_a: the (run, timestep, metric) array of the first simulation
+    :param data_b: the (run, timestep, metric) array of the second simulation
+    :param metric: name of the metric
+    """
+    from scipy.stats import ttest_ind
+
+    return ttest_ind(final_values(data_a, metric), final_values(data_b, metric))
+
+
+# Compare the final state of two paired simulations
+def compare_paired(data_a, data_b, metric):
+    """
+    Paired t-test on the final value of a metric of two modes simulated on the same scenarios (simulation() with a
+    list of modes), returns the t statistic and p value
+    :param data_a: the (run, timestep, metric) array of the first mode
+    :param data_b: the (run, timestep, metric) array of the second mode
+    :param metric: name of the metric
+    """
+    from scipy.stats import ttest_rel
+
+    return ttest_rel(final_values(data_a, metric), final_values(data_b, metric))
+
+
+# Load the results of a grid search
+def load_grid(modes, sens_ranges, panel_prods, data_dir='../data', out_format='npz', mmap=False):
+    """
+    Load the results of a grid of configurations, keyed by (mode, sensitivity range index, panel production index)
+    :param modes: the modes of the simulation
+    :param sens_ranges: the sensitivity ranges of the grid
+    :param panel_prods: the production factors of the solar panels of the grid
+    :param data_dir: the folder of the results files
+    :param out_format: the format of the results files
+    :param mmap: memory-map the data instead of reading it (npy files only)
+    """
+    grid = {}
+    for mode in modes:
+        for i, sens_range in enumerate(sens_ranges):
+            for j, panel_prod in enumerate(panel_prods):
+                path = os.path.join(data_dir, f'{result_name(mode, sens_range, panel_prod)}.{out_format}')
+                grid[mode, i, j] = load(path, mmap)
+    return grid
+
+
+# Average a metric over the runs of every configuration of a grid
+def grid_avg_over_runs(grid, mode, metric):
+    """
+    Stack the averages over runs of a metric into an array of shape (sensitivity ranges, panel productions, timesteps)
+    :param grid: the grid of results, see load_grid
+    :param mode: the mode of the simulation
+    :param metric: name of the metric
+    """
+    keys = [key for key in grid if key[0] == mode]
+    n_sens = max(key[1] for key in keys) + 1
+    n_panel = max(key[2] for key in keys) + 1
+    return np.stack([
+        np.stack([avg_over_runs(grid[mode, i, j], metric) for j in range(n_panel)])
+        for i in range(n_sens)
+    ])
+
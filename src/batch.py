@@ -0,0 +1,265 @@
+"""
+Config-batched simulation.
+Instead of one simulation() per configuration, the runs of many configurations (sensitivity ranges, panel
+production factors, modes and seeds) are advanced together: the BatchedPopulation concatenates the agents of all
+runs into one (runs x agents) array with the run of every agent, and every day is one pass of array operations over
+all of them, with the markets of the runs cleared together by clear_grouped. Every run keeps its own generator and
+draws the same random numbers as a run of the vectorized engine, so a batched run reproduces simulation() with the
+same seed up to rounding. Every configuration gets its own results file and summary, like simulation() writes.
+"""
+
+import os
+
+import numpy as np
+
+from agent import calculate_seasonal_demand
+from data import get_average_difference_in_seasons, get_production_series
+from main import (CENTRAL_BUY_PRICE, CENTRAL_SELL_PRICE, DATA_YEAR, create_agents, daily_energy_level,
+                  interval_levels)
+from market import RESIDUAL_TOLERANCE, clear_grouped
+from results import METRICS, ResultStore, output_layout, reduce_results
+from stats import RunningStats, write_summary
+
+# Options of simulation() that batched_simulation supports as well
+BATCHED_OPTIONS = ['summary', 'quantiles', 'batch_size', 'interval', 'population', 'output']
+
+
+# Batched population class holding the agents of many runs
+class BatchedPopulation():
+
+    # Initialize the batch
+    def __init__(self, populations, modes, rngs, avg_prices):
+        """
+        :param populations: the ProsumerPopulation of every run
+        :param modes: the mode of every run ('centralised' or 'distributed')
+        :param rngs: the random number generator of every run
+        :param avg_prices: the starting average price of every run
+        """
+        self.n_runs = len(populations)
+        self.rngs = rngs
+        self.n_agents = np.array([population.n_agents for population in populations])
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_agents)))
+        self.run = np.repeat(np.arange(self.n_runs), self.n_agents)
+        self.distributed = np.array([mode == 'distributed' for mode in modes])
+        self.avg_price = np.asarray(avg_prices, dtype=float)
+
+        self.n_panels = np.concatenate([population.n_panels for population in populations])
+        self.base_energy_demand = np.concatenate([population.base_energy_demand for population in populations])
+        self.sell_price = np.concatenate([population.sell_price for population in populations])
+        self.sensitivity = np.concatenate([population.sensitivity for population in populations])
+        self.balance = np.zeros(len(self.run))
+        self.has_sold = np.zeros(len(self.run), dtype=bool)
+
+    # Method to sum an array of agents per run
+    def per_run(self, values, agents=None):
+        """
+        Return the sum of the values of every run
+        :param values: the values of the agents
+        :param agents: the agents of the values (None for all agents)
+        """
+        return np.bincount(self.run if agents is None else self.run[agents], values, minlength=self.n_runs)
+
+    # Method to simulate one day of all runs
+    def step(self, day, daily_energy_levels, demand_share=1):
+        """
+        Simulate one day of every run, the batched version of ProsumerPopulation.step. Returns the metrics of every
+        run, an array of shape (runs, number of metrics).
+        :param day: current day
+        :param daily_energy_levels: energy produced per solar panel today in every run
+        :param demand_share: the part of the daily demand that falls in the current interval
+        """
+        run = self.run
+
+        # Update the sell prices of the agents that sold energy on the previous day
+        raise_price = self.has_sold & (self.sell_price > self.avg_price[run])
+        lower_price = self.has_sold & ~raise_price
+        self.sell_price[raise_price] += self.sensitivity[raise_price]
+        self.sell_price[lower_price] = np.maximum(0, self.sell_price[lower_price] - self.sensitivity[lower_price])
+        self.has_sold[:] = False
+
+        # Production and demand, with the demand noise every run draws from its own generator
+        noise = np.concatenate([rng.normal(loc=0, scale=0.02, size=n) for rng, n in zip(self.rngs, self.n_agents)])
+        energy_production = self.n_panels * daily_energy_levels[run]
+        energy_demand = calculate_seasonal_demand(day, self.base_energy_demand, noise=noise) * demand_share
+        energy_balance = energy_production - energy_demand
+        total_demand = self.per_run(energy_demand)
+        total_produced = self.per_run(energy_production)
+
+        # Orders, by run and agent id
+        ids = np.flatnonzero(energy_balance != 0)
+        amounts = np.abs(energy_balance[ids])
+        is_sell = energy_balance[ids] > 0
+        buys = ids[~is_sell]
+        buy_amounts = amounts[~is_sell]
+        sells = ids[is_sell]
+        sell_amounts = amounts[is_sell]
+
+        # Shuffle the buy orders of every run with the generator of the run
+        bounds = np.searchsorted(buys, self.offsets)
+        order = np.concatenate([
+            bounds[r] + rng.permutation(bounds[r + 1] - bounds[r]) for r, rng in enumerate(self.rngs)
+        ]).astype(int)
+        buys = buys[order]
+        buy_amounts = buy_amounts[order]
+
+        # Sort the sell orders of every run by price (low to high), ties by agent id
+        order = np.lexsort((sells, self.sell_price[sells], run[sells]))
+        sells = sells[order]
+        sell_amounts = sell_amounts[order]
+        sell_prices = self.sell_price[sells]
+
+        # Agent-to-agent trades only in distributed runs and only with sellers below the central sell price
+        traded_buys = np.zeros(len(buys))
+        value_buys = np.zeros(len(buys))
+        traded_sells = np.zeros(len(sells))
+        eligible = self.distributed[run[sells]] & (sell_prices <= CENTRAL_SELL_PRICE)
+        if np.any(eligible):
+            traded_buys, value_buys, traded_eligible = clear_grouped(
+                buy_amounts, run[buys], sell_amounts[eligible], sell_prices[eligible], run[sells[eligible]], self.n_runs
+            )
+            traded_sells[eligible] = traded_eligible
+
+        # Settle agent-to-agent trades and the remaining amounts with the central agent, without the rounding
+        # leftovers of the matching, like clear_book
+        central_buys = buy_amounts - traded_buys
+        central_buys[central_buys <= RESIDUAL_TOLERANCE] = 0
+        central_sells = sell_amounts - traded_sells
+        central_sells[central_sells <= RESIDUAL_TOLERANCE] = 0
+        self.balance[buys] -= value_buys + central_buys * CENTRAL_SELL_PRICE
+        self.balance[sells] += traded_sells * sell_prices + central_sells * CENTRAL_BUY_PRICE
+        self.has_sold[sells] = True
+
+        central_energy_sold = self.per_run(central_buys, buys)
+        central_energy_bought = self.per_run(central_sells, sells)
+
+        # Calculate the weighted average price
+        total_amount_sold = self.per_run(traded_buys, buys) + central_energy_sold + central_energy_bought
+        total_value = self.per_run(value_buys, buys) + central_energy_sold * CENTRAL_SELL_PRICE + central_energy_bought * CENTRAL_BUY_PRICE
+        avg_price = np.divide(total_value, total_amount_sold, out=np.zeros(self.n_runs), where=total_amount_sold > 0)
+        avg_balance = self.per_run(self.balance) / self.n_agents
+
+        self.avg_price = avg_price
+        return np.column_stack((avg_balance, total_demand, central_energy_sold, total_produced, avg_price))
+
+
+# Simulate a batch of runs
+def simulate_batch(runs, t_max, percentage_diff, interval=None):
+    """
+    Simulate runs of different configurations together, returns the metrics of every run and timestep as an array of
+    shape (runs, t_max, number of metrics)
+    :param runs: the runs as (mode, n_agents, sens_range, panel_prod, seed, population) tuples, seed is the seed
+                 sequence of the run and population the options of get_population (None for generate_agents)
+    :param t_max: the maximum number of timesteps
+    :param percentage_diff: percentage difference between summer and winter energy production
+    :param interval: the number of hours per timestep (None for one timestep per day)
+    """
+    # Every run starts like a RunState of the vectorized engine
+    populations, modes, rngs, avg_prices = [], [], [], []
+    for mode, n_agents, sens_range, panel_prod, seed, population in runs:
+        rng = np.random.default_rng(seed)
+        populations.append(create_agents(n_agents, False, sens_range, panel_prod, 'vectorized', rng, seed, population)[1])
+        modes.append(mode)
+        rngs.append(rng)
+        avg_prices.append(round(rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01), 2))
+    batch = BatchedPopulation(populations, modes, rngs, avg_prices)
+
+    if interval is not None:
+        energy_levels, demand_shares = interval_levels(t_max, interval)
+
+    results = np.empty((len(runs), t_max, len(METRICS)))
+    for day in range(t_max):
+        if interval is None:
+            # The seasonal production of daily_energy_level with the weather noise of every run
+            levels = np.array([daily_energy_level(day, percentage_diff, rng=rng) for rng in rngs])
+            results[:, day] = batch.step(day, levels)
+        else:
+            levels = np.full(len(runs), energy_levels[day])
+            results[:, day] = batch.step(day * interval // 24, levels, demand_shares[day])
+    return results
+
+
+# Run the configurations of a sweep in batches
+def batched_simulation(configs, n_runs=10, t_max=1000, engine='vectorized', out_format='npz', summary=True,
+                       quantiles=None, batch_size=None, interval=None, population=None, output=None):
+    """
+    Run the simulation of every configuration with the runs of all configurations batched together, and write the
+    results files of simulation(). Returns the paths of the results files.
+    :param configs: the configurations as dictionaries with the mode, n_agents, sens_range, panel_prod, the master
+                    seed and out_file of a simulation() call, and optionally the population options of the
+                    configuration
+    :param n_runs: the number of runs per configuration
+    :param t_max: the maximum number of timesteps
+    :param engine: the prosumer engine, batching follows the vectorized engine
+    :param out_format: the format of the results files
+    :param summary: write the per-timestep summary of every configuration next to its results
+    :param quantiles: quantiles to add to the summaries
+    :param batch_size: the maximum number of runs simulated together (None for all runs of all configurations)
+    :param interval: the number of hours per timestep (None for one timestep per day)
+    :param population: options of get_population of the configurations without their own (None for generate_agents)
+    :param output: the granularity of the results files, see output_layout
+    """
+    if engine != 'vectorized':
+        raise ValueError("Batched simulations follow the vectorized engine")
+
+    _, _, percentage_diff = get_average_difference_in_seasons(DATA_YEAR)
+    if interval is not None:
+        get_production_series(interval)
+
+    timesteps, columns = output_layout(t_max, output)
+    stores, stats, runs = [], [], []
+    for c, config in enumerate(configs):
+        seed_sequence = np.random.SeedSequence(config['seed'])
+        config_population = config.get('population', population)
+        stores.append(ResultStore(config['out_file'], n_runs, t_max, out_format=out_format,
+                                  timesteps=timesteps if output is not None else None, columns=columns, metadata={
+            'mode': config['mode'],
+            'n_agents': config['n_agents'],
+            'sens_range': config['sens_range'],
+            'panel_prod': config['panel_prod'],
+            'engine': engine,
+            'seed': seed_sequence.entropy,
+            'percentage_diff': percentage_diff,
+            'interval': interval,
+            'population': config_population,
+            'output': output,
+            'batched': True
+        }))
+        stats.append(RunningStats((len(timesteps), len(columns)), quantiles))
+        for run, seed in enumerate(seed_sequence.spawn(n_runs)):
+            runs.append((c, run, (config['mode'], config['n_agents'], config['sens_range'], config['panel_prod'], seed,
+                                  config_population)))
+
+    batch_size = batch_size or len(runs)
+    for start in range(0, len(runs), batch_size):
+        batch = runs[start:start + batch_size]
+        results = simulate_batch([args for _, _, args in batch], t_max, percentage_diff, interval)
+        for (c, run, _), run_results in zip(batch, results):
+            reduced = reduce_results(run_results, output)
+            stores[c].add_run(run, reduced)
+            stats[c].add(reduced)
+
+    for config, store, config_stats in zip(configs, stores, stats):
+        if summary:
+            write_summary(config_stats, columns, os.path.splitext(config['out_file'])[0] + '_summary.csv', timesteps=timesteps)
+        store.flush()
+
+    return [config['out_file'] for config in configs]
+
+
+# Split the options of a sweep into the options of batched_simulation
+def batch_options(options):
+    """
+    Return the options of simulation() that batched_simulation supports, raises a ValueError for the other options
+    unless they have the default value of simulation()
+    :param options: keyword arguments of simulation()
+    """
+    import inspect
+
+    from main import simulation
+
+    parameters = inspect.signature(simulation).parameters
+    unsupported = [key for key, value in options.items()
+                   if key not in BATCHED_OPTIONS and (key not in parameters or value != parameters[key].default)]
+    if unsupported:
+        raise ValueError(f"Options not supported by batched simulations: {unsupported}")
+    return {key: value for key, value in options.items() if key in BATCHED_OPTIONS}
@@ -0,0 +1,336 @@
+"""
+Benchmarks for the hot paths of the simulation.
+Times the full simulation() and every phase of a simulated day in isolation (agent generation, daily update,
+order creation, distributed matching, central settlement and result writing) for a range of agent counts, engines
+and modes. Reports throughput in agent-days per second and peak memory, and saves the results as a JSON baseline
+that later runs can be compared against:
+
+    python benchmark.py --agents 200 1000 10000 --save ../benchmarks/before.json
+    python benchmark.py --agents 200 1000 10000 --compare ../benchmarks/before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from agent import CentralAgent
+from data import get_average_difference_in_seasons
+from enums import OrderType
+from main import CENTRAL_BUY_PRICE, CENTRAL_SELL_PRICE, daily_energy_level, generate_agents, simulation
+from market import ClearingEngine, clear_book
+from population import ProsumerPopulation
+from results import METRICS, ResultStore
+
+
+# Time a function
+def time_call(func, setup=None, repeat=3, statistic=min):
+    """
+    Return the best (or another statistic of the) wall clock time of a number of calls of a function
+    :param func: the function, called with the return value of setup (if given)
+    :param setup: function preparing the arguments of a call, not timed
+    :param repeat: the number of calls
+    :param statistic: function reducing the times of the calls to one, e.g. np.median
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return float(statistic(times))
+
+
+# Measure the peak memory of a function
+def peak_memory(func, setup=None):
+    """
+    Return the peak memory in bytes allocated by Python during one call of a function
+    :param func: the function, called with the return value of setup (if given)
+    :param setup: function preparing the arguments of the call, not measured
+    """
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Day state for the phase benchmarks
+class DayState():
+
+    # Initialize a population after a warm-up day
+    def __init__(self, n_agents, engine, mode, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.engine = engine
+        self.mode = mode
+        self.n_agents = n_agents
+        _, _, self.percentage_diff = get_average_difference_in_seasons(2022)
+        self.energy_today = daily_energy_level(180, self.percentage_diff, rng=self.rng)
+        self.avg_price = 0.15
+        self.central_agent = CentralAgent(0, CENTRAL_SELL_PRICE, CENTRAL_BUY_PRICE)
+
+        self.agent_list = generate_agents(n_agents, False, rng=self.rng)
+        if engine == 'vectorized':
+            self.population = ProsumerPopulation.from_agents(self.agent_list)
+        else:
+            self.clearing_engine = ClearingEngine(self.central_agent, mode)
+        self.update()
+
+    # Method to update all agents
+    def update(self):
+        if self.engine == 'vectorized':
+            self.population.update(self.energy_today, self.avg_price, 180, self.rng)
+        else:
+            for agent in self.agent_list:
+                agent.update(self.energy_today, self.avg_price, 180, self.rng)
+
+    # Method to create the orders of the day
+    def create_orders(self):
+        if self.engine == 'vectorized':
+            return (self.population.create_orders(),)
+
+        buy_order_list = []
+        sell_order_list = []
+        for agent in self.agent_list:
+            order = agent.create_order()
+            if order is not None:
+                if order.type == OrderType.BUY:
+                    buy_order_list.append(order)
+                else:
+                    sell_order_list.append(order)
+        self.rng.shuffle(buy_order_list)
+        return buy_order_list, sell_order_list
+
+    # Method to start a new day and create its orders
+    def prepare(self):
+        self.update()
+        return self.create_orders()
+
+    # Method to clear the orders of the day
+    def clear(self, *orders):
+        if self.engine == 'vectorized':
+            clear_book(orders[0], self.population.price_order, self.central_agent, self.mode, self.rng)
+        else:
+            self.clearing_engine.clear(self.agent_list, *orders)
+
+
+# Benchmark the phases of a day
+def bench_phases(n_agents, engine, mode, n_runs=10, t_max=365, repeat=3):
+    """
+    Time every phase of a simulated day in isolation, returns a dictionary of phase name to seconds
+    :param n_agents: the number of agents
+    :param engine: the prosumer engine ('object' or 'vectorized')
+    :param mode: the mode of the simulation ('centralised' or 'distributed')
+    :param n_runs: the number of runs for the result writing phase
+    :param t_max: the number of timesteps for the result writing phase
+    :param repeat: the number of repetitions, the best time is reported
+    """
+    rng = np.random.default_rng(0)
+    state = DayState(n_agents, engine, mode)
+    # Matching is timed in the mode of the benchmark, settlement always with the central agent only
+    central_state = DayState(n_agents, engine, 'centralised')
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        def write():
+            store = ResultStore(os.path.join(out_dir, 'results.npz'), n_runs, t_max)
+            for run in range(n_runs):
+                store.add_run(run, rng.random((t_max, len(METRICS))))
+            store.flush()
+
+        return {
+            'generate': time_call(lambda: generate_agents(n_agents, False, rng=rng), repeat=repeat),
+            'update': time_call(state.update, repeat=repeat),
+            'orders': time_call(state.create_orders, repeat=repeat),
+            'matching': time_call(state.clear, state.prepare, repeat=repeat),
+            'settlement': time_call(central_state.clear, central_state.prepare, repeat=repeat),
+            'write': time_call(write, repeat=repeat)
+        }
+
+
+# Benchmark the full simulation
+def bench_simulation(n_agents, t_max, engine, mode, n_runs=1, memory=True, repeat=5, n_zones=1, n_threads=1):
+    """
+    Time the full simulation, returns the median time, the throughput in agent-days per second and the peak memory
+    :param n_agents: the number of agents
+    :param t_max: the number of timesteps
+    :param engine: the prosumer engine ('object' or 'vectorized')
+    :param mode: the mode of the simulation ('centralised' or 'distributed')
+    :param n_runs: the number of runs
+    :param memory: also measure the peak memory (in a separate run, tracing slows the simulation down)
+    :param repeat: the number of timed simulations
+    :param n_zones: the number of neighbourhood zones (vectorized engine only)
+    :param n_threads: the number of threads clearing the zones
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        def run():
+            simulation(mode, n_agents, n_runs, t_max, sens_range=[0.005, 0.02], engine=engine, seed=0,
+                       out_file=os.path.join(out_dir, 'results.npz'), show_progress=False, summary=False,
+                       n_zones=n_zones, n_threads=n_threads)
+
+        seconds = time_call(run, repeat=repeat, statistic=np.median)
+        return {
+            'seconds': seconds,
+            'agent_days_per_second': n_agents * t_max * n_runs / seconds,
+            'peak_memory': peak_memory(run) if memory else None
+        }
+
+
+# Run the benchmark suite
+def run_suite(agent_counts, t_maxes, engines, modes, repeat=5, memory=True, max_agent_days=2e7, simulation_repeat=5,
+              zone_counts=(), thread_counts=(1,)):
+    """
+    Run the phase and simulation benchmarks for every combination of the parameters
+    :param agent_counts: the numbers of agents
+    :param t_maxes: the numbers of timesteps of the full simulation
+    :param engines: the prosumer engines
+    :param modes: the modes of the simulation
+    :param repeat: the number of repetitions of the phase benchmarks
+    :param memory: also measure the peak memory of the full simulation
+    :param max_agent_days: skip full simulations of the object engine above this number of agent-days
+    :param simulation_repeat: the number of repetitions of the full simulations, the median is reported
+    :param zone_counts: numbers of zones of extra full simulations of the vectorized engine, every number of zones
+                        with every number of threads (the speedup of the threads needs a machine with several cores)
+    :param thread_counts: the numbers of threads clearing the zones
+    """
+    records = []
+    for engine in engines:
+        for mode in modes:
+            for n_agents in agent_counts:
+                phases = bench_phases(n_agents, engine, mode, repeat=repeat)
+                record = {'case': f'{engine}/{mode}/phases/{n_agents}', 'engine': engine, 'mode': mode,
+                          'n_agents': n_agents, 'phases': phases}
+                records.append(record)
+                print_record(record)
+
+                for t_max in t_maxes:
+                    if engine == 'object' and n_agents * t_max > max_agent_days:
+                        continue
+                    record = {'case': f'{engine}/{mode}/simulation/{n_agents}/{t_max}', 'engine': engine,
+                              'mode': mode, 'n_agents': n_agents, 't_max': t_max}
+                    record.update(bench_simulation(n_agents, t_max, engine, mode, memory=memory, repeat=simulation_repeat))
+                    records.append(record)
+                    print_record(record)
+
+                    if engine != 'vectorized':
+                        continue
+                    for n_zones in zone_counts:
+                        for n_threads in thread_counts:
+                            record = {'case': f'{engine}/{mode}/zones/{n_agents}/{t_max}/{n_zones}x{n_threads}',
+                                      'engine': engine, 'mode': mode, 'n_agents': n_agents, 't_max': t_max,
+                                      'n_zones': n_zones, 'n_threads': n_threads}
+                            record.update(bench_simulation(n_agents, t_max, engine, mode, memory=memory,
+                                                           repeat=simulation_repeat, n_zones=n_zones, n_threads=n_threads))
+                            records.append(record)
+                            print_record(record)
+    return records
+
+
+# Print a benchmark record
+def print_record(record):
+    if 'phases' in record:
+        phases = ', '.join(f'{name} {seconds * 1000:.2f} ms' for name, seconds in record['phases'].items())
+        print(f"{record['case']:45s} {phases}")
+    else:
+        memory = f", peak memory {record['peak_memory'] / 2**20:.1f} MiB" if record['peak_memory'] is not None else ''
+        print(f"{record['case']:45s} {record['seconds']:.3f} s, {record['agent_days_per_second']:,.0f} agent-days/s{memory}")
+
+
+# Get the current git commit
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Save a baseline
+def save_baseline(records, path):
+    """
+    Save benchmark records as a JSON baseline
+    :param records: the records returned by run_suite
+    :param path: path of the JSON file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': git_commit(),
+            'created': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'records': records
+        }, f, indent=4)
+
+
+# Compare with a baseline
+def compare(records, path, tolerance=0.1, noise_floor=0.005):
+    """
+    Compare benchmark records with a saved baseline and print the speedup of every case and phase. Returns the
+    cases that are more than the tolerance and more than the noise floor slower than the baseline.
+    :param records: the records returned by run_suite
+    :param path: path of the JSON baseline
+    :param tolerance: the relative slowdown that counts as a regression
+    :param noise_floor: the absolute slowdown in seconds below which a timing is noise, e.g. of sub-millisecond
+                        phases
+    """
+    with open(path, encoding='utf-8') as f:
+        baseline = {record['case']: record for record in json.load(f)['records']}
+
+    regressions = []
+    for record in records:
+        old = baseline.get(record['case'])
+        if old is None:
+            continue
+
+        if 'phases' in record:
+            timings = [(f"{record['case']}/{name}", old['phases'][name], seconds) for name, seconds in record['phases'].items() if name in old['phases']]
+        else:
+            timings = [(record['case'], old['seconds'], record['seconds'])]
+
+        for case, old_seconds, seconds in timings:
+            speedup = old_seconds / seconds
+            flag = ''
+            if seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > noise_floor:
+                regressions.append(case)
+                flag = '  REGRESSION'
+            print(f"{case:55s} {old_seconds * 1000:10.2f} ms -> {seconds * 1000:10.2f} ms  x{speedup:.2f}{flag}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the simulation')
+    parser.add_argument('--agents', type=int, nargs='+', default=[200, 1000, 10000, 100000], help='numbers of agents')
+    parser.add_argument('--t-max', type=int, nargs='+', default=[30, 365], help='numbers of timesteps of the full simulation')
+    parser.add_argument('--engines', nargs='+', default=['object', 'vectorized'], choices=['object', 'vectorized'])
+    parser.add_argument('--modes', nargs='+', default=['distributed', 'centralised'], choices=['distributed', 'centralised'])
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of the phase benchmarks')
+    parser.add_argument('--simulation-repeat', type=int, default=5, help='repetitions of the full simulations')
+    parser.add_argument('--zones', type=int, nargs='+', default=[], help='numbers of zones of extra vectorized simulations')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1], help='numbers of threads clearing the zones')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement')
+    parser.add_argument('--save', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown that counts as a regression')
+    parser.add_argument('--noise-floor', type=float, default=5, help='slowdown in ms below which a timing is noise')
+    args = parser.parse_args()
+
+    records = run_suite(args.agents, args.t_max, args.engines, args.modes, args.repeat, not args.no_memory,
+                        simulation_repeat=args.simulation_repeat, zone_counts=args.zones, thread_counts=args.threads)
+
+    if args.save:
+        save_baseline(records, args.save)
+    if args.compare:
+        regressions = compare(records, args.compare, args.tolerance, args.noise_floor / 1000)
+        if regressions:
+            print(f"{len(regressions)} regressions")
+            raise SystemExit(1)
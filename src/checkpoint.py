@@ -0,0 +1,45 @@
+"""
+Checkpoints of the simulation.
+A checkpoint is the pickled RunState of a run: the agents, the central agent, the average price, the day, the results
+so far and the state of the random number generator. Loading a checkpoint and stepping on gives exactly the same
+results as the uninterrupted run, so long simulations can be resumed and what-if scenarios can be forked from one
+warmed up state instead of re-simulating the first years.
+"""
+
+import os
+
+
+# Get the path of the checkpoint of a run
+def checkpoint_path(checkpoint_dir, run):
+    """
+    :param checkpoint_dir: the folder of the checkpoints of a simulation
+    :param run: the index of the run
+    """
+    return os.path.join(checkpoint_dir, f'run{run:04d}.pkl')
+
+
+# Save a checkpoint
+def save_checkpoint(state, path):
+    """
+    Save the state of a run, the previous checkpoint at the path is only replaced once the new one is complete
+    :param state: the RunState of the run
+    :param path: path of the checkpoint
+    """
+    import pickle
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.part', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.part', path)
+
+
+# Load a checkpoint
+def load_checkpoint(path):
+    """
+    Load the state of a run
+    :param path: path of the checkpoint
+    """
+    import pickle
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -1,12 +1,61 @@
-"""	
+"""
 File that handles the data of solar panel production.
+The production data is parsed once per year and data file, the resulting solar profile is kept in memory and
+in a small cache file next to the data, so later runs and worker processes do not need pandas at all. The same
+goes for the hourly production series of the interval mode, which is cached as a memory-mapped array.
 """
 
-import pandas as pd
+import json
+import os
 
+import numpy as np
+
+DATA_FILE = '../data/ProvincialProduction.csv'
+CACHE_DIR = '../data/cache'
+
+# Solar profiles, production series and seasonal constants that were already loaded in this process
+_profiles = {}
+_series = {}
+_seasons = {}
+
+
+# Calculate the hash of the data file
+def file_hash(file_path):
+    """
+    Calculate the hash of a file, used to key the cache on the content of the data file
+    :param file_path: path of the file
+    """
+    import hashlib
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+# Temporary name of a cache file being written
+def part_file(path, extension=''):
+    """
+    Name of the temporary file a cache file is written to before it is moved into place. The name is unique per
+    process, so processes filling the same cache at the same time never move each other's file, and the last one
+    to move its (identical) file into place simply wins.
+    :param path: path of the cache file
+    :param extension: extension numpy appends to the temporary file, e.g. '.npz'
+    """
+    return f'{path}.{os.getpid()}.part{extension}'
+
+
+# Parse the solar profile of a year from the data file
+def parse_solar_profile(year, file_path=DATA_FILE):
+    """
+    Parse the production data of a year and calculate the seasonal statistics and normalized production curves
+    :param year: the year of the data
+    :param file_path: path of the production data
+    """
+    # pandas is only needed when the profile is not cached yet
+    import pandas as pd
 
-def get_average_difference_in_seasons(year):
-    file_path = '../data/ProvincialProduction.csv'
     solar_data_cleaned = pd.read_csv(file_path, skiprows=13)
 
     solar_data_cleaned['Local'] = pd.to_datetime(solar_data_cleaned['Local'])
@@ -22,17 +71,209 @@ def get_average_difference_in_seasons(year):
     summer_data_filtered_year = summer_data_year[summer_data_year['Groningen'] > 0]
     winter_data_filtered_year = winter_data_year[winter_data_year['Groningen'] > 0]
 
-    if not summer_data_filtered_year.empty and not winter_data_filtered_year.empty:
-        summer_avg_production_filtered_year = summer_data_filtered_year['Groningen'].mean()
-        winter_avg_production_filtered_year = winter_data_filtered_year['Groningen'].mean()
+    if summer_data_filtered_year.empty or winter_data_filtered_year.empty:
+        return None
+
+    summer_avg_production_filtered_year = summer_data_filtered_year['Groningen'].mean()
+    winter_avg_production_filtered_year = winter_data_filtered_year['Groningen'].mean()
+
+    # Calculate the percentage difference
+    percentage_difference_filtered_year = ((summer_avg_production_filtered_year - winter_avg_production_filtered_year) / winter_avg_production_filtered_year) * 100
+
+    # Production per day of the year and hour of the day
+    production = solar_data_year['Groningen'].clip(lower=0)
+    hourly = production.groupby([solar_data_year['Local'].dt.dayofyear, solar_data_year['Local'].dt.hour]).sum().unstack(fill_value=0)
+    hourly = hourly.reindex(index=range(1, 367), columns=range(24), fill_value=0).to_numpy(dtype=float)
+
+    # Daily production relative to the average day, and the share of every hour in the production of its day
+    daily = hourly.sum(axis=1)
+    n_days = 366 if daily[365] > 0 else 365
+    daily = daily[:n_days]
+    hourly = hourly[:n_days]
+    daily_profile = daily / daily.mean()
+    hourly_profile = np.divide(hourly, daily[:, None], out=np.zeros_like(hourly), where=daily[:, None] > 0)
+
+    return {
+        'summer_avg': summer_avg_production_filtered_year,
+        'winter_avg': winter_avg_production_filtered_year,
+        'percentage_diff': percentage_difference_filtered_year,
+        'daily_profile': daily_profile,
+        'hourly_profile': hourly_profile
+    }
+
+
+# Load the solar profile of a year
+def get_solar_profile(year, file_path=DATA_FILE, cache_dir=CACHE_DIR):
+    """
+    Get the solar profile of a year, from memory, from the cache file or by parsing the data file (in that order)
+    :param year: the year of the data
+    :param file_path: path of the production data
+    :param cache_dir: folder of the cache files (None to disable the cache file)
+    """
+    key = (os.path.abspath(file_path), os.path.getmtime(file_path), year)
+    if key in _profiles:
+        return _profiles[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'solar_{year}_{file_hash(file_path)}.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        # An empty cache file means the year has no usable data
+        with np.load(cache_file) as cache:
+            profile = {name: cache[name] for name in cache.files} or None
+        if profile is not None:
+            for name in ['summer_avg', 'winter_avg', 'percentage_diff']:
+                profile[name] = float(profile[name])
+    else:
+        profile = parse_solar_profile(year, file_path)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            part = part_file(cache_file, '.npz')
+            np.savez(part, **(profile if profile is not None else {}))
+            os.replace(part, cache_file)
+
+    _profiles[key] = profile
+    return profile
+
+
+# Parse the production time series from the data file
+def parse_production_series(file_path=DATA_FILE, column='Groningen'):
+    """
+    Parse the production of a province into an hourly time series from the first to the last timestamp of the data
+    file, hours without data count as zero. Returns the first hour and the production of every hour.
+    :param file_path: path of the production data
+    :param column: the province
+    """
+    # pandas is only needed when the series is not cached yet
+    import pandas as pd
 
-        # Calculate the percentage difference
-        percentage_difference_filtered_year = ((summer_avg_production_filtered_year - winter_avg_production_filtered_year) / winter_avg_production_filtered_year) * 100
-        return summer_avg_production_filtered_year, winter_avg_production_filtered_year, percentage_difference_filtered_year
+    solar_data = pd.read_csv(file_path, skiprows=13, usecols=['Local', column])
+    local = pd.to_datetime(solar_data['Local'])
+
+    start = local.min().floor('h')
+    hours = ((local - start) // pd.Timedelta(hours=1)).to_numpy()
+    production = np.zeros(hours.max() + 1)
+    np.add.at(production, hours, solar_data[column].clip(lower=0).to_numpy(dtype=float))
+
+    return np.datetime64(start, 'h'), production
+
+
+# Load the production time series
+def get_production_series(interval=1, file_path=DATA_FILE, column='Groningen', cache_dir=CACHE_DIR):
+    """
+    Get the production per interval of the data file as a share of the production of an average day, so an
+    average day sums to 1. The series is parsed once and cached as a .npy file (with a json sidecar holding the
+    first hour) that is memory-mapped by every later run and worker process.
+    Returns the first hour of the series and the series.
+    :param interval: the number of hours per interval, a divisor of 24
+    :param file_path: path of the production data
+    :param column: the province
+    :param cache_dir: folder of the cache files (None to disable the cache file)
+    """
+    if 24 % interval != 0:
+        raise ValueError(f"Interval must be a divisor of 24 hours, got {interval}")
+
+    key = (os.path.abspath(file_path), os.path.getmtime(file_path), column, interval)
+    if key in _series:
+        return _series[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'production_{column}_{interval}h_{file_hash(file_path)}.npy')
+
+    # The sidecar is moved into place before the series, so a complete series always has its sidecar
+    if cache_file is not None and os.path.exists(cache_file) and os.path.exists(cache_file + '.json'):
+        with open(cache_file + '.json', encoding='utf-8') as f:
+            start = np.datetime64(json.load(f)['start'], 'h')
+        series = np.load(cache_file, mmap_mode='r')
     else:
-        return None, None, None
-    
-    
+        start, production = parse_production_series(file_path, column)
+
+        # Whole intervals only, as a share of the production of an average day
+        n_intervals = len(production) // interval
+        production = production[:n_intervals * interval].reshape(n_intervals, interval).sum(axis=1)
+        series = production / (production.sum() / (n_intervals * interval / 24))
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            part = part_file(cache_file + '.json')
+            with open(part, 'w', encoding='utf-8') as f:
+                json.dump({'start': str(start), 'interval': interval, 'column': column}, f)
+            os.replace(part, cache_file + '.json')
+            part = part_file(cache_file, '.npy')
+            np.save(part, series)
+            os.replace(part, cache_file)
+            series = np.load(cache_file, mmap_mode='r')
+
+    _series[key] = (start, series)
+    return start, series
+
+
+# Get the position of a year in a production series
+def series_offset(start, year, interval=1):
+    """
+    The index of the first interval of a year in a production series
+    :param start: the first hour of the series
+    :param year: the year
+    :param interval: the number of hours per interval
+    """
+    return int((np.datetime64(f'{year}-01-01T00', 'h') - start).astype(int)) // interval
+
+
+# Read a json index of the cache
+def read_index(path):
+    """
+    Read a json index of the cache folder, an empty index if it does not exist (yet)
+    :param path: path of the index (None for no index)
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Load the seasonal constants of a year
+def get_seasonal_constants(year, file_path=DATA_FILE, cache_dir=CACHE_DIR):
+    """
+    Get the summer average, winter average and percentage difference of a year. They are kept in a small json index
+    in the cache folder, keyed on the size and modification time of the data file, so a short job reads one small
+    file instead of hashing the data file and loading the solar profile. Processes adding entries at the same time
+    may drop each other's entry from the index, which only means it is computed again later.
+    :param year: the year of the data
+    :param file_path: path of the production data
+    :param cache_dir: folder of the cache files (None to disable the cache file)
+    """
+    stat = os.stat(file_path)
+    key = f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}:{year}'
+    if key in _seasons:
+        return _seasons[key]
+
+    index_file = os.path.join(cache_dir, 'seasons.json') if cache_dir is not None else None
+    index = read_index(index_file)
+
+    if key not in index:
+        profile = get_solar_profile(year, file_path, cache_dir)
+        index[key] = [profile['summer_avg'], profile['winter_avg'], profile['percentage_diff']] if profile is not None else None
+        if index_file is not None:
+            # Merge with the entries other processes added while the profile was loaded
+            entry = index[key]
+            index = read_index(index_file)
+            index[key] = entry
+            os.makedirs(cache_dir, exist_ok=True)
+            part = part_file(index_file)
+            with open(part, 'w', encoding='utf-8') as f:
+                json.dump(index, f, indent=4)
+            os.replace(part, index_file)
+
+    _seasons[key] = tuple(index[key]) if index[key] is not None else (None, None, None)
+    return _seasons[key]
+
+
+def get_average_difference_in_seasons(year):
+    return get_seasonal_constants(year)
+
+
 if __name__ == '__main__':
     _, _, percentage_diff = get_average_difference_in_seasons(2022)
-    print(percentage_diff)
\ No newline at end of file
+    print(percentage_diff)
@@ -0,0 +1,92 @@
+"""
+Instrumentation of the simulation.
+An Instrumentation collects named phase timers and event counters of a run (orders created, matches, partial fills,
+central fallbacks, sell orders scanned). When profiling is disabled the NullInstrumentation is used, whose methods
+do nothing, so the simulation pays one empty method call per phase and day.
+"""
+
+import csv
+from time import perf_counter
+
+# Phases of a simulated day, in order
+PHASES = ['generate', 'energy', 'update', 'orders', 'sort', 'matching', 'central', 'store']
+
+# Counters of a run
+COUNTERS = ['days', 'buy orders', 'sell orders', 'matches', 'inter-zone matches', 'partial fills', 'central sales', 'central purchases', 'sell orders scanned']
+
+
+# Instrumentation class
+class Instrumentation():
+    enabled = True
+
+    # Initialize the instrumentation
+    def __init__(self):
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._started = {}
+
+    # Method to start the timer of a phase
+    def start(self, phase):
+        self._started[phase] = perf_counter()
+
+    # Method to stop the timer of a phase
+    def stop(self, phase):
+        self.timings[phase] = self.timings.get(phase, 0.0) + perf_counter() - self._started[phase]
+
+    # Method to increase a counter
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # Method to get the summary of the run
+    def summary(self):
+        """
+        Return a dictionary with the total time of every phase ('time <phase>' in seconds), every counter and the
+        average number of sell orders scanned per buy order
+        """
+        summary = {f'time {phase}': seconds for phase, seconds in self.timings.items()}
+        summary.update(self.counters)
+        buy_orders = self.counters.get('buy orders', 0)
+        summary['sell orders scanned per buy'] = self.counters.get('sell orders scanned', 0) / buy_orders if buy_orders else 0
+        return summary
+
+
+# Instrumentation that does nothing
+class NullInstrumentation(Instrumentation):
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def start(self, phase):
+        pass
+
+    def stop(self, phase):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def summary(self):
+        return {}
+
+
+# Shared instance for disabled profiling
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+# Write profiles to a table
+def write_profile(profiles, path):
+    """
+    Write the profile summaries of all runs as a csv table with one row per run
+    :param profiles: list of the summaries of the runs, in run order
+    :param path: path of the csv file
+    """
+    columns = []
+    for profile in profiles:
+        columns.extend(name for name in profile if name not in columns)
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run'] + columns)
+        for run, profile in enumerate(profiles):
+            writer.writerow([run] + [profile.get(name, 0) for name in columns])
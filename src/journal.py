@@ -0,0 +1,237 @@
+"""
+Event journal of the simulation.
+Instead of printing every order, match and trade with the central agent, the simulation records them as fixed size
+records in a preallocated ring buffer (EventJournal). Every kind of event has a level, like the levels of the logging
+module, and the journal only keeps the kinds at or above its level, optionally only a random sample of them. When
+the buffer is full the oldest events are overwritten, so a run keeps its last events at a fixed memory cost.
+The events of all runs are appended to a binary file of EVENT_DTYPE records that is read back with load_journal.
+"""
+
+import os
+
+import numpy as np
+
+# Levels of the events, the same values as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+# Kinds of events
+DAY = 0
+BUY_ORDER = 1
+SELL_ORDER = 2
+MATCH = 3
+PARTIAL_FILL = 4
+CENTRAL_SALE = 5
+CENTRAL_PURCHASE = 6
+UNSATISFIED = 7
+
+# Names and levels of the kinds of events
+EVENT_KINDS = ['day', 'buy order', 'sell order', 'match', 'partial fill', 'central sale', 'central purchase', 'unsatisfied']
+EVENT_LEVELS = [INFO, DEBUG, DEBUG, INFO, INFO, INFO, INFO, WARNING]
+
+# Counterparty of the events with the central agent or without a counterparty
+CENTRAL = -1
+
+# Record layout of an event
+# day: energy level of the day (amount) and average price of the previous day (price)
+# orders: agent and amount and price of the order
+# matches and partial fills: buyer (agent_id), seller (counterparty), amount and price
+# central sales and purchases: agent, amount and price of the central agent
+# unsatisfied: agent and the energy it is short of (amount)
+EVENT_DTYPE = np.dtype([
+    ('run', np.int32),
+    ('day', np.int32),
+    ('kind', np.int8),
+    ('agent_id', np.int64),
+    ('counterparty', np.int64),
+    ('amount', np.float64),
+    ('price', np.float64)
+])
+
+
+# Event journal class, a ring buffer of events
+class EventJournal():
+    enabled = True
+
+    # Initialize the journal
+    def __init__(self, run=0, capacity=2**16, level=INFO, kinds=None, sample=1.0, seed=0):
+        """
+        :param run: the index of the run, stored in every event
+        :param capacity: the number of events kept, older events are overwritten
+        :param level: the minimum level of the recorded events
+        :param kinds: the kinds of events to record (None for all kinds at or above the level)
+        :param sample: the fraction of the events that is recorded
+        :param seed: seed of the sampling, sampling does not use the random number generator of the run
+        """
+        self.run = run
+        self.events = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.n_events = 0
+        self.day = 0
+        self.sample = sample
+        self.rng = np.random.default_rng([seed, run])
+        self.active = [
+            EVENT_LEVELS[kind] >= level and (kinds is None or kind in kinds)
+            for kind in range(len(EVENT_KINDS))
+        ]
+
+    # Method to set the day of the following events
+    def start_day(self, day):
+        self.day = day
+
+    # Method to check whether a kind of event is recorded
+    def wants(self, kind):
+        return self.active[kind]
+
+    # Method to record an event
+    def record(self, kind, agent_id, counterparty=CENTRAL, amount=0.0, price=0.0):
+        """
+        Record a single event of the current day
+        :param kind: the kind of event
+        :param agent_id: the agent of the event (the buyer of a match)
+        :param counterparty: the other agent of the event (the seller of a match)
+        :param amount: the amount of energy
+        :param price: the price
+        """
+        if not self.active[kind] or (self.sample < 1 and self.rng.random() >= self.sample):
+            return
+
+        self.events[self.n_events % len(self.events)] = (self.run, self.day, kind, agent_id, counterparty, amount, price)
+        self.n_events += 1
+
+    # Method to record events in bulk
+    def record_many(self, kind, agent_ids, counterparties=CENTRAL, amounts=0.0, prices=0.0):
+        """
+        Record events of the current day, all arguments are arrays (or scalars) of the same length as agent_ids
+        :param kind: the kind of the events
+        :param agent_ids: the agents of the events (the buyers of matches)
+        :param counterparties: the other agents of the events (the sellers of matches)
+        :param amounts: the amounts of energy
+        :param prices: the prices
+        """
+        if not self.active[kind]:
+            return
+
+        agent_ids = np.asarray(agent_ids)
+        keep = np.broadcast_to(True, agent_ids.shape)
+        if self.sample < 1:
+            keep = self.rng.random(len(agent_ids)) < self.sample
+
+        events = np.zeros(len(agent_ids), dtype=EVENT_DTYPE)
+        events['agent_id'] = agent_ids
+        events['counterparty'] = counterparties
+        events['amount'] = amounts
+        events['price'] = prices
+        events = events[keep]
+
+        # Only the last events fit in the buffer
+        events = events[max(len(events) - len(self.events), 0):]
+        events['run'] = self.run
+        events['day'] = self.day
+        events['kind'] = kind
+        positions = (self.n_events + np.arange(len(events))) % len(self.events)
+        self.events[positions] = events
+        self.n_events += len(events)
+
+    # Method to get the recorded events
+    def view(self):
+        """
+        Return the events in the buffer in the order they were recorded
+        """
+        if self.n_events <= len(self.events):
+            return self.events[:self.n_events]
+        return np.roll(self.events, -(self.n_events % len(self.events)))
+
+    # Method to get the number of overwritten events
+    def dropped(self):
+        return max(self.n_events - len(self.events), 0)
+
+
+# Event journal that records nothing
+class NullJournal(EventJournal):
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def start_day(self, day):
+        pass
+
+    def wants(self, kind):
+        return False
+
+    def record(self, kind, agent_id, counterparty=CENTRAL, amount=0.0, price=0.0):
+        pass
+
+    def record_many(self, kind, agent_ids, counterparties=CENTRAL, amounts=0.0, prices=0.0):
+        pass
+
+    def view(self):
+        return np.zeros(0, dtype=EVENT_DTYPE)
+
+    def dropped(self):
+        return 0
+
+
+# Shared instance for a disabled journal
+NULL_JOURNAL = NullJournal()
+
+
+# Journal file class
+class JournalWriter():
+
+    # Initialize the journal file
+    def __init__(self, path):
+        """
+        :param path: path of the journal file, written to a temporary file until it is complete
+        """
+        self.path = path
+        self.part_path = path + '.part'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(self.part_path, 'wb')
+
+    # Method to append the events of a run
+    def add_run(self, events):
+        np.ascontiguousarray(events, dtype=EVENT_DTYPE).tofile(self.file)
+
+    # Method to complete the journal file
+    def flush(self):
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+
+# Load a journal file
+def load_journal(path, mmap=False):
+    """
+    Load the events of a journal file as a structured array of EVENT_DTYPE records
+    :param path: path of the journal file
+    :param mmap: memory-map the file instead of reading it
+    """
+    if mmap:
+        return np.memmap(path, dtype=EVENT_DTYPE, mode='r')
+    return np.fromfile(path, dtype=EVENT_DTYPE)
+
+
+# Format events as text
+def format_events(events):
+    """
+    Return one line of text per event, in the style of the verbose output of the simulation
+    :param events: structured array of EVENT_DTYPE records
+    """
+    lines = []
+    for event in events:
+        kind = event['kind']
+        prefix = f"Run {event['run']} day {event['day']}: "
+        if kind == DAY:
+            lines.append(prefix + f"Energy today {event['amount']}, average price {event['price']} €/kWh")
+        elif kind in (BUY_ORDER, SELL_ORDER):
+            lines.append(prefix + f"{EVENT_KINDS[kind].capitalize()} of Agent {event['agent_id']}, Amount {event['amount']}, Price {event['price']}")
+        elif kind in (MATCH, PARTIAL_FILL):
+            lines.append(prefix + f"{EVENT_KINDS[kind].capitalize()}: Buyer {event['agent_id']}, Seller {event['counterparty']}, Amount {event['amount']}, Price {event['price']}")
+        elif kind == CENTRAL_SALE:
+            lines.append(prefix + f"Central agent fulfilled {event['amount']} kWh for Buyer {event['agent_id']} at {event['price']} €/kWh")
+        elif kind == CENTRAL_PURCHASE:
+            lines.append(prefix + f"Central agent fulfilled {event['amount']} kWh for Seller {event['agent_id']} at {event['price']} €/kWh")
+        else:
+            lines.append(prefix + f"Agent {event['agent_id']} not satisfied, short of {event['amount']} kWh")
+    return lines
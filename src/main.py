@@ -3,15 +3,24 @@ Main file for running the simulation
 The simulation can be run in two modes: 'centralised' and 'distributed'
 """
 
-import csv
-from random import choices, shuffle, uniform
+import os
 
 import numpy as np
 
 from agent import CentralAgent, ProsumerAgent
-from data import get_average_difference_in_seasons
+from analysis import run_values
+from checkpoint import checkpoint_path, load_checkpoint, save_checkpoint
+from data import get_average_difference_in_seasons, get_production_series, series_offset
 from enums import HouseType, OrderType
+from instrument import NULL_INSTRUMENTATION, Instrumentation, write_profile
+from journal import BUY_ORDER, CENTRAL, DAY, NULL_JOURNAL, SELL_ORDER, UNSATISFIED, EventJournal, JournalWriter
+from market import ClearingEngine
+from population import ProsumerPopulation
 from progressbar import clear_progressbar, progressbar
+from results import (CUMULATIVE_METRICS, METRICS, ResultStore, output_layout, reduce_results, result_name,
+                     simulated_steps, write_snapshots)
+from stats import RunningStats, SteadyState, write_summary
+from telemetry import NULL_TELEMETRY, PORT, TelemetryPublisher, TelemetryServer
 
 #initalize buy and sell price of central agent
 CENTRAL_BUY_PRICE = 0.07
@@ -25,14 +34,35 @@ HOUSE_TYPE_DATA = {
     HouseType.MULTI_FAMILY_HOUSE: {"proportion": 60.6, "demand_range": (1510, 2210)}
 }
 
+# Base energy production level: 2 kWh per solar panel per day
+BASE_PRODUCTION = 2
+
+# Share of the daily household demand per hour of the day (low at night, peaks in the morning and evening)
+HOURLY_DEMAND_PROFILE = np.array([
+    2.6, 2.2, 2.0, 1.9, 1.9, 2.1, 2.9, 3.8, 4.2, 4.1, 4.0, 4.0,
+    4.1, 3.9, 3.8, 3.9, 4.5, 5.7, 6.6, 6.6, 6.1, 5.3, 4.3, 3.3
+])
+HOURLY_DEMAND_PROFILE = HOURLY_DEMAND_PROFILE / HOURLY_DEMAND_PROFILE.sum()
+
+# Year of the production data
+DATA_YEAR = 2022
+
+# Spawn key of the stream of the populations from get_population, apart from the children spawned by the runs
+POPULATION_STREAM = 2**32 - 1
+
 # Calculate the daily energy level
-def daily_energy_level(day, percentage_diff, verbose=False):
+def daily_energy_level(day, percentage_diff, verbose=False, rng=None, noise=None):
     """
     Caclulate the daily energy level based on the seasonality and random fluctuations
     :param day: current day
     :param percentage_diff: percentage difference between summer and winter energy production
     :param verbose: print additional information
+    :param rng: the random number generator of the run
+    :param noise: the daily fluctuation from a pre-drawn scenario (None to draw it from rng)
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     days_in_year = 365
     phase_shift = 0
  
@@ -45,10 +75,10 @@ def daily_energy_level(day, percentage_diff, verbose=False):
         print("Seasonal Effect: ", seasonal_effect)
 
     # Add daily fluctuation for randomness (cloudy days, varying weather)
-    daily_variability = np.random.uniform(-0.1, 0.1)
+    daily_variability = rng.uniform(-0.1, 0.1) if noise is None else noise
 
     # Base energy production level: 2 kWh per solar panel
-    base_production = 2
+    base_production = BASE_PRODUCTION
 
     if verbose:
         print("Seasonal Effect: ", seasonal_effect)
@@ -56,42 +86,70 @@ def daily_energy_level(day, percentage_diff, verbose=False):
     # Final daily energy production level with seasonal and random variations
     return base_production * (1 + seasonal_effect + daily_variability)
 
+# Look up the energy levels of the intervals of a run
+def interval_levels(t_max, interval, year=DATA_YEAR):
+    """
+    Energy produced per solar panel and share of the daily demand of every interval of a run in the interval mode,
+    looked up in one batch from the memory-mapped production series. The run starts at the first hour of the year
+    and wraps around to the start of the data when it runs past its end.
+    :param t_max: the number of intervals of the run
+    :param interval: the number of hours per interval
+    :param year: the year of the production data the run starts in
+    """
+    start, series = get_production_series(interval)
+    steps = np.arange(t_max)
+
+    energy_levels = BASE_PRODUCTION * np.take(series, series_offset(start, year, interval) + steps, mode='wrap')
+    demand_shares = HOURLY_DEMAND_PROFILE.reshape(-1, interval).sum(axis=1)[steps % (24 // interval)]
+    return energy_levels, demand_shares
+
 # Calculate the base demand for each house type
-def calculate_base_demand(house_type):
+def calculate_base_demand(house_type, rng=None):
     """
     Caclulate the base demand for each house type
     :param house_type: the type of the house
+    :param rng: the random number generator of the run
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     demand_range = HOUSE_TYPE_DATA[house_type]["demand_range"]
-    yearly_demand = np.random.randint(demand_range[0], demand_range[1] + 1)
+    yearly_demand = rng.integers(demand_range[0], demand_range[1] + 1)
     return yearly_demand
 
 # Generate agents with random house types and energy demands
-def generate_agents(n, verbose, sens_range=[0.005, 0.02], panel_production=1):
+def generate_agents(n, verbose, sens_range=[0.005, 0.02], panel_production=1, rng=None):
     """
     Generate agents with random house types and energy demands, and solar panels
     :param n: number of agents
     :param verbose: print additional information
     :param sens_range: sensitivity range for the agents
     :param panel_production: production of the solar panels
+    :param rng: the random number generator of the run
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     house_types = list(HOUSE_TYPE_DATA.keys())
-    house_proportions = [HOUSE_TYPE_DATA[ht]["proportion"] for ht in house_types]
+    house_proportions = np.array([HOUSE_TYPE_DATA[ht]["proportion"] for ht in house_types])
+    house_proportions /= house_proportions.sum()
 
     agent_list = []
 
     # Generate agents
     for i in range(n):
-        selected_house_type = choices(house_types, weights=house_proportions, k=1)[0]
-        base_energy_demand_yearly = calculate_base_demand(selected_house_type)
+        selected_house_type = house_types[rng.choice(len(house_types), p=house_proportions)]
+        base_energy_demand_yearly = calculate_base_demand(selected_house_type, rng)
         
         agent_list.append(
             ProsumerAgent(
                 id=i,
-                n_panels=calculate_solar_panels(base_energy_demand_yearly, panel_production),
+                # The panel production factor has always been passed as the noise level of the panels, seeded
+                # results depend on it; generate_population has separate parameters for both
+                n_panels=calculate_solar_panels(base_energy_demand_yearly, noise_level=panel_production, rng=rng),
                 base_energy_demand=base_energy_demand_yearly / 365,
-                sell_price=np.random.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01),
-                sensitivity=np.random.uniform(sens_range[0], sens_range[1]),
+                sell_price=rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01),
+                sensitivity=rng.uniform(sens_range[0], sens_range[1]),
                 house_type=selected_house_type
             )
         )
@@ -103,17 +161,124 @@ def generate_agents(n, verbose, sens_range=[0.005, 0.02], panel_production=1):
 
     return agent_list
 
+# Generate a population in bulk
+def generate_population(n, sens_range=[0.005, 0.02], panel_production=1, noise_level=0.2, zero_panel_prob=0.25, rng=None):
+    """
+    Generate the households of generate_agents as a ProsumerPopulation, every attribute is drawn for all households
+    at once. The random numbers are drawn in another order than generate_agents, so the same generator gives
+    another population.
+    :param n: number of agents
+    :param sens_range: sensitivity range for the agents
+    :param panel_production: production of the solar panels (see calculate_solar_panels)
+    :param noise_level: the noise level for the solar panels
+    :param zero_panel_prob: the probability of having 0 solar panels
+    :param rng: the random number generator of the population
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    house_types = list(HOUSE_TYPE_DATA.keys())
+    house_proportions = np.array([HOUSE_TYPE_DATA[ht]["proportion"] for ht in house_types])
+    house_proportions /= house_proportions.sum()
+    demand_ranges = np.array([HOUSE_TYPE_DATA[ht]["demand_range"] for ht in house_types])
+
+    # House types and yearly demands
+    selected = rng.choice(len(house_types), size=n, p=house_proportions)
+    yearly_demand = rng.integers(demand_ranges[selected, 0], demand_ranges[selected, 1] + 1)
+
+    # Solar panels, as in calculate_solar_panels
+    has_panels = rng.random(n) >= zero_panel_prob
+    noise_factor = rng.uniform(1 - noise_level, 1 + noise_level, n)
+    n_panels = np.where(has_panels, np.round(yearly_demand / round(365 * panel_production) * noise_factor), 0)
+
+    return ProsumerPopulation(
+        n_panels=n_panels,
+        base_energy_demand=yearly_demand / 365,
+        sell_price=rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01, n),
+        sensitivity=rng.uniform(sens_range[0], sens_range[1], n),
+        house_type=[house_types[i] for i in selected.tolist()]
+    )
+
+# Get a population of a run
+def get_population(n, sens_range, panel_production, seed, noise_level=0.2, zero_panel_prob=0.25, cache_dir=None,
+                   entropy=None):
+    """
+    Get the population of a run from generate_population, drawn from its own stream of the seed of the run. With a
+    cache folder the population is saved under its parameters and seed, so later simulations with the same
+    parameters and seed (e.g. the other mode of a simulation with the same master seed) load it instead of
+    generating it again.
+    :param n: number of agents
+    :param sens_range: sensitivity range for the agents
+    :param panel_production: production of the solar panels
+    :param seed: the seed sequence of the run
+    :param noise_level: the noise level for the solar panels
+    :param zero_panel_prob: the probability of having 0 solar panels
+    :param cache_dir: folder of the saved populations (None to always generate them)
+    :param entropy: the entropy of the population stream instead of that of the seed of the run, so simulations
+                    with different seeds share their populations, e.g. the modes of a sweep (see population_entropy
+                    in sweep.py)
+    """
+    entropy = seed.entropy if entropy is None else entropy
+    population_seed = np.random.SeedSequence(entropy, spawn_key=seed.spawn_key + (POPULATION_STREAM,))
+
+    cache_file = None
+    if cache_dir is not None:
+        import hashlib
+        import json
+
+        key = json.dumps([n, list(sens_range), panel_production, noise_level, zero_panel_prob, str(entropy), list(seed.spawn_key)])
+        cache_file = os.path.join(cache_dir, f"population_{n}_{hashlib.sha256(key.encode()).hexdigest()[:16]}.npz")
+        if os.path.exists(cache_file):
+            return ProsumerPopulation.load(cache_file)
+
+    population = generate_population(n, sens_range, panel_production, noise_level, zero_panel_prob,
+                                     np.random.default_rng(population_seed))
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        population.save(cache_file)
+    return population
+
+# Create the agents of a run
+def create_agents(n_agents, verbose, sens_range, panel_prod, engine, rng, seed, population=None):
+    """
+    Create the agents of a run, returns the list of ProsumerAgents (None for a bulk population of the vectorized
+    engine) and the ProsumerPopulation (None for the object engine)
+    :param n_agents: the number of agents
+    :param verbose: print additional information
+    :param sens_range: sensitivity range for the agents
+    :param panel_prod: production of the solar panels
+    :param engine: the prosumer engine ('object' or 'vectorized')
+    :param rng: the random number generator of the run, used by generate_agents
+    :param seed: the seed sequence of the run, used by get_population
+    :param population: options of get_population, e.g. {'noise_level': 0.2, 'cache_dir': '../data/populations'}
+                       (None for generate_agents)
+    """
+    if population is None:
+        agent_list = generate_agents(n_agents, verbose, sens_range, panel_prod, rng)
+        if engine == 'vectorized':
+            return agent_list, ProsumerPopulation.from_agents(agent_list)
+        return agent_list, None
+
+    prosumers = get_population(n_agents, sens_range, panel_prod, seed, **population)
+    if engine == 'vectorized':
+        return None, prosumers
+    return prosumers.to_agents(), None
+
 # Calculate the number of solar panels for each house
-def calculate_solar_panels(annual_energy_demand, noise_level=0.2, zero_panel_prob=0.25, panel_production=1):
+def calculate_solar_panels(annual_energy_demand, noise_level=0.2, zero_panel_prob=0.25, panel_production=1, rng=None):
     """
     Caclulate the number of solar panels for each house
     :param annual_energy_demand: the annual energy demand of the house
     :param noise_level: the noise level for the solar panels
     :param zero_panel_prob: the probability of having 0 solar panels
     :param panel_production: the production of the solar panels
+    :param rng: the random number generator of the run
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     # Check if the house gets 0 solar panels
-    if np.random.rand() < zero_panel_prob:
+    if rng.random() < zero_panel_prob:
         return 0
 
     # Solar panel production: 2 kWh per day, 365 days per year = 730 kWh/year per panel
@@ -123,282 +288,813 @@ def calculate_solar_panels(annual_energy_demand, noise_level=0.2, zero_panel_pro
     optimal_panels = annual_energy_demand / panel_production
 
     # Introduce variability (better or worse setups)
-    noise_factor = np.random.uniform(1 - noise_level, 1 + noise_level) 
+    noise_factor = rng.uniform(1 - noise_level, 1 + noise_level) 
     actual_panels = optimal_panels * noise_factor
 
     # Return the final number of panels
     return round(actual_panels)
 
-# Run the simulation
-def simulation(mode = 'distributed', n_agents = 200, n_runs = 10, t_max = 1000, verbose = False, sens_range = [0.005,0.02], panel_prod = 1):
+# Scenario of a paired run
+class Scenario():
+
+    # Draw the scenario of a run
+    def __init__(self, n_agents, t_max, verbose, sens_range, panel_prod, engine, seed, interval=None, population=None):
+        """
+        The agents and all noise of a run drawn in bulk, so that paired runs of different modes simulate the same
+        households, weather and demand. Matching draws its random numbers from a separate generator, the same for
+        every mode.
+        :param n_agents: the number of agents
+        :param t_max: the maximum number of timesteps
+        :param verbose: print additional information
+        :param sens_range: sensitivity range for the agents
+        :param panel_prod: production of the solar panels
+        :param engine: the prosumer engine ('object' or 'vectorized')
+        :param seed: the seed sequence of the run
+        :param interval: the number of hours per timestep (None for one timestep per day)
+        :param population: options of get_population (None for generate_agents)
+        """
+        scenario_seed, self.market_seed = seed.spawn(2)
+        rng = np.random.default_rng(scenario_seed)
+
+        self.t_max = t_max
+        self.agent_list, self.population = create_agents(n_agents, verbose, sens_range, panel_prod, engine, rng,
+                                                         scenario_seed, population)
+        self.avg_price = round(rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01), 2)
+
+        # Weather noise of every day (the interval mode follows the production data) and demand noise of every
+        # timestep and agent
+        self.weather_noise = rng.uniform(-0.1, 0.1, t_max) if interval is None else None
+        self.demand_noise = rng.normal(loc=0, scale=0.02, size=(t_max, n_agents))
+
+# State of a single run
+class RunState():
+
+    # Initialize a run at day 0
+    def __init__(self, run, mode, n_agents, t_max, verbose, sens_range, panel_prod, engine, percentage_diff, seed,
+                 n_zones=1, n_threads=1, interval=None, instrument=NULL_INSTRUMENTATION, journal=NULL_JOURNAL,
+                 scenario=None, population=None):
+        """
+        :param run: the index of the run
+        :param mode: the mode of the simulation ('centralised' or 'distributed')
+        :param n_agents: the number of agents
+        :param t_max: the maximum number of timesteps
+        :param verbose: print additional information
+        :param sens_range: sensitivity range for the agents
+        :param panel_prod: production of the solar panels
+        :param engine: the prosumer engine ('object' or 'vectorized')
+        :param percentage_diff: percentage difference between summer and winter energy production
+        :param seed: the seed sequence of this run
+        :param n_zones: the number of neighbourhood zones with their own market (vectorized engine only)
+        :param n_threads: the number of threads clearing the zones
+        :param interval: the number of hours per timestep, driven by the production data (None for one timestep per
+                         day with the seasonal production model)
+        :param instrument: the instrumentation of the run
+        :param journal: the event journal of the run
+        :param scenario: the pre-drawn Scenario of a paired run (None to draw the agents and noise as the run goes)
+        :param population: options of get_population, e.g. {'cache_dir': '../data/populations'} (None for
+                           generate_agents with the generator of the run)
+        """
+        self.run = run
+        self.mode = mode
+        self.n_agents = n_agents
+        self.t_max = t_max
+        self.verbose = verbose
+        self.sens_range = sens_range
+        self.panel_prod = panel_prod
+        self.engine = engine
+        self.percentage_diff = percentage_diff
+        self.instrument = instrument
+        self.journal = journal
+        self.interval = interval
+        self.scenario = scenario
+        self.day = 0
+        self.stopped = False
+        self.results = np.empty((t_max, len(METRICS)))
+        self.lookup_intervals()
+
+        # Every run draws all its randomness from its own generator, a paired run only its matching
+        self.rng = np.random.default_rng(seed if scenario is None else scenario.market_seed)
+
+        # Create central agent
+        self.central_agent = CentralAgent(0, CENTRAL_SELL_PRICE, CENTRAL_BUY_PRICE)
+        self.clearing_engine = ClearingEngine(self.central_agent, mode, instrument, journal)
+
+        # Create agents
+        instrument.start('generate')
+        # The vectorized engine advances all agents at once using arrays
+        if scenario is None:
+            self.agent_list, self.population = create_agents(n_agents, verbose, sens_range, panel_prod, engine,
+                                                             self.rng, seed, population)
+        else:
+            import copy
+
+            self.agent_list, self.population = copy.deepcopy((scenario.agent_list, scenario.population))
+
+        if self.population is not None:
+            self.population.set_zones(n_zones, n_threads)
+        elif n_zones > 1:
+            raise ValueError("Zones are only supported by the vectorized engine")
+        instrument.stop('generate')
+
+        # Set starting random avg price between 0.08 - 0.23 for for run
+        if scenario is None:
+            self.avg_price = round(self.rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01), 2)
+        else:
+            self.avg_price = scenario.avg_price
+
+    # The instrumentation and the journal belong to the process, not to the saved state
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['instrument'], state['journal']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach(NULL_INSTRUMENTATION, NULL_JOURNAL)
+
+    # Method to set the instrumentation and the journal
+    def attach(self, instrument, journal):
+        self.instrument = instrument
+        self.journal = journal
+        self.clearing_engine.instrument = instrument
+        self.clearing_engine.journal = journal
+
+    # Method to look up the energy levels of all intervals of the run
+    def lookup_intervals(self):
+        self.energy_levels = None
+        self.demand_shares = None
+        if self.interval is not None:
+            self.energy_levels, self.demand_shares = interval_levels(self.t_max, self.interval)
+
+    # Method to check whether the run is complete, or stopped early in steady state
+    def done(self):
+        return self.stopped or self.day >= self.t_max
+
+    # Method to get the balance of every agent
+    def agent_balances(self):
+        if self.population is not None:
+            return self.population.balance
+        return np.array([agent.balance for agent in self.agent_list])
+
+    # Method to get the mean sell price of the agents
+    def mean_sell_price(self):
+        if self.population is not None:
+            return self.population.sell_price.mean()
+        return sum(agent.sell_price for agent in self.agent_list) / len(self.agent_list)
+
+    # Method to continue the state as a different scenario
+    def fork(self, mode=None, t_max=None, seed=None):
+        """
+        Return a copy of the state to continue with another mode, horizon or random numbers. Without a seed the
+        copy draws the same random numbers as the original would, so scenarios only differ by their parameters.
+        :param mode: the mode of the simulation from the current day on (None to keep it)
+        :param t_max: the new maximum number of timesteps, at least the current day (None to keep it)
+        :param seed: seed of a new random number generator (None to keep the state of the generator)
+        """
+        import pickle
+
+        state = pickle.loads(pickle.dumps(self))
+
+        # A run that stopped in steady state continues in another scenario, it is complete in the same one
+        if (mode is not None and mode != state.mode) or (t_max is not None and t_max != state.t_max):
+            state.stopped = False
+
+        if mode is not None:
+            state.mode = mode
+            state.clearing_engine.mode = mode
+
+        if t_max is not None and t_max != state.t_max:
+            if t_max < state.day:
+                raise ValueError(f"Cannot fork at day {state.day} with t_max {t_max}")
+            if state.scenario is not None and t_max > state.scenario.t_max:
+                raise ValueError(f"Cannot extend a paired run beyond its scenario of {state.scenario.t_max} timesteps")
+            results = np.empty((t_max, len(METRICS)))
+            results[:state.day] = state.results[:state.day]
+            state.results = results
+            state.t_max = t_max
+            state.lookup_intervals()
+
+        if seed is not None:
+            state.rng = np.random.default_rng(seed)
+
+        return state
+
+    # Method to simulate the next day
+    def step(self):
+        """
+        Simulate the next day (or interval) and store its metrics in the results
+        """
+        day = self.day
+        rng = self.rng
+        instrument = self.instrument
+        journal = self.journal
+        agent_list = self.agent_list
+        central_agent = self.central_agent
+        avg_price = self.avg_price
+
+        if day % 100 == 0 and self.verbose:
+            print('Day: ', day)
+
+        # Reset order lists
+        buy_order_list = []
+        sell_order_list = []
+
+        # Noise of a paired run comes from its scenario
+        weather_noise = demand_noise = None
+        if self.scenario is not None:
+            demand_noise = self.scenario.demand_noise[day]
+            if self.interval is None:
+                weather_noise = self.scenario.weather_noise[day]
+
+        # Determine energy level for day, or look it up for the interval
+        instrument.start('energy')
+        if self.interval is None:
+            calendar_day = day
+            demand_share = 1
+            energy_today = daily_energy_level(day, self.percentage_diff, self.verbose, rng, weather_noise)
+        else:
+            calendar_day = day * self.interval // 24
+            demand_share = self.demand_shares[day]
+            energy_today = self.energy_levels[day]
+        instrument.stop('energy')
+        instrument.count('days')
+        journal.start_day(day)
+        journal.record(DAY, CENTRAL, CENTRAL, energy_today, avg_price)
+
+        if self.engine == 'vectorized':
+            total_demand, central_energy_sold, total_produced, avg_price, avg_balance = self.population.step(
+                calendar_day, energy_today, avg_price, central_agent, self.mode, rng, instrument, journal, demand_share,
+                demand_noise
+            )
+        else:
+            # Update agent energy based on energy level of the day (energy_today)
+            instrument.start('update')
+            if demand_noise is None:
+                for curr_agent in agent_list:
+                    curr_agent.update(energy_today, avg_price, calendar_day, rng, demand_share)
+            else:
+                for curr_agent, noise in zip(agent_list, demand_noise):
+                    curr_agent.update(energy_today, avg_price, calendar_day, rng, demand_share, noise)
+            instrument.stop('update')
+
+            # Determine total demand and produced energy
+            total_demand = sum([agent.energy_demand for agent in agent_list])
+            total_produced = sum([agent.energy_production for agent in agent_list])
+
+            # Create orders
+            instrument.start('orders')
+            for curr_agent in agent_list:
+                order = curr_agent.create_order()
+                if order is not None:
+                    if order.type == OrderType.BUY:
+                        buy_order_list.append(order)
+                    else:
+                        sell_order_list.append(order)
+            instrument.stop('orders')
+            instrument.count('buy orders', len(buy_order_list))
+            instrument.count('sell orders', len(sell_order_list))
+
+            # Record the orders of the day
+            if journal.wants(BUY_ORDER) or journal.wants(SELL_ORDER):
+                for order in buy_order_list:
+                    journal.record(BUY_ORDER, order.agent_id, CENTRAL, order.amount, order.price)
+                for order in sell_order_list:
+                    journal.record(SELL_ORDER, order.agent_id, CENTRAL, order.amount, order.price)
+
+            # Shuffle buy order list so order of agents purchasing energy is random.
+            rng.shuffle(buy_order_list)
+
+            # Match the orders, sorted by price (low to high), and settle the rest with the central agent
+            central_energy_sold, avg_price = self.clearing_engine.clear(agent_list, buy_order_list, sell_order_list)
+
+            # Calculate the average balance of all agents
+            avg_balance = sum(agent.balance for agent in agent_list) / self.n_agents
+
+            # Check if each agent is satisfied
+            if journal.wants(UNSATISFIED):
+                for agent in agent_list:
+                    if round(agent.energy_production, 5) < round(agent.energy_demand, 5):
+                        journal.record(UNSATISFIED, agent.id, CENTRAL, agent.energy_demand - agent.energy_production)
+
+        # store timestep info
+        instrument.start('store')
+        self.results[day] = [avg_balance, total_demand, central_energy_sold, total_produced, avg_price]
+        instrument.stop('store')
+
+        self.avg_price = avg_price
+        self.day += 1
+
+# Simulate a centralised run in closed form
+def simulate_closed_form(n_agents, t_max, verbose, sens_range, panel_prod, percentage_diff, seed, interval=None,
+                         population=None, instrument=NULL_INSTRUMENTATION, snapshot_days=None):
     """
-    Run the simulation
-    :param mode: the mode of the simulation ('centralised' or 'distributed')
+    Simulate a run of the centralised mode with the closed-form engine: the agents are those of a RunState of the
+    vectorized engine with the same seed, but the weather and demand noise of all timesteps are drawn at once, so the
+    results equal those of the other engines in distribution, not draw for draw. Returns the results of the run and
+    the balances of the agents at the snapshot days (None without snapshot days).
     :param n_agents: the number of agents
-    :param n_runs: the number of runs
     :param t_max: the maximum number of timesteps
     :param verbose: print additional information
     :param sens_range: sensitivity range for the agents
     :param panel_prod: production of the solar panels
+    :param percentage_diff: percentage difference between summer and winter energy production
+    :param seed: the seed sequence of this run
+    :param interval: the number of hours per timestep (None for one timestep per day)
+    :param population: options of get_population (None for generate_agents)
+    :param instrument: the instrumentation of the run
+    :param snapshot_days: the timesteps to return the balances of the agents at (None for none)
     """
-    # Set random seed for reproducibility
-    #np.random.seed(0)
-
-    print("Now running the simulation in " + mode + " mode")
-
-    # open data file for storing results and write header
-    with open(f"../data/results_{mode}_sens{sens_range}_panel{panel_prod}.csv", 'w+', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            'run', 
-            'timestep', 
-            'average balance', 
-            'total energy demand', 
-            'total central energy bought', 
-            'total energy produced', 
-            'average price'
-        ])
-
-        for run in range(n_runs):
-
-            progressbar(run, n_runs)
-
-            _, _, percentage_diff = get_average_difference_in_seasons(2022)
-
-            agent_list = []
-            buy_order_list = []
-            sell_order_list = []
-
-            # Create central agent
-            central_agent = CentralAgent(0, CENTRAL_SELL_PRICE, CENTRAL_BUY_PRICE)
-
-            # Create agents
-            agent_list.extend(generate_agents(n_agents, verbose, sens_range, panel_prod))
-
-            # Set starting random avg price between 0.08 - 0.23 for for run
-            avg_price = round(uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01), 2)
-
+    rng = np.random.default_rng(seed)
+    central_agent = CentralAgent(0, CENTRAL_SELL_PRICE, CENTRAL_BUY_PRICE)
+
+    instrument.start('generate')
+    _, agents = create_agents(n_agents, verbose, sens_range, panel_prod, 'vectorized', rng, seed, population)
+    instrument.stop('generate')
+
+    # The starting average price is drawn like in a RunState, although no price depends on it in this mode
+    rng.uniform(CENTRAL_BUY_PRICE + 0.01, CENTRAL_SELL_PRICE - 0.01)
+
+    instrument.start('energy')
+    timesteps = np.arange(t_max)
+    if interval is None:
+        days = timesteps
+        demand_shares = np.ones(t_max)
+        energy_levels = daily_energy_level(timesteps, percentage_diff, verbose, rng, rng.uniform(-0.1, 0.1, size=t_max))
+    else:
+        days = timesteps * interval // 24
+        energy_levels, demand_shares = interval_levels(t_max, interval)
+    instrument.stop('energy')
+    instrument.count('days', t_max)
+
+    instrument.start('central')
+    results, balances = agents.simulate_centralised(days, energy_levels, demand_shares, central_agent, rng, snapshot_days)
+    instrument.stop('central')
+    return results, balances
+
+# Simulate a single run
+def simulate_run(run, mode, n_agents, t_max, verbose, sens_range, panel_prod, engine, percentage_diff, seed, *, profile=False,
+                 journal=None, checkpoint_every=None, checkpoint_file=None, start_file=None, reseed=False, n_zones=1,
+                 n_threads=1, interval=None, steady_state=None, population=None, telemetry=None, snapshots=None,
+                 scenario=None):
+    """
+    Simulate a single run and return the metrics of every timestep as an array of shape (t_max, number of metrics),
+    the profile of the run (an empty dictionary if profiling is disabled), the events of its journal and the
+    snapshots of the agent balances (None if snapshots are disabled). A run that
+    stops early in steady state has missing values (NaN) after its last timestep, except for the cumulative metrics,
+    which SteadyState.extend fills. For a list of modes the run draws
+    one Scenario, simulates it in every mode and returns a list with the outputs of every mode. The options after the
+    seed are keyword-only.
+    :param run: the index of the run
+    :param mode: the mode of the simulation ('centralised' or 'distributed'), or a list of paired modes
+    :param n_agents: the number of agents
+    :param t_max: the maximum number of timesteps
+    :param verbose: print additional information
+    :param sens_range: sensitivity range for the agents
+    :param panel_prod: production of the solar panels
+    :param engine: the prosumer engine ('object', 'vectorized' or 'closed-form' for centralised runs)
+    :param percentage_diff: percentage difference between summer and winter energy production
+    :param seed: the seed sequence of this run
+    :param profile: collect phase timings and event counters
+    :param journal: options of the EventJournal of the run, e.g. {'level': DEBUG, 'sample': 0.01} (None to disable)
+    :param checkpoint_every: save the state of the run every this many days and when it is complete (None to disable)
+    :param checkpoint_file: path of the checkpoint of the run
+    :param start_file: checkpoint to continue from instead of starting at day 0 (None to start a new run)
+    :param reseed: continue the checkpoint with the generator of this run instead of the saved one
+    :param n_zones: the number of neighbourhood zones with their own market (vectorized engine only)
+    :param n_threads: the number of threads clearing the zones
+    :param interval: the number of hours per timestep (None for one timestep per day)
+    :param steady_state: options of the SteadyState detection that stops the run early, e.g. {'window': 365,
+                         'tolerance': 0.001} (None to always simulate t_max timesteps)
+    :param population: options of get_population, e.g. {'cache_dir': '../data/populations'} (None for
+                       generate_agents with the generator of the run)
+    :param telemetry: options of the TelemetryPublisher of the run, e.g. {'address': ('127.0.0.1', 8765), 'every': 10}
+                      (None to disable)
+    :param snapshots: options of the snapshots of the agent balances, e.g. {'every': 30} for the balance of every
+                      agent every 30 days (and at the final day) or {'every': 30, 'quantiles': [0.05, 0.5, 0.95]}
+                      for quantiles of the balances only (None to disable)
+    :param scenario: the pre-drawn Scenario of the run (None to draw the agents and noise as the run goes)
+    """
+    if engine == 'closed-form':
+        if mode != 'centralised':
+            raise ValueError("The closed-form engine only simulates the centralised mode")
+        unsupported = [name for name, value in [('journal', journal), ('checkpoint_every', checkpoint_every),
+                                                ('start_file', start_file), ('steady_state', steady_state)]
+                       if value is not None]
+        if unsupported:
+            raise ValueError(f"Not supported by the closed-form engine: {unsupported}")
+
+        instrument = Instrumentation() if profile else NULL_INSTRUMENTATION
+        snapshot_days = output_layout(t_max, {'every': snapshots['every']})[0] if snapshots is not None else None
+        results, balances = simulate_closed_form(n_agents, t_max, verbose, sens_range, panel_prod, percentage_diff,
+                                                 seed, interval, population, instrument, snapshot_days)
+
+        if telemetry is not None:
+            publisher = TelemetryPublisher(run=run, mode=mode, n_agents=n_agents, **telemetry)
             for day in range(t_max):
+                publisher.publish(day, results[day])
+            publisher.close()
+        if balances is not None:
+            quantiles = snapshots.get('quantiles')
+            balances = (balances if quantiles is None else np.quantile(balances, quantiles, axis=1).T).astype(np.float32)
+        return results, instrument.summary(), NULL_JOURNAL.view(), balances
+
+    if not isinstance(mode, str):
+        scenario = Scenario(n_agents, t_max, verbose, sens_range, panel_prod, engine, seed, interval, population)
+        options = dict(profile=profile, journal=journal, checkpoint_every=checkpoint_every,
+                       checkpoint_file=checkpoint_file, start_file=start_file, reseed=reseed, n_zones=n_zones,
+                       n_threads=n_threads, interval=interval, steady_state=steady_state, population=population,
+                       telemetry=telemetry, snapshots=snapshots, scenario=scenario)
+        return [
+            simulate_run(run, variant, n_agents, t_max, verbose, sens_range, panel_prod, engine, percentage_diff, seed,
+                         **options)
+            for variant in mode
+        ]
+
+    instrument = Instrumentation() if profile else NULL_INSTRUMENTATION
+    journal = EventJournal(run, **journal) if journal is not None else NULL_JOURNAL
+
+    if start_file is not None:
+        state = load_checkpoint(start_file)
+        if (state.n_agents, state.engine, state.sens_range, state.panel_prod) != (n_agents, engine, sens_range, panel_prod):
+            raise ValueError(f"Checkpoint {start_file} was saved with different agents")
+        if state.interval != interval:
+            raise ValueError(f"Checkpoint {start_file} was saved with another interval")
+        state = state.fork(mode, t_max, seed if reseed else None)
+        state.attach(instrument, journal)
+        if state.population is not None:
+            state.population.set_zones(n_zones, n_threads)
+    else:
+        state = RunState(run, mode, n_agents, t_max, verbose, sens_range, panel_prod, engine, percentage_diff, seed,
+                         n_zones, n_threads, interval, instrument, journal, scenario, population)
+
+    detector = SteadyState(**steady_state) if steady_state is not None else None
+    publisher = TelemetryPublisher(run=run, mode=mode, n_agents=n_agents, **telemetry) if telemetry is not None else NULL_TELEMETRY
+
+    # Snapshots of the agent balances at the days of output_layout, as float32 to keep them compact
+    balances = None
+    if snapshots is not None:
+        snapshot_days = output_layout(t_max, {'every': snapshots['every']})[0]
+        quantiles = snapshots.get('quantiles')
+        balances = np.full((len(snapshot_days), n_agents if quantiles is None else len(quantiles)), np.nan, dtype=np.float32)
+        n_snapshots = np.searchsorted(snapshot_days, state.day)
+
+    while not state.done():
+        state.step()
+        publisher.publish(state.day - 1, state.results[state.day - 1])
+
+        if balances is not None and n_snapshots < len(snapshot_days) and snapshot_days[n_snapshots] == state.day - 1:
+            agent_balances = state.agent_balances()
+            balances[n_snapshots] = agent_balances if quantiles is None else np.quantile(agent_balances, quantiles)
+            n_snapshots += 1
+
+        if detector is not None and detector.update(state.avg_price, state.mean_sell_price()):
+            state.stopped = True
+            state.results[state.day:] = np.nan
+            for metric in CUMULATIVE_METRICS:
+                detector.extend(state.results[:, METRICS.index(metric)], state.day)
+
+        if checkpoint_every and (state.day % checkpoint_every == 0 or state.done()):
+            instrument.start('store')
+            save_checkpoint(state, checkpoint_file)
+            instrument.stop('store')
+
+    publisher.close()
+    return state.results, instrument.summary(), journal.view(), balances
+
+# Collect the profile of a run
+def collect_profile(profiles, run, run_profile, profile_callback=None):
+    """
+    Add the profile of a finished run to the list of profiles and pass it to the callback
+    :param profiles: the profiles of the previous runs
+    :param run: the index of the run
+    :param run_profile: the profile of the run (empty if profiling is disabled)
+    :param profile_callback: function called with the run index and the profile
+    """
+    if not run_profile:
+        return
+    profiles.append(run_profile)
+    if profile_callback is not None:
+        profile_callback(run, run_profile)
+
+# Simulate runs in order
+def iterate_runs(run_args, n_workers=1):
+    """
+    Yield the outputs of simulate_run for the arguments of every run, in run order. Worker processes only simulate a
+    few runs ahead, so closing the generator stops the simulation of the remaining runs.
+    :param run_args: the keyword arguments of simulate_run of every run
+    :param n_workers: the number of worker processes
+    """
+    if n_workers <= 1:
+        for kwargs in run_args:
+            yield simulate_run(**kwargs)
+        return
+
+    # Results are collected in run order, while the workers already simulate the next runs
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        next_run = 0
+        try:
+            while pending or next_run < len(run_args):
+                while next_run < len(run_args) and len(pending) < 2 * n_workers:
+                    pending.append(executor.submit(simulate_run, **run_args[next_run]))
+                    next_run += 1
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
-                if day % 100 == 0 and verbose:
-                    print('Day: ', day)
-
-                # Reset order lists
-                buy_order_list = []
-                sell_order_list = []
-
-                # Determine energy level for day
-                energy_today = daily_energy_level(day, percentage_diff, verbose)
-
-                if verbose:
-                    print("Energy Today: ", energy_today)
-
-                # Update agent energy based on energy level of the day (energy_today)
-                for curr_agent in agent_list:
-                    curr_agent.update(energy_today, avg_price, day)
-
-
-                # Determine total demand and produced energy
-                total_demand = sum([agent.energy_demand for agent in agent_list])
-                total_produced = sum([agent.energy_production for agent in agent_list])
-
-                # Create orders
-                for curr_agent in agent_list:
-                    order = curr_agent.create_order()
-                    if order is not None:
-                        if order.type == OrderType.BUY:
-                            buy_order_list.append(order)
-                        else:
-                            sell_order_list.append(order)
-
-                # Print info
-                if verbose:
-                    print('Day: ', day)
-                    print('Energy today: ', energy_today)
-                    print('')
-                    for agent in agent_list:
-                        print('Agent id: ', agent.id, ' Energy Production: ', agent.energy_production, ' Energy Demand: ', agent.energy_demand)
-                    print('')
-                    print('Buy orders: ')
-                    for order in buy_order_list:
-                        print('Agent id: ', order.agent_id, ' Amount: ', order.amount)
-                    print('Sell orders: ')
-                    for order in sell_order_list:
-                        print('Agent id: ', order.agent_id, ' Amount: ', order.amount, ' Price: ', order.price)
-                    print('')
-                    print('total energy produced: ', sum([agent.energy_production for agent in agent_list]))
-                    print('total energy demand: ', sum([agent.energy_demand for agent in agent_list]))
-
-                # Sort orders by price (low to high))
-                sell_order_list = sorted(sell_order_list, key=lambda x: x.price)
-
-                # Create sales tracking variables
-                sold_amount_list = []
-                sold_price_list = []
-                central_energy_sold = 0
-                
-                # Shuffle buy order list so order of agents purchasing energy is random.
-                shuffle(buy_order_list)
-
-                # First, process agent-to-agent orders
-                for buy_order in buy_order_list:
-
-                    # Loop till order is fulfilled
-                    while buy_order.type != OrderType.DONE:
-
-                        # Only process agent-to-agent order if mode is 'distributed'
-                        if mode == 'distributed':
-                            for sell_order in sell_order_list:
-
-                                # If agent sell price is higher than the central agent sell price (0.24), cancel agent-to-agent orders.
-                                # if sell_order_list[0].price > central_agent.sell_price:
-                                #     break
-
-                                # Fulfill the entire buy order if possible
-                                if sell_order.amount >= buy_order.amount and sell_order.price <= central_agent.sell_price:
-                                    buyer = agent_list[buy_order.agent_id]
-                                    seller = agent_list[sell_order.agent_id]
-
-                                    seller.total_sold_energy_list.append(buy_order.amount)
-                                    seller.total_sold_energy_price_list.append(sell_order.price)
-
-                                    # Transfer energy from seller to buyer
-                                    buyer.set_own_energy(buy_order.amount)
-                                    seller.set_own_energy(-buy_order.amount)
-
-                                    # Update balances
-                                    buyer.balance -= buy_order.amount * sell_order.price
-                                    seller.balance += buy_order.amount * sell_order.price
-
-                                    sold_amount_list.append(buy_order.amount)
-                                    sold_price_list.append(sell_order.price)
-
-                                    # Mark orders as done
-                                    sell_order.amount -= buy_order.amount
-                                    buyer.energy_bought += buy_order.amount
-                                    buy_order.amount = 0
-                                    buy_order.type = OrderType.DONE
-
-                                    if sell_order.price > central_agent.sell_price:
-                                        print(f"Agent {sell_order.agent_id} sold energy at higher price than central agent: {sell_order.price} €/kWh")
-
-                                    if verbose:
-                                        print(f"Matched order: Buyer {buy_order.agent_id}, Seller {sell_order.agent_id}, Amount {buy_order.amount}, Price {buy_order.price}")
-
-                                    break  # Fully fulfilled, move to next buy_order
-
-                                # If sell order can't fully fulfill the buy order, partially fulfill it
-                                elif sell_order.amount < buy_order.amount and sell_order.price <= central_agent.sell_price:
-                                    buyer = agent_list[buy_order.agent_id]
-                                    seller = agent_list[sell_order.agent_id]
-
-                                    seller.total_sold_energy_list.append(sell_order.amount)
-                                    seller.total_sold_energy_price_list.append(sell_order.price)
-
-                                    # Transfer partial energy from seller to buyer
-                                    buyer.set_own_energy(sell_order.amount)
-                                    seller.set_own_energy(-sell_order.amount)
-
-                                    # Update balances
-                                    buyer.balance -= sell_order.amount * sell_order.price
-                                    seller.balance += sell_order.amount * sell_order.price
-
-                                    sold_amount_list.append(sell_order.amount)
-                                    sold_price_list.append(sell_order.price)
-
-                                    # Adjust the amounts left in both orders
-                                    buy_order.amount -= sell_order.amount
-                                    buyer.energy_bought += sell_order.amount
-                                    sell_order.amount = 0
-                                    sell_order.type = OrderType.DONE
-
-                                    if verbose:
-                                        print(f"Partial match: Buyer {buy_order.agent_id}, Seller {sell_order.agent_id}, Amount {sell_order.amount}, Price {sell_order.price}")
-
-                                    # Continue looping through other sell orders to fulfill the rest of the buy order
-
-
-                        buyer = agent_list[buy_order.agent_id]
-
-                        # The central agent sells energy at fixed prices (0.24)
-                        if buy_order.amount > 0:  # Agent needs to buy energy from central
-    
-                            buyer.set_own_energy(buy_order.amount)
-                            central_agent.energy_sold += buy_order.amount
-
-                            # Adjust balances
-                            buyer.balance -= buy_order.amount * central_agent.sell_price
-                            central_agent.balance += buy_order.amount * central_agent.sell_price
-
-                            sold_amount_list.append(buy_order.amount)
-                            sold_price_list.append(central_agent.sell_price)
-
-                            central_energy_sold += buy_order.amount
-
-                            if verbose:
-                                print(f"Central agent fulfilled {buy_order.amount} kWh for Buyer {buy_order.agent_id} at {central_agent.sell_price} €/kWh")
-                            
-                            # Mark buy order as done
-                            buy_order.amount -= buy_order.amount
-                            buyer.energy_bought += buy_order.amount
-                            if buy_order.amount == 0:
-                                buy_order.type = OrderType.DONE
-                
-                # The central agent buys energy at fixed prices (0.07)
-                for sell_order in sell_order_list:
-                    if sell_order.amount > 0:
-                        
-                        seller = agent_list[sell_order.agent_id]
-
-                        seller.total_sold_energy_list.append(sell_order.amount)
-                        seller.total_sold_energy_price_list.append(sell_order.price)
-
-                        seller.set_own_energy(-sell_order.amount)
-                        central_agent.energy_bought += sell_order.amount
-
-                        # Adjust balances
-                        seller.balance += sell_order.amount * central_agent.buy_price
-                        central_agent.balance -= sell_order.amount * central_agent.buy_price
+# Run the simulation
+def simulation(mode = 'distributed', n_agents = 200, n_runs = 10, t_max = 1000, verbose = False, sens_range = [0.005,0.02], panel_prod = 1, engine = 'object', seed = None, n_workers = 1, out_file = None, show_progress = True, out_format = 'npz', summary = True, quantiles = None, profile = False, profile_callback = None, journal = None, checkpoint_every = None, checkpoint_dir = None, resume = False, warm_start = None, reseed = False, n_zones = 1, n_threads = 1, interval = None, target_ci = None, min_runs = 10, steady_state = None, population = None, telemetry = None, output = None, snapshots = None):
+    """
+    Run the simulation, returns the path of the results file (a list of paths for paired modes)
+    :param mode: the mode of the simulation ('centralised' or 'distributed'), or a list of modes that are paired: every
+                 run draws its agents and noise once and simulates every mode on them (common random numbers), so
+                 the modes differ only by their market
+    :param n_agents: the number of agents
+    :param n_runs: the number of runs (the maximum number of runs with a target_ci)
+    :param t_max: the maximum number of timesteps
+    :param verbose: print additional information
+    :param sens_range: sensitivity range for the agents
+    :param panel_prod: production of the solar panels
+    :param engine: the prosumer engine ('object' for one ProsumerAgent per household, 'vectorized' for a ProsumerPopulation,
+                   'closed-form' to compute a centralised run as a whole, equal in distribution to the other engines)
+    :param seed: master seed of the simulation, every run gets its own generator derived from it (None for a random seed)
+    :param n_workers: the number of worker processes running the runs in parallel
+    :param out_file: path of the results file, a list of paths for paired modes (None for the default names in the
+                     data folder)
+    :param show_progress: print the mode and a progress bar
+    :param out_format: the format of the results file ('npz', 'npy', 'parquet' or 'csv')
+    :param summary: write a per-timestep summary over the runs (mean, std, confidence interval, min, max) next to the results
+    :param quantiles: quantiles to add to the summary, e.g. [0.05, 0.5, 0.95]
+    :param profile: collect phase timings and event counters of every run and write them to a profile table next to
+                    the results
+    :param profile_callback: function called with the run index and the profile of every finished run
+    :param journal: options of the event journal of every run, e.g. {'level': DEBUG, 'sample': 0.01}, the events of
+                    all runs are written to a journal file next to the results (None to disable)
+    :param checkpoint_every: save the state of every run every this many days and when it is complete (None to disable)
+    :param checkpoint_dir: the folder of the checkpoints (None for a folder next to the results)
+    :param resume: continue every run from its checkpoint in checkpoint_dir, if there is one
+    :param warm_start: folder of the checkpoints of another simulation to continue every run from, e.g. to fork
+                       scenarios with another mode or horizon from the same warmed up state
+    :param reseed: continue the warm started runs with new random numbers derived from the seed
+    :param n_zones: the number of neighbourhood zones, every zone clears its own market before the residual orders
+                    are matched between the zones (vectorized engine only)
+    :param n_threads: the number of threads per run clearing the zones concurrently
+    :param interval: the number of hours per timestep (a divisor of 24), production then follows the hourly data from
+                     the start of the data year and demand follows the HOURLY_DEMAND_PROFILE; t_max counts intervals
+                     (None for one timestep per day with the seasonal production model)
+    :param target_ci: maximum half-width of the 95% confidence interval of the final value of metrics over the runs,
+                      e.g. {'average balance': 50, 'green energy share': 0.01}; runs are added until every interval
+                      is narrower or n_runs is reached (None to always simulate n_runs runs)
+    :param min_runs: the minimum number of runs with a target_ci
+    :param steady_state: options of the SteadyState detection that stops a run early when the yearly averages of the
+                         average price and the sell prices no longer change, e.g. {'window': 365, 'tolerance': 0.001};
+                         the results of the remaining timesteps of the run are missing, except for the cumulative
+                         average balance, which is extended with the change of the last window so its final value
+                         is comparable to runs that did not stop (None to disable)
+    :param population: options of the bulk population factory get_population, e.g. {'noise_level': 0.2,
+                       'cache_dir': '../data/populations'}; the populations are drawn in arrays with explicit panel
+                       production and noise level and saved in the cache folder, keyed by their parameters and seed,
+                       for later simulations and sweeps (None for generate_agents, which passes the panel production
+                       as the noise level of the panels)
+    :param telemetry: stream the metrics of every run while it runs, e.g. {'port': 8765, 'every': 10} starts a
+                      TelemetryServer for the duration of the simulation, {'address': ('127.0.0.1', 8765)} publishes
+                      to a running one (None to disable)
+    :param output: the granularity of the results files, {'every': k} for every k-th timestep, {'window': w,
+                   'stats': ['mean', 'min', 'max', 'std']} for statistics of windows of w timesteps or {'final': True}
+                   for the final state only (None for every timestep), see output_layout; the metadata lists the
+                   timesteps of the rows
+    :param snapshots: write snapshots of the agent balances of every run to a snapshot file next to the results,
+                      e.g. {'every': 30} for every agent or {'every': 30, 'quantiles': [0.05, 0.5, 0.95]} for the
+                      quantiles of the balances (None to disable)
+    """
+    # A list of modes runs every mode on the same scenarios, with one results file per mode
+    paired = not isinstance(mode, str)
+    modes = list(mode) if paired else [mode]
+
+    if out_file is None:
+        out_file = [f"../data/{result_name(m, sens_range, panel_prod)}.{out_format}" for m in modes]
+    out_files = list(out_file) if paired else [out_file]
+    if len(out_files) != len(modes):
+        raise ValueError(f"Got {len(out_files)} results files for {len(modes)} modes")
+
+    if n_zones > 1 and engine != 'vectorized':
+        raise ValueError("Zones are only supported by the vectorized engine")
+    if engine == 'closed-form' and mode != 'centralised':
+        raise ValueError("The closed-form engine only simulates the centralised mode")
+
+    if paired and (checkpoint_every or resume or warm_start is not None):
+        raise ValueError("Checkpoints are not supported for paired modes")
+
+    if target_ci is not None:
+        unknown = [metric for metric in target_ci if metric not in METRICS + ['green energy share']]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown} in target_ci")
+
+    if show_progress:
+        print("Now running the simulation in " + " and ".join(modes) + " mode")
+
+    # Derive one independent seed per run from the master seed, so the results do not depend on the number of workers
+    seed_sequence = np.random.SeedSequence(seed)
+    run_seeds = seed_sequence.spawn(n_runs)
+
+    _, _, percentage_diff = get_average_difference_in_seasons(DATA_YEAR)
+
+    # Parse and cache the production series once, the runs memory-map it
+    if interval is not None:
+        get_production_series(interval)
+
+    if checkpoint_dir is None and (checkpoint_every or resume):
+        checkpoint_dir = os.path.splitext(out_files[0])[0] + '_checkpoints'
+
+    # Runs publish to a running telemetry server, or to one of this simulation
+    server = None
+    if telemetry is not None:
+        telemetry = dict(telemetry)
+        if 'address' not in telemetry:
+            server = TelemetryServer(port=telemetry.pop('port', PORT)).start()
+            telemetry['address'] = server.address
+        telemetry.setdefault('config', os.path.splitext(os.path.basename(out_files[0]))[0])
+
+    run_args = []
+    for run in range(n_runs):
+        checkpoint_file = checkpoint_path(checkpoint_dir, run) if checkpoint_dir is not None else None
+
+        # Runs continue from the checkpoints of another simulation, or from their own after an interruption
+        start_file = None
+        if warm_start is not None:
+            start_file = checkpoint_path(warm_start, run)
+        elif resume and os.path.exists(checkpoint_file):
+            start_file = checkpoint_file
+
+        run_args.append(dict(
+            run=run, mode=mode, n_agents=n_agents, t_max=t_max, verbose=verbose, sens_range=sens_range,
+            panel_prod=panel_prod, engine=engine, percentage_diff=percentage_diff, seed=run_seeds[run], profile=profile,
+            journal=journal, checkpoint_every=checkpoint_every, checkpoint_file=checkpoint_file, start_file=start_file,
+            reseed=reseed, n_zones=n_zones, n_threads=n_threads, interval=interval, steady_state=steady_state,
+            population=population, telemetry=telemetry, snapshots=snapshots
+        ))
+    if journal is not None:
+        journal_writers = [JournalWriter(os.path.splitext(path)[0] + '_journal.bin') for path in out_files]
+
+    # Runs are reduced to the rows and columns of the output granularity as they come in
+    timesteps, columns = output_layout(t_max, output)
+
+    # Buffer the results of all runs and write them in bulk when the simulation is complete
+    stores = [
+        ResultStore(path, n_runs, t_max, out_format=out_format, timesteps=timesteps if output is not None else None, columns=columns, metadata={
+            'mode': m,
+            'n_agents': n_agents,
+            'sens_range': sens_range,
+            'panel_prod': panel_prod,
+            'engine': engine,
+            'seed': seed_sequence.entropy,
+            'percentage_diff': percentage_diff,
+            'warm_start': warm_start,
+            'n_zones': n_zones,
+            'interval': interval,
+            'target_ci': target_ci,
+            'steady_state': steady_state,
+            'paired_modes': modes if paired else None,
+            'population': population,
+            'output': output
+        })
+        for m, path in zip(modes, out_files)
+    ]
+
+    # Cross-run statistics are updated as the runs come in
+    stats = [RunningStats((len(timesteps), len(columns)), quantiles) for _ in modes]
+    profiles = [[] for _ in modes]
+
+    if snapshots is not None:
+        snapshot_days = output_layout(t_max, {'every': snapshots['every']})[0]
+        agent_snapshots = [[] for _ in modes]
+
+    # The confidence intervals of the target metrics decide the number of runs, for paired modes the intervals of the
+    # differences between every mode and the first mode
+    if target_ci is not None:
+        targets = list(target_ci)
+        target_widths = np.tile([target_ci[metric] for metric in targets], max(len(modes) - 1, 1))
+        target_stats = RunningStats(target_widths.shape)
+
+    if show_progress:
+        progressbar(0, n_runs)
+
+    n_done = 0
+    n_steps = [[] for _ in modes]
+    runs = iterate_runs(run_args, n_workers)
+    for run, outputs in enumerate(runs):
+        if not paired:
+            outputs = [outputs]
+
+        for i, (results, run_profile, events, balances) in enumerate(outputs):
+            reduced = reduce_results(results, output)
+            stores[i].add_run(run, reduced)
+            stats[i].add(reduced)
+            if snapshots is not None:
+                agent_snapshots[i].append(balances)
+            collect_profile(profiles[i], run, run_profile, profile_callback)
+            if journal is not None:
+                journal_writers[i].add_run(events)
+            n_steps[i].append(simulated_steps(results))
+        n_done = run + 1
+        if show_progress:
+            progressbar(n_done, n_runs)
+
+        if target_ci is not None:
+            values = [run_values(results, targets) for results, *_ in outputs]
+            if len(values) > 1:
+                values = [variant - values[0] for variant in values[1:]]
+            target_stats.add(np.concatenate(values))
+            if n_done >= max(min_runs, 2) and np.all(target_stats.ci() <= target_widths):
+                break
+    runs.close()
+
+    if show_progress:
+        clear_progressbar()
 
-                        sold_amount_list.append(sell_order.amount)
-                        sold_price_list.append(central_agent.buy_price)
+    if server is not None:
+        server.stop()
 
-                        if verbose:
-                            print(f"Central agent fulfilled {sell_order.amount} kWh for Seller {sell_order.agent_id} at {central_agent.buy_price} €/kWh")
+    for i, path in enumerate(out_files):
+        if n_done < n_runs:
+            stores[i].truncate(n_done)
+        if steady_state is not None:
+            stores[i].metadata['n_steps'] = n_steps[i]
 
+        if summary:
+            write_summary(stats[i], columns, os.path.splitext(path)[0] + '_summary.csv', timesteps=timesteps)
 
-                # Calculate the weighted average price
-                total_amount_sold = sum(sold_amount_list)
-                avg_price = (
-                    sum(price * amount for price, amount in zip(sold_price_list, sold_amount_list)) / total_amount_sold
-                    if total_amount_sold > 0 else 0
-                )
+        if profile:
+            write_profile(profiles[i], os.path.splitext(path)[0] + '_profile.csv')
 
-                # Calculate the average balance of all agents
-                avg_balance = sum(agent.balance for agent in agent_list) / n_agents
+        if journal is not None:
+            journal_writers[i].flush()
 
-                # Check if each agent is satisfied
-                if verbose:
-                    for agent in agent_list:
-                        if round(agent.energy_production, 5) < round(agent.energy_demand, 5):
-                            print('Agent id: ', agent.id, ' not satisfied')
-                            print('Energy production: ', agent.energy_production, ' Energy demand: ', agent.energy_demand)
+        if snapshots is not None:
+            write_snapshots(os.path.splitext(path)[0] + '_snapshots.npz', snapshot_days, np.stack(agent_snapshots[i]),
+                            snapshots.get('quantiles'))
 
-                        else:
-                            print('Agent id: ', agent.id, ' satisfied')
+        stores[i].flush()
 
+    return out_files if paired else out_file
 
-                # write timestep info to csv
-                writer.writerow([run, day, avg_balance, total_demand, central_energy_sold, total_produced , avg_price])
-                
 
-        clear_progressbar()
+# Parse a sensitivity range argument
+def parse_sens_range(text):
+    """
+    Parse a sensitivity range given as 'low-high' on the command line, e.g. '0.005-0.02'
+    :param text: the argument
+    """
+    low, high = (float(value) for value in text.split('-'))
+    return [low, high]
 
 
 if __name__ == '__main__':
-    #grid search for sensitivity and panel production
-    for sens in [[0.005, 0.02], [0.01, 0.02], [0.05, 0.1]]:
-        for panel_prod in [0.1, 0.25, 0.5, 1]:
-            simulation('distributed', n_agents=200, n_runs=100, t_max=365*5, sens_range=sens, panel_prod=panel_prod)
-            quit()
-            simulation('centralised', n_agents=200, n_runs=100, t_max=365*5, sens_range=sens, panel_prod=panel_prod)
\ No newline at end of file
+    import argparse
+
+    from results import FORMATS
+
+    # Without arguments the full grid search for sensitivity and panel production is run
+    parser = argparse.ArgumentParser(description='Run the simulation for every combination of the given parameters')
+    parser.add_argument('--modes', nargs='+', default=['distributed', 'centralised'], choices=['distributed', 'centralised'])
+    parser.add_argument('--agents', type=int, nargs='+', default=[200], help='numbers of agents')
+    parser.add_argument('--runs', type=int, default=100, help='number of runs per configuration')
+    parser.add_argument('--t-max', type=int, default=365*5, help='number of timesteps')
+    parser.add_argument('--sens-ranges', type=parse_sens_range, nargs='+', default=[[0.005, 0.02], [0.01, 0.02], [0.05, 0.1]],
+                        help='sensitivity ranges of the agents, as low-high')
+    parser.add_argument('--panel-prods', type=float, nargs='+', default=[0.1, 0.25, 0.5, 1], help='production factors of the solar panels')
+    parser.add_argument('--seed', type=int, default=0, help='master seed')
+    parser.add_argument('--format', default='npz', choices=FORMATS, help='format of the results files')
+    parser.add_argument('--workers', type=int, default=None, help='configurations running at the same time (default: number of cores)')
+    parser.add_argument('--run-workers', type=int, default=1, help='worker processes per configuration running its runs')
+    parser.add_argument('--engine', default='object', choices=['object', 'vectorized'])
+    parser.add_argument('--centralised-engine', default=None, choices=['object', 'vectorized', 'closed-form'],
+                        help='engine of the centralised configurations (default: --engine)')
+    parser.add_argument('--interval', type=int, default=None, help='hours per timestep (default: one timestep per day)')
+    parser.add_argument('--zones', type=int, default=1, help='number of neighbourhood zones (vectorized engine only)')
+    parser.add_argument('--population-cache', default=None,
+                        help='generate the agents in bulk and save them in this folder for later sweeps (default: generate_agents)')
+    parser.add_argument('--telemetry-port', type=int, default=None,
+                        help='stream the metrics of the running simulations on this port (see telemetry.py)')
+    parser.add_argument('--batched', action='store_true',
+                        help='simulate the runs of many configurations together (vectorized engine only)')
+    parser.add_argument('--out-dir', default='../data', help='folder of the results files')
+    args = parser.parse_args()
+
+    from sweep import build_grid, run_sweep
+
+    # All configurations publish to one telemetry server in this process
+    telemetry = None
+    if args.telemetry_port is not None:
+        telemetry = {'address': TelemetryServer(port=args.telemetry_port).start().address}
+
+    grid = build_grid(modes=args.modes, sens_ranges=args.sens_ranges, panel_prods=args.panel_prods, agent_counts=args.agents)
+    run_sweep(grid, n_runs=args.runs, t_max=args.t_max, seed=args.seed, n_workers=args.workers, engine=args.engine,
+              out_dir=args.out_dir, out_format=args.format, batched=args.batched, centralised_engine=args.centralised_engine,
+              options={'n_workers': args.run_workers, 'interval': args.interval, 'n_zones': args.zones,
+                       'population': {'cache_dir': args.population_cache} if args.population_cache else None,
+                       'telemetry': telemetry})
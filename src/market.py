@@ -0,0 +1,539 @@
+"""
+Order book clearing for the simulation.
+The ClearingEngine matches the buy orders of the ProsumerAgents against the price sorted sell orders in a single pass
+with a moving cursor and hands the remaining amounts to the CentralAgent. The clear_book function does the same
+for the OrderBook of the array based ProsumerPopulation, optionally split into neighbourhood zones that clear their
+own orders in parallel before the residual orders are matched between the zones.
+"""
+
+import numpy as np
+
+from enums import OrderType
+from instrument import NULL_INSTRUMENTATION
+from journal import CENTRAL, CENTRAL_PURCHASE, CENTRAL_SALE, MATCH, NULL_JOURNAL, PARTIAL_FILL
+from order import BUY, DONE, SELL
+
+
+# Clearing engine for the order objects of the ProsumerAgents
+class ClearingEngine():
+
+    # Initialize the clearing engine
+    def __init__(self, central_agent, mode='distributed', instrument=NULL_INSTRUMENTATION, journal=NULL_JOURNAL):
+        self.central_agent = central_agent
+        self.mode = mode
+        self.instrument = instrument
+        self.journal = journal
+
+        # Agents sorted by sell price on the previous day, used as starting point for the next sort
+        self.price_order = None
+
+    # The instrumentation and the journal are not part of a checkpoint
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['instrument'], state['journal']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.instrument = NULL_INSTRUMENTATION
+        self.journal = NULL_JOURNAL
+
+    # Method to sort the sell orders by price
+    def sort_sell_orders(self, agent_list, sell_order_list):
+        """
+        Sort the sell orders by price (low to high), ties by agent id. Sell prices only move by the sensitivity of
+        the agent each day, so the agents sorted on the previous day are nearly sorted and timsort runs in about
+        linear time on them.
+        :param agent_list: list of all ProsumerAgents, ordered by id
+        :param sell_order_list: the sell orders of the day
+        """
+        if self.price_order is None:
+            self.price_order = list(agent_list)
+        self.price_order.sort(key=lambda agent: (agent.sell_price, agent.id))
+
+        sell_orders = {order.agent_id: order for order in sell_order_list}
+        return [sell_orders[agent.id] for agent in self.price_order if agent.id in sell_orders]
+
+    # Method to clear the orders of a day
+    def clear(self, agent_list, buy_order_list, sell_order_list):
+        """
+        Match the buy orders, in the given priority order, with the cheapest sell orders and let the central agent
+        fulfill the rest. Returns the energy sold by the central agent and the weighted average price of the day.
+        :param agent_list: list of all ProsumerAgents, ordered by id
+        :param buy_order_list: the buy orders of the day, in priority order
+        :param sell_order_list: the sell orders of the day
+        """
+        central_agent = self.central_agent
+        instrument = self.instrument
+        journal = self.journal
+
+        instrument.start('sort')
+        sell_order_list = self.sort_sell_orders(agent_list, sell_order_list)
+        instrument.stop('sort')
+        instrument.start('matching')
+
+        # Only sell orders below the central agent sell price take part in agent-to-agent trades
+        n_eligible = 0
+        if self.mode == 'distributed':
+            while n_eligible < len(sell_order_list) and sell_order_list[n_eligible].price <= central_agent.sell_price:
+                n_eligible += 1
+
+        # Create sales tracking variables
+        total_amount_sold = 0
+        total_value_sold = 0
+        central_energy_sold = 0
+
+        # Cursor to the cheapest sell order that is not exhausted yet
+        cursor = 0
+
+        # Event counters, added to the instrumentation once per day
+        matches = 0
+        partial_fills = 0
+        central_sales = 0
+        central_purchases = 0
+
+        for buy_order in buy_order_list:
+            buyer = agent_list[buy_order.agent_id]
+
+            # First, process agent-to-agent orders
+            while buy_order.amount > 0 and cursor < n_eligible:
+                sell_order = sell_order_list[cursor]
+                seller = agent_list[sell_order.agent_id]
+
+                # Fulfill the entire buy order if possible, otherwise partially fulfill it
+                amount = min(buy_order.amount, sell_order.amount)
+                matches += 1
+                if sell_order.amount < buy_order.amount:
+                    partial_fills += 1
+                    journal.record(PARTIAL_FILL, buy_order.agent_id, sell_order.agent_id, amount, sell_order.price)
+                else:
+                    journal.record(MATCH, buy_order.agent_id, sell_order.agent_id, amount, sell_order.price)
+
+                seller.sales.record(amount, sell_order.price)
+
+                # Transfer energy from seller to buyer
+                buyer.set_own_energy(amount)
+                seller.set_own_energy(-amount)
+
+                # Update balances
+                buyer.balance -= amount * sell_order.price
+                seller.balance += amount * sell_order.price
+
+                total_amount_sold += amount
+                total_value_sold += amount * sell_order.price
+
+                # Adjust the amounts left in both orders
+                sell_order.amount -= amount
+                buy_order.amount -= amount
+                buyer.energy_bought += amount
+
+                # Skip the sell order from now on when it is exhausted
+                if sell_order.amount <= 0:
+                    sell_order.type = OrderType.DONE
+                    cursor += 1
+
+            # The central agent sells energy at fixed prices (0.24)
+            if buy_order.amount > 0:
+                buyer.set_own_energy(buy_order.amount)
+                central_agent.energy_sold += buy_order.amount
+                central_agent.sales.record(buy_order.amount, central_agent.sell_price)
+
+                # Adjust balances
+                buyer.balance -= buy_order.amount * central_agent.sell_price
+                central_agent.balance += buy_order.amount * central_agent.sell_price
+
+                total_amount_sold += buy_order.amount
+                total_value_sold += buy_order.amount * central_agent.sell_price
+
+                central_energy_sold += buy_order.amount
+                journal.record(CENTRAL_SALE, buy_order.agent_id, CENTRAL, buy_order.amount, central_agent.sell_price)
+
+                buy_order.amount = 0
+                central_sales += 1
+
+            # Mark buy order as done
+            buy_order.type = OrderType.DONE
+
+        instrument.stop('matching')
+        instrument.count('matches', matches)
+        instrument.count('sell orders scanned', matches)
+        instrument.count('partial fills', partial_fills)
+        instrument.count('central sales', central_sales)
+        instrument.start('central')
+
+        # The central agent buys energy at fixed prices (0.07)
+        for sell_order in sell_order_list[cursor:]:
+            if sell_order.amount > 0:
+                seller = agent_list[sell_order.agent_id]
+
+                seller.sales.record(sell_order.amount, sell_order.price)
+
+                seller.set_own_energy(-sell_order.amount)
+                central_agent.energy_bought += sell_order.amount
+
+                # Adjust balances
+                seller.balance += sell_order.amount * central_agent.buy_price
+                central_agent.balance -= sell_order.amount * central_agent.buy_price
+
+                total_amount_sold += sell_order.amount
+                total_value_sold += sell_order.amount * central_agent.buy_price
+
+                central_purchases += 1
+                journal.record(CENTRAL_PURCHASE, sell_order.agent_id, CENTRAL, sell_order.amount, central_agent.buy_price)
+
+        instrument.count('central purchases', central_purchases)
+        instrument.stop('central')
+
+        # Calculate the weighted average price
+        avg_price = total_value_sold / total_amount_sold if total_amount_sold > 0 else 0
+
+        return central_energy_sold, avg_price
+
+
+# Sell side ordering for the array based ProsumerPopulation
+class PriceOrder():
+
+    # Initialize the price order
+    def __init__(self, n_agents):
+        self.order = np.arange(n_agents)
+
+    # Method to group the agents by zone
+    def group(self, zones):
+        """
+        Move the agents of every zone to a contiguous part of the order, keeping their price order within the zone,
+        so the zones can be sorted independently
+        :param zones: the zone of every agent, ascending by agent id
+        """
+        self.order = self.order[np.argsort(zones[self.order], kind='stable')]
+
+    # Method to sort the sell orders by price
+    def sort(self, sell_ids, sell_prices, is_seller, span=slice(None)):
+        """
+        Return the positions of the sell orders sorted by price (low to high), ties by agent id. The agents are
+        kept sorted by price between days, so the stable sort works on nearly sorted data.
+        :param sell_ids: the agent ids of the sell orders, ascending
+        :param sell_prices: the prices of the sell orders
+        :param is_seller: boolean mask over all agents that have a sell order
+        :param span: the part of the order holding the agents of the sell orders, e.g. the agents of a zone after
+                     group (all agents by default); disjoint spans can be sorted concurrently
+        """
+        order = self.order[span]
+
+        # Sellers in the order of the previous day
+        presorted = order[is_seller[order]]
+        positions = np.searchsorted(sell_ids, presorted)
+        positions = positions[np.argsort(sell_prices[positions], kind='stable')]
+
+        # Restore the agent id order when new ties are not in id order
+        prices = sell_prices[positions]
+        if np.any((np.diff(prices) == 0) & (np.diff(positions) < 0)):
+            positions = np.lexsort((sell_ids, sell_prices))
+
+        # Move the sellers to their new place and keep the other agents in between
+        order[np.flatnonzero(is_seller[order])] = sell_ids[positions]
+        return positions
+
+
+# Match buy orders against price sorted sell orders
+def clear_orders(buy_amounts, sell_amounts, sell_prices):
+    """
+    Match the buy orders, in priority order, against the sell orders, sorted by price (low to high). Every buy order
+    takes energy from the cheapest sell orders that are not exhausted yet, exactly like the ClearingEngine.
+    Both sides are laid out on one cumulative energy axis, so the whole day is cleared without a Python loop.
+    Returns the amount and cost bought by each buy order and the amount sold by each sell order.
+    :param buy_amounts: amounts of the buy orders in priority order
+    :param sell_amounts: amounts of the sell orders sorted by price
+    :param sell_prices: prices of the sell orders sorted by price
+    """
+    if len(buy_amounts) == 0 or len(sell_amounts) == 0:
+        return np.zeros(len(buy_amounts)), np.zeros(len(buy_amounts)), np.zeros(len(sell_amounts))
+
+    buy_cum = np.concatenate(([0], np.cumsum(buy_amounts)))
+    sell_cum = np.concatenate(([0], np.cumsum(sell_amounts)))
+    value_cum = np.concatenate(([0], np.cumsum(sell_amounts * sell_prices)))
+    traded = min(buy_cum[-1], sell_cum[-1])
+
+    # Energy traded by each order is its part of the axis below the total traded amount
+    buy_cum = np.minimum(buy_cum, traded)
+    bought = np.diff(buy_cum)
+    sold = np.diff(np.minimum(sell_cum, traded))
+
+    # Value of the first x units sold: value of the exhausted sell orders plus the part of the current one
+    idx = np.clip(np.searchsorted(sell_cum, buy_cum, side='right') - 1, 0, len(sell_amounts) - 1)
+    value = value_cum[idx] + (buy_cum - sell_cum[idx]) * sell_prices[idx]
+    cost = np.diff(value)
+
+    return bought, cost, sold
+
+
+# Match the orders of many independent markets
+def clear_grouped(buy_amounts, buy_groups, sell_amounts, sell_prices, sell_groups, n_groups):
+    """
+    Version of clear_orders for many markets at once, e.g. the runs of a config-batched simulation. The orders of a
+    market (group) are contiguous and every group gets its own cumulative energy axis starting at 0, so the groups are
+    cleared exactly as separate calls of clear_orders would, up to rounding.
+    :param buy_amounts: amounts of the buy orders, by group and in priority order within a group
+    :param buy_groups: the group of every buy order, ascending
+    :param sell_amounts: amounts of the sell orders, by group and sorted by price within a group
+    :param sell_prices: prices of the sell orders
+    :param sell_groups: the group of every sell order, ascending
+    :param n_groups: the number of groups
+    """
+    bought = np.zeros(len(buy_amounts))
+    cost = np.zeros(len(buy_amounts))
+    sold = np.zeros(len(sell_amounts))
+    if len(buy_amounts) == 0 or len(sell_amounts) == 0:
+        return bought, cost, sold
+
+    # Start and end of every order on the axis of its group
+    def local_axis(amounts, groups):
+        ends = np.cumsum(amounts)
+        starts = np.concatenate(([0], ends[:-1]))
+        first = np.searchsorted(groups, np.arange(n_groups))
+        last = np.searchsorted(groups, np.arange(n_groups), side='right') - 1
+        base = starts[np.minimum(first, len(starts) - 1)]
+        totals = np.where(last >= first, ends[last] - base, 0)
+        return starts - base[groups], ends - base[groups], totals, first, last
+
+    buy_start, buy_end, buy_totals, _, _ = local_axis(buy_amounts, buy_groups)
+    sell_start, sell_end, sell_totals, first_sell, last_sell = local_axis(sell_amounts, sell_groups)
+    value_start = local_axis(sell_amounts * sell_prices, sell_groups)[0]
+
+    # Energy traded by each order is its part of the axis below the amount traded in its group
+    traded = np.minimum(buy_totals, sell_totals)
+    low = np.minimum(buy_start, traded[buy_groups])
+    high = np.minimum(buy_end, traded[buy_groups])
+    bought = high - low
+    sold = np.minimum(sell_end, traded[sell_groups]) - np.minimum(sell_start, traded[sell_groups])
+
+    # Sell order of the group at every point of the axis: the last one that starts at or below it
+    has_sells = (last_sell >= first_sell)[buy_groups]
+    points = np.concatenate((low, high))
+    point_groups = np.concatenate((buy_groups, buy_groups))
+    keys = np.lexsort((
+        np.concatenate((np.zeros(len(sell_start), dtype=np.int8), np.ones(len(points), dtype=np.int8))),
+        np.concatenate((sell_start, points)),
+        np.concatenate((sell_groups, point_groups))
+    ))
+    is_point = keys >= len(sell_start)
+    idx = np.empty(len(points), dtype=int)
+    idx[keys[is_point] - len(sell_start)] = np.cumsum(~is_point)[is_point] - 1
+    idx = np.clip(idx, first_sell[point_groups], np.maximum(last_sell[point_groups], first_sell[point_groups]))
+    idx = np.minimum(idx, len(sell_start) - 1)
+
+    # Value of the first x units sold in the group
+    value = value_start[idx] + (points - sell_start[idx]) * sell_prices[idx]
+    cost = np.where(has_sells, value[len(low):] - value[:len(low)], 0)
+
+    return bought, cost, sold
+
+
+# Split the cleared orders into matches
+def match_segments(buy_amounts, sell_amounts):
+    """
+    Split the traded part of the cumulative energy axis of clear_orders into the individual matches of the
+    ClearingEngine. Every match is a piece of the axis between two order boundaries. Returns per match the position
+    of the buy order, the position of the sell order, the amount and whether the sell order was exhausted before the
+    buy order was complete (a partial fill).
+    :param buy_amounts: amounts of the buy orders in priority order
+    :param sell_amounts: amounts of the sell orders sorted by price
+    """
+    if len(buy_amounts) == 0 or len(sell_amounts) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0), np.zeros(0, dtype=bool)
+
+    buy_cum = np.cumsum(buy_amounts)
+    sell_cum = np.cumsum(sell_amounts)
+    ends = np.unique(np.minimum(np.concatenate((buy_cum, sell_cum)), min(buy_cum[-1], sell_cum[-1])))
+    starts = np.concatenate(([0], ends[:-1]))
+    middles = (starts + ends) / 2
+
+    buy_idx = np.searchsorted(buy_cum, middles)
+    sell_idx = np.searchsorted(sell_cum, middles)
+    return buy_idx, sell_idx, ends - starts, ends < buy_cum[buy_idx]
+
+
+# Thread pools clearing the zones of an order book, one per number of threads
+_executors = {}
+
+# Leftovers of the cumulative matching below this amount are rounding errors, not energy
+RESIDUAL_TOLERANCE = 1e-9
+
+
+# Get a thread pool for the zones
+def zone_executor(n_threads):
+    """
+    Return the thread pool with the given number of threads, created on first use and shared by all runs of the
+    process. The arrays of the zones are disjoint and NumPy releases the GIL in the matching, so the zones are cleared
+    concurrently.
+    :param n_threads: the number of threads
+    """
+    if n_threads not in _executors:
+        from concurrent.futures import ThreadPoolExecutor
+
+        _executors[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return _executors[n_threads]
+
+
+# Split orders by zone
+def split_by_zone(positions, zones_of_orders, n_zones):
+    """
+    Split the positions of orders into one array per zone, keeping their order within every zone
+    :param positions: the positions of the orders, in priority order
+    :param zones_of_orders: the zone of every order in positions
+    :param n_zones: the number of zones
+    """
+    order = np.argsort(zones_of_orders, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(zones_of_orders, minlength=n_zones))))
+    positions = positions[order]
+    return [positions[bounds[zone]:bounds[zone + 1]] for zone in range(n_zones)]
+
+
+# Clear one market of an order book
+def clear_market(buy_amounts, sell_amounts, sell_prices, segments=False):
+    """
+    Match the remaining amounts of the buy and sell orders of one market (the whole book, a zone or the inter-zone
+    stage) with clear_orders. Returns the amount and cost bought per buy order, the amount sold per sell order and
+    the individual matches of match_segments if requested (None otherwise).
+    :param buy_amounts: remaining amounts of the buy orders in priority order
+    :param sell_amounts: remaining amounts of the sell orders sorted by price
+    :param sell_prices: prices of the sell orders sorted by price
+    :param segments: also return the individual matches
+    """
+    bought, cost, sold = clear_orders(buy_amounts, sell_amounts, sell_prices)
+    matches = match_segments(buy_amounts, sell_amounts) if segments else None
+    return bought, cost, sold, matches
+
+
+# Clear an order book
+def clear_book(book, price_order, central_agent, mode='distributed', rng=None, instrument=NULL_INSTRUMENTATION,
+               journal=NULL_JOURNAL, zones=None, n_threads=1):
+    """
+    Clear the orders of an OrderBook in place. Buy orders are matched in random order with the cheapest sell orders
+    below the central agent sell price (distributed mode only), all remaining amounts go to the central agent.
+    With zones, every zone first clears its own orders, the zones concurrently, and the residual orders of all zones
+    are then matched in an inter-zone stage before they go to the central agent.
+    Afterwards all orders are DONE. Returns per order of the book the amount and value traded with other agents and
+    the amount traded with the central agent.
+    :param book: the OrderBook of the day
+    :param price_order: the PriceOrder of the population
+    :param central_agent: the central agent buying and selling the remaining energy
+    :param mode: the mode of the simulation ('centralised' or 'distributed')
+    :param rng: the random number generator of the run
+    :param instrument: the instrumentation of the run
+    :param journal: the event journal of the run
+    :param zones: the zone of every agent (None for one market of all agents)
+    :param n_threads: the number of threads clearing the zones
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    instrument.start('sort')
+    orders = book.view()
+    traded = np.zeros(len(orders))
+    value = np.zeros(len(orders))
+
+    # Shuffle buy orders so order of agents purchasing energy is random
+    buys = np.flatnonzero(orders['side'] == BUY)
+    buys = buys[rng.permutation(len(buys))]
+
+    # Sell orders, in agent id order
+    sells = np.flatnonzero(orders['side'] == SELL)
+    sell_ids = orders['agent_id'][sells]
+    is_seller = np.zeros(len(price_order.order), dtype=bool)
+    is_seller[sell_ids] = True
+
+    # Sort sell orders by price (low to high), with zones every zone sorts its own sell orders below
+    if zones is None:
+        sells = sells[price_order.sort(sell_ids, orders['price'][sells], is_seller)]
+    instrument.stop('sort')
+    instrument.start('matching')
+
+    # The individual matches are only needed for the instrumentation and the journal
+    distributed = mode == 'distributed'
+    segments = distributed and (instrument.enabled or journal.wants(MATCH) or journal.wants(PARTIAL_FILL))
+
+    # Agent-to-agent trades only in distributed mode and only with sellers below the central sell price
+    def eligible(market_sells):
+        return market_sells[:np.searchsorted(orders['price'][market_sells], central_agent.sell_price, side='right')]
+
+    # Clear the remaining amounts of a market and settle the result
+    def clear(market_buys, market_sells):
+        return clear_market(orders['amount'][market_buys] - traded[market_buys],
+                            orders['amount'][market_sells] - traded[market_sells],
+                            orders['price'][market_sells], segments)
+
+    def settle(market_buys, market_sells, result, counter):
+        bought, cost, sold, matches = result
+        traded[market_buys] += bought
+        value[market_buys] += cost
+        traded[market_sells] += sold
+        value[market_sells] += sold * orders['price'][market_sells]
+
+        if matches is not None:
+            buy_idx, sell_idx, amounts, partial = matches
+            instrument.count(counter, len(amounts))
+            instrument.count('sell orders scanned', len(amounts))
+            instrument.count('partial fills', np.count_nonzero(partial))
+            buyers = orders['agent_id'][market_buys[buy_idx]]
+            sellers = orders['agent_id'][market_sells[sell_idx]]
+            prices = orders['price'][market_sells[sell_idx]]
+            journal.record_many(MATCH, buyers[~partial], sellers[~partial], amounts[~partial], prices[~partial])
+            journal.record_many(PARTIAL_FILL, buyers[partial], sellers[partial], amounts[partial], prices[partial])
+
+    if zones is None:
+        if distributed:
+            sells = eligible(sells)
+            settle(buys, sells, clear(buys, sells), 'matches')
+    else:
+        # The zones are contiguous ranges of agent ids, so the sell orders of a zone are a slice of the book and
+        # its agents a span of the price order
+        n_zones = int(zones[-1]) + 1
+        agent_bounds = np.searchsorted(zones, np.arange(n_zones + 1))
+        sell_bounds = np.searchsorted(sell_ids, agent_bounds)
+        zone_buys = split_by_zone(buys, zones[orders['agent_id'][buys]], n_zones)
+
+        # Local stage: every zone sorts and clears its own orders, the zones are independent
+        def clear_zone(zone):
+            start, end = sell_bounds[zone], sell_bounds[zone + 1]
+            zone_sells = sells[start:end]
+            zone_sells = zone_sells[price_order.sort(sell_ids[start:end], orders['price'][zone_sells], is_seller,
+                                                     slice(agent_bounds[zone], agent_bounds[zone + 1]))]
+            if not distributed:
+                return zone_sells, None
+            zone_sells = eligible(zone_sells)
+            return zone_sells, clear(zone_buys[zone], zone_sells)
+
+        if n_threads > 1:
+            results = list(zone_executor(n_threads).map(clear_zone, range(n_zones)))
+        else:
+            results = list(map(clear_zone, range(n_zones)))
+
+        if distributed:
+            for market_buys, (market_sells, result) in zip(zone_buys, results):
+                settle(market_buys, market_sells, result, 'matches')
+
+            # Inter-zone stage: the residual orders of all zones, in the global priority and price order
+            sells = np.concatenate([market_sells for market_sells, _ in results])
+            buys = buys[orders['amount'][buys] - traded[buys] > RESIDUAL_TOLERANCE]
+            sells = sells[orders['amount'][sells] - traded[sells] > RESIDUAL_TOLERANCE]
+            sells = sells[np.lexsort((orders['agent_id'][sells], orders['price'][sells]))]
+            settle(buys, sells, clear(buys, sells), 'inter-zone matches')
+
+    # Everything that is left is traded with the central agent, except the rounding leftovers of the cumulative
+    # matching, which are no energy and no trades
+    central = orders['amount'] - traded
+    central[central <= RESIDUAL_TOLERANCE] = 0
+
+    if instrument.enabled or journal.wants(CENTRAL_SALE) or journal.wants(CENTRAL_PURCHASE):
+        is_buy = orders['side'] == BUY
+        central_sales = np.flatnonzero(is_buy & (central > 0))
+        central_purchases = np.flatnonzero(~is_buy & (central > 0))
+        instrument.count('central sales', len(central_sales))
+        instrument.count('central purchases', len(central_purchases))
+        journal.record_many(CENTRAL_SALE, orders['agent_id'][central_sales], CENTRAL, central[central_sales], central_agent.sell_price)
+        journal.record_many(CENTRAL_PURCHASE, orders['agent_id'][central_purchases], CENTRAL, central[central_purchases], central_agent.buy_price)
+    instrument.stop('matching')
+    orders['amount'] = 0
+    orders['status'] = DONE
+
+    return traded, value, central
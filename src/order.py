@@ -1,9 +1,75 @@
-""" 
-Order class 
 """
+Order class and array based order book
+"""
+
+import numpy as np
+
+# Sides and statuses of the orders in an OrderBook
+BUY = 0
+SELL = 1
+OPEN = 0
+DONE = 1
+
+# Record layout of an order in an OrderBook
+ORDER_DTYPE = np.dtype([
+    ('agent_id', np.int64),
+    ('amount', np.float64),
+    ('price', np.float64),
+    ('side', np.int8),
+    ('status', np.int8)
+])
+
+
 class Order():
+    __slots__ = ('agent_id', 'amount', 'price', 'type')
+
     def __init__(self, agent_id, amount, price, order_type):
         self.agent_id = agent_id
         self.amount = amount
         self.price = price
-        self.type = order_type
\ No newline at end of file
+        self.type = order_type
+
+
+# Order book class, a preallocated structured array of orders
+class OrderBook():
+
+    # Initialize the order book
+    def __init__(self, capacity):
+        """
+        :param capacity: the maximum number of orders, e.g. the number of agents
+        """
+        self.orders = np.zeros(capacity, dtype=ORDER_DTYPE)
+        self.n_orders = 0
+
+    # Method to remove all orders
+    def reset(self):
+        self.n_orders = 0
+
+    # Method to add orders in bulk
+    def add(self, agent_ids, amounts, prices, sides):
+        """
+        Append orders to the book, all arguments are arrays (or scalars) of the same length
+        :param agent_ids: the ids of the agents
+        :param amounts: the amounts of energy
+        :param prices: the prices
+        :param sides: BUY or SELL
+        """
+        agent_ids = np.asarray(agent_ids)
+        start, end = self.n_orders, self.n_orders + len(agent_ids)
+        if end > len(self.orders):
+            raise ValueError(f"Order book is full ({len(self.orders)} orders)")
+
+        orders = self.orders[start:end]
+        orders['agent_id'] = agent_ids
+        orders['amount'] = amounts
+        orders['price'] = prices
+        orders['side'] = sides
+        orders['status'] = OPEN
+        self.n_orders = end
+
+    # Method to get the orders in the book
+    def view(self):
+        """
+        Return the orders in the book, a view on the underlying array
+        """
+        return self.orders[:self.n_orders]
@@ -0,0 +1,320 @@
+"""
+Vectorized prosumer population for the simulation.
+Instead of one ProsumerAgent object per household, the ProsumerPopulation keeps the state of all prosumers
+in NumPy arrays (struct-of-arrays) and advances the whole population with a few batched operations per day.
+Populations are saved to and loaded from compact .npz files of their initial attributes.
+"""
+
+import os
+
+import numpy as np
+
+from agent import ProsumerAgent, calculate_seasonal_demand
+from enums import HouseType
+from instrument import NULL_INSTRUMENTATION
+from journal import BUY_ORDER, CENTRAL, NULL_JOURNAL, SELL_ORDER, UNSATISFIED
+from market import PriceOrder, clear_book
+from order import BUY, SELL, OrderBook
+
+
+# Population class holding the state of all prosumers in arrays
+class ProsumerPopulation():
+
+    # Initialize the population
+    def __init__(self, n_panels, base_energy_demand, sell_price, sensitivity, house_type):
+        self.n_agents = len(n_panels)
+        self.n_panels = np.asarray(n_panels, dtype=float)
+        self.base_energy_demand = np.asarray(base_energy_demand, dtype=float)
+        self.sell_price = np.asarray(sell_price, dtype=float)
+        self.sensitivity = np.asarray(sensitivity, dtype=float)
+        self.house_type = list(house_type)
+        self.balance = np.zeros(self.n_agents)
+        self.energy_production = np.zeros(self.n_agents)
+        self.energy_demand = self.base_energy_demand.copy()
+        self.energy_bought = np.zeros(self.n_agents)
+        self.energy_balance = np.zeros(self.n_agents)
+
+        # Whether the agent sold energy on the previous day (replaces the per-agent sold energy lists)
+        self.has_sold = np.zeros(self.n_agents, dtype=bool)
+        self.price_order = PriceOrder(self.n_agents)
+        self.order_book = OrderBook(self.n_agents)
+
+        # All agents trade in one market until the population is split into zones
+        self.zones = None
+        self.n_threads = 1
+
+    # Create a population from a list of prosumer agents
+    @classmethod
+    def from_agents(cls, agent_list):
+        """
+        Build a population from ProsumerAgent objects, e.g. the output of generate_agents
+        :param agent_list: list of ProsumerAgents, ordered by id
+        """
+        return cls(
+            n_panels=[agent.n_panels for agent in agent_list],
+            base_energy_demand=[agent.base_energy_demand for agent in agent_list],
+            sell_price=[agent.sell_price for agent in agent_list],
+            sensitivity=[agent.sensitivity for agent in agent_list],
+            house_type=[agent.house_type for agent in agent_list]
+        )
+
+    # Method to convert the population to prosumer agents
+    def to_agents(self):
+        """
+        Build one ProsumerAgent per household with the current sell prices, e.g. for the object engine
+        """
+        return [
+            ProsumerAgent(
+                id=i,
+                n_panels=n_panels,
+                base_energy_demand=base_energy_demand,
+                sell_price=sell_price,
+                sensitivity=sensitivity,
+                house_type=house_type
+            )
+            for i, (n_panels, base_energy_demand, sell_price, sensitivity, house_type) in enumerate(zip(
+                self.n_panels.tolist(), self.base_energy_demand.tolist(), self.sell_price.tolist(),
+                self.sensitivity.tolist(), self.house_type
+            ))
+        ]
+
+    # Method to save the population
+    def save(self, path):
+        """
+        Save the attributes the population was created with to a compressed .npz file, written to a temporary file
+        until it is complete
+        :param path: path of the file
+        """
+        house_types = list(HouseType)
+        # Concurrent simulations may save the same population, every process writes its own temporary file
+        part = f'{path}.{os.getpid()}.part'
+        with open(part, 'wb') as f:
+            np.savez_compressed(
+                f,
+                n_panels=self.n_panels,
+                base_energy_demand=self.base_energy_demand,
+                sell_price=self.sell_price,
+                sensitivity=self.sensitivity,
+                house_type=np.array([house_types.index(house_type) for house_type in self.house_type], dtype=np.int8)
+            )
+        os.replace(part, path)
+
+    # Load a saved population
+    @classmethod
+    def load(cls, path):
+        """
+        Load a population saved with save
+        :param path: path of the file
+        """
+        house_types = list(HouseType)
+        with np.load(path) as f:
+            return cls(
+                n_panels=f['n_panels'],
+                base_energy_demand=f['base_energy_demand'],
+                sell_price=f['sell_price'],
+                sensitivity=f['sensitivity'],
+                house_type=[house_types[code] for code in f['house_type'].tolist()]
+            )
+
+    # Method to split the population into zones
+    def set_zones(self, n_zones, n_threads=1):
+        """
+        Partition the agents into neighbourhood zones of (nearly) equal size by agent id. Every zone clears its own
+        orders first, the residual orders are matched between the zones before they go to the central agent.
+        :param n_zones: the number of zones (1 for one market of all agents)
+        :param n_threads: the number of threads clearing the zones concurrently
+        """
+        if n_zones < 1 or n_zones > self.n_agents:
+            raise ValueError(f"Number of zones must be between 1 and {self.n_agents}, got {n_zones}")
+
+        # The smallest integer type of the zone numbers, a stable sort by zone is then a radix sort
+        self.zones = None
+        if n_zones > 1:
+            self.zones = (np.arange(self.n_agents) * n_zones // self.n_agents).astype(np.min_scalar_type(n_zones - 1))
+            self.price_order.group(self.zones)
+        self.n_threads = n_threads
+
+    # Method to update all agents
+    def update(self, daily_energy_level, average_price, iteration, rng=None, demand_share=1, noise=None):
+        """
+        Batched version of ProsumerAgent.update for the whole population
+        :param daily_energy_level: energy produced per solar panel today
+        :param average_price: the average price of the previous day
+        :param iteration: current day
+        :param rng: the random number generator of the run
+        :param demand_share: the part of the daily demand that falls in the current interval
+        :param noise: the demand noise of every agent from a pre-drawn scenario (None to draw it from rng)
+        """
+        # Update the sell price of the agents that sold energy on the previous day. An agent sells all its energy
+        # at its own sell price, so the volume weighted sell price of ProsumerAgent.update is the sell price itself.
+        raise_price = self.has_sold & (self.sell_price > average_price)
+        lower_price = self.has_sold & ~raise_price
+        self.sell_price[raise_price] += self.sensitivity[raise_price]
+        self.sell_price[lower_price] = np.maximum(0, self.sell_price[lower_price] - self.sensitivity[lower_price])
+        self.has_sold[:] = False
+
+        # Calculate energy production, demand and balance
+        self.energy_production = self.n_panels * daily_energy_level
+        self.energy_demand = calculate_seasonal_demand(iteration, self.base_energy_demand, size=self.n_agents, rng=rng, noise=noise) * demand_share
+        self.energy_bought = np.zeros(self.n_agents)
+        self.energy_balance = self.energy_production - self.energy_demand
+
+    # Method to create the orders of all agents
+    def create_orders(self):
+        """
+        Batched version of ProsumerAgent.create_order, fills the order book with one order per agent with an
+        energy surplus (sell order) or deficit (buy order), in agent id order
+        """
+        ids = np.flatnonzero(self.energy_balance != 0)
+        energy_balance = self.energy_balance[ids]
+        is_sell = energy_balance > 0
+
+        self.order_book.reset()
+        self.order_book.add(ids, np.abs(energy_balance), np.where(is_sell, self.sell_price[ids], 0), np.where(is_sell, SELL, BUY))
+        return self.order_book
+
+    # Method to simulate one day
+    def step(self, day, daily_energy_level, average_price, central_agent, mode='distributed', rng=None,
+             instrument=NULL_INSTRUMENTATION, journal=NULL_JOURNAL, demand_share=1, noise=None):
+        """
+        Simulate one day for the whole population and return the metrics written to the results file
+        :param day: current day
+        :param daily_energy_level: energy produced per solar panel today
+        :param average_price: the average price of the previous day
+        :param central_agent: the central agent buying and selling the remaining energy
+        :param mode: the mode of the simulation ('centralised' or 'distributed')
+        :param rng: the random number generator of the run
+        :param instrument: the instrumentation of the run
+        :param journal: the event journal of the run
+        :param demand_share: the part of the daily demand that falls in the current interval
+        :param noise: the demand noise of every agent from a pre-drawn scenario (None to draw it from rng)
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        instrument.start('update')
+        self.update(daily_energy_level, average_price, day, rng, demand_share, noise)
+        instrument.stop('update')
+
+        total_demand = self.energy_demand.sum()
+        total_produced = self.energy_production.sum()
+
+        instrument.start('orders')
+        book = self.create_orders()
+        orders = book.view()
+        ids = orders['agent_id']
+        buys = orders['side'] == BUY
+        sells = ~buys
+        instrument.stop('orders')
+        instrument.count('buy orders', np.count_nonzero(buys))
+        instrument.count('sell orders', np.count_nonzero(sells))
+        journal.record_many(BUY_ORDER, ids[buys], CENTRAL, orders['amount'][buys], orders['price'][buys])
+        journal.record_many(SELL_ORDER, ids[sells], CENTRAL, orders['amount'][sells], orders['price'][sells])
+
+        traded, value, central = clear_book(book, self.price_order, central_agent, mode, rng, instrument, journal,
+                                            self.zones, self.n_threads)
+
+        instrument.start('central')
+
+        # Settle agent-to-agent trades
+        self.balance[ids[buys]] -= value[buys]
+        self.balance[ids[sells]] += value[sells]
+        self.energy_bought[ids[buys]] += traded[buys]
+        self.energy_production[ids[buys]] += traded[buys]
+        self.energy_production[ids[sells]] -= traded[sells]
+
+        # The central agent sells the remaining deficit at fixed prices
+        central_energy_sold = central[buys].sum()
+        self.energy_production[ids[buys]] += central[buys]
+        self.balance[ids[buys]] -= central[buys] * central_agent.sell_price
+        central_agent.energy_sold += central_energy_sold
+        if central_energy_sold > 0:
+            central_agent.sales.record(central_energy_sold, central_agent.sell_price, np.count_nonzero(central[buys]))
+        central_agent.balance += central_energy_sold * central_agent.sell_price
+
+        # The central agent buys the remaining surplus at fixed prices
+        central_energy_bought = central[sells].sum()
+        self.energy_production[ids[sells]] -= central[sells]
+        self.balance[ids[sells]] += central[sells] * central_agent.buy_price
+        central_agent.energy_bought += central_energy_bought
+        central_agent.balance -= central_energy_bought * central_agent.buy_price
+
+        self.has_sold[ids[sells]] = True
+        instrument.stop('central')
+
+        if journal.wants(UNSATISFIED):
+            unsatisfied = np.flatnonzero(np.round(self.energy_production, 5) < np.round(self.energy_demand, 5))
+            journal.record_many(UNSATISFIED, unsatisfied, CENTRAL, self.energy_demand[unsatisfied] - self.energy_production[unsatisfied])
+
+        # Calculate the weighted average price
+        total_amount_sold = traded[buys].sum() + central_energy_sold + central_energy_bought
+        avg_price = (
+            (value[buys].sum() + central_energy_sold * central_agent.sell_price + central_energy_bought * central_agent.buy_price) / total_amount_sold
+            if total_amount_sold > 0 else 0
+        )
+
+        avg_balance = self.balance.sum() / self.n_agents
+
+        return total_demand, central_energy_sold, total_produced, avg_price, avg_balance
+
+    # Method to simulate a whole centralised run at once
+    def simulate_centralised(self, days, daily_energy_levels, demand_shares, central_agent, rng=None,
+                             snapshot_days=None, block_size=None):
+        """
+        Closed-form version of step for the centralised mode. Without agent-to-agent trades every deficit is bought
+        from and every surplus sold to the central agent at its fixed prices, so the balances depend neither on the
+        sell prices nor on the order of the buyers, and all timesteps are computed as (timesteps x agents) arrays in
+        blocks of block_size timesteps. Returns the metrics of every timestep as an array of shape (timesteps,
+        number of metrics) and the balances of the agents at the snapshot days (None without snapshot days).
+        :param days: the calendar day of every timestep
+        :param daily_energy_levels: energy produced per solar panel in every timestep
+        :param demand_shares: the part of the daily demand that falls in every timestep
+        :param central_agent: the central agent buying and selling all energy
+        :param rng: the random number generator of the run
+        :param snapshot_days: the timesteps to return the balances of the agents at, ascending (None for none)
+        :param block_size: the number of timesteps computed at once (None for blocks of about a million values)
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        if block_size is None:
+            block_size = max(1, 2**20 // max(self.n_agents, 1))
+
+        t_max = len(days)
+        results = np.empty((t_max, 5))
+        snapshots = np.empty((len(snapshot_days), self.n_agents)) if snapshot_days is not None else None
+
+        for start in range(0, t_max, block_size):
+            block = slice(start, min(start + block_size, t_max))
+
+            # The demand noise of the block in one draw, row by row as the days would draw it
+            noise = rng.normal(loc=0, scale=0.02, size=(block.stop - block.start, self.n_agents))
+            energy_production = self.n_panels * daily_energy_levels[block, None]
+            energy_demand = calculate_seasonal_demand(days[block, None], self.base_energy_demand, noise=noise) * demand_shares[block, None]
+            energy_balance = energy_production - energy_demand
+
+            # All deficits are sold and all surpluses bought by the central agent
+            central_sales = np.maximum(-energy_balance, 0)
+            central_purchases = np.maximum(energy_balance, 0)
+            balances = self.balance + np.cumsum(central_purchases * central_agent.buy_price - central_sales * central_agent.sell_price, axis=0)
+            self.balance = balances[-1].copy()
+
+            central_energy_sold = central_sales.sum(axis=1)
+            central_energy_bought = central_purchases.sum(axis=1)
+            central_agent.energy_sold += central_energy_sold.sum()
+            central_agent.energy_bought += central_energy_bought.sum()
+            central_agent.balance += (central_energy_sold * central_agent.sell_price - central_energy_bought * central_agent.buy_price).sum()
+
+            # Calculate the weighted average price
+            total_amount_sold = central_energy_sold + central_energy_bought
+            total_value = central_energy_sold * central_agent.sell_price + central_energy_bought * central_agent.buy_price
+            avg_price = np.divide(total_value, total_amount_sold, out=np.zeros(len(total_value)), where=total_amount_sold > 0)
+
+            results[block] = np.column_stack((balances.sum(axis=1) / self.n_agents, energy_demand.sum(axis=1),
+                                              central_energy_sold, energy_production.sum(axis=1), avg_price))
+
+            if snapshots is not None:
+                in_block = (snapshot_days >= block.start) & (snapshot_days < block.stop)
+                snapshots[in_block] = balances[snapshot_days[in_block] - block.start]
+
+        return results, snapshots
+
@@ -0,0 +1,345 @@
+"""
+Result store for the simulation.
+The metrics of every run and timestep are buffered in one preallocated (run, timestep, metric) array and written in
+bulk to a binary file together with a metadata header that records the parameters of the simulation.
+Supported formats are 'npz' (compressed NumPy archive), 'npy' (memory-mappable array with a JSON sidecar),
+'parquet' (needs pandas with pyarrow) and 'csv' (the original long format with one row per run and timestep).
+Instead of every timestep, a results file can hold every k-th timestep, aggregates of fixed windows of timesteps or
+only the final state (see output_layout); the metadata then lists the timesteps of the rows. Snapshots of the
+balance of every agent (or its quantiles) every n days are written to a separate file.
+"""
+
+import csv
+import json
+import os
+import warnings
+
+import numpy as np
+
+# Columns of the long format, the first two are the index
+RESULT_COLUMNS = [
+    'run',
+    'timestep',
+    'average balance',
+    'total energy demand',
+    'total central energy bought',
+    'total energy produced',
+    'average price'
+]
+METRICS = RESULT_COLUMNS[2:]
+
+# Metrics that accumulate over the timesteps, extended past the end of a run that stopped in steady state
+CUMULATIVE_METRICS = ['average balance']
+
+FORMATS = ['npz', 'npy', 'parquet', 'csv']
+
+# Statistics of the windows of the windowed output
+OUTPUT_STATS = ['mean', 'min', 'max', 'std']
+
+
+# Format a parameter for a file name
+def format_param(value):
+    """
+    Format a parameter value for use in a file name, lists are flattened and joined by '-'
+    :param value: the parameter value
+    """
+    if isinstance(value, (list, tuple)):
+        return '-'.join(format_param(v) for v in value)
+    if isinstance(value, float):
+        return f'{value:g}'
+    return str(value)
+
+
+# Name of a results file
+def result_name(mode, sens_range, panel_prod, n_agents=None):
+    """
+    Build the name (without extension) of the results file of a configuration, e.g.
+    results_distributed_sens0.005-0.02_panel0.1
+    :param mode: the mode of the simulation ('centralised' or 'distributed')
+    :param sens_range: sensitivity range for the agents
+    :param panel_prod: production of the solar panels
+    :param n_agents: the number of agents (None to leave it out of the name)
+    """
+    name = f"results_{mode}_sens{format_param(sens_range)}_panel{format_param(panel_prod)}"
+    if n_agents is not None:
+        name += f"_agents{n_agents}"
+    return name
+
+
+# Result store class
+class ResultStore():
+
+    # Initialize the result store
+    def __init__(self, path, n_runs, t_max, metadata=None, out_format='npz', timesteps=None, columns=METRICS):
+        """
+        :param path: path of the results file, including the extension
+        :param n_runs: the number of runs
+        :param t_max: the maximum number of timesteps
+        :param metadata: the parameters of the simulation, stored in the header of the file
+        :param out_format: the format of the results file (see FORMATS)
+        :param timesteps: the timesteps of the rows of every run (None for every timestep)
+        :param columns: the names of the columns, see output_layout
+        """
+        if out_format not in FORMATS:
+            raise ValueError(f"Unknown results format {out_format}, choose from {FORMATS}")
+
+        self.path = path
+        self.out_format = out_format
+        self.timesteps = timesteps
+        self.columns = columns
+        self.metadata = dict(metadata or {}, n_runs=n_runs, t_max=t_max, metrics=columns)
+        if timesteps is not None:
+            self.metadata['timesteps'] = [int(step) for step in timesteps]
+        n_rows = t_max if timesteps is None else len(timesteps)
+
+        # The npy format is filled in directly on disk, the other formats are written in one go when flushed
+        if out_format == 'npy':
+            self.data = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=float, shape=(n_runs, n_rows, len(columns)))
+            self.data[:] = np.nan
+        else:
+            self.data = np.full((n_runs, n_rows, len(columns)), np.nan)
+
+    # Method to add the results of a run
+    def add_run(self, run, results):
+        """
+        Store the metrics of every timestep of a run
+        :param run: the index of the run
+        :param results: array of shape (number of rows, number of columns), see reduce_results
+        """
+        self.data[run] = results
+
+    # Method to drop the runs that were not simulated
+    def truncate(self, n_runs):
+        """
+        Keep only the first runs, e.g. when an adaptive simulation converged before its maximum number of runs
+        :param n_runs: the number of runs to keep
+        """
+        if n_runs == len(self.data):
+            return
+        self.metadata['n_runs'] = n_runs
+
+        if self.out_format == 'npy':
+            # The preallocated file is rewritten with the smaller shape
+            part = self.path + '.part'
+            np.save(part + '.npy', self.data[:n_runs])
+            del self.data
+            os.replace(part + '.npy', part)
+            self.data = np.lib.format.open_memmap(part, mode='r+')
+        else:
+            self.data = self.data[:n_runs]
+
+    # Method to write the results to disk
+    def flush(self):
+        """
+        Write the results file, it only gets its final name once it is complete
+        """
+        part = self.path + '.part'
+
+        if self.out_format == 'npy':
+            self.data.flush()
+            write_metadata(self.path, self.metadata)
+        elif self.out_format == 'npz':
+            with open(part, 'wb') as f:
+                np.savez_compressed(f, data=self.data, metadata=json.dumps(self.metadata))
+        elif self.out_format == 'parquet':
+            to_dataframe(self.data, self.timesteps, self.columns).to_parquet(part)
+            write_metadata(self.path, self.metadata)
+        else:
+            export_csv(self.data, part, self.timesteps, self.columns)
+            write_metadata(self.path, self.metadata)
+
+        os.replace(part, self.path)
+
+
+# Write the metadata sidecar of a results file
+def write_metadata(path, metadata):
+    """
+    Write the metadata of a results file to a JSON file next to it
+    :param path: path of the results file
+    :param metadata: the metadata
+    """
+    with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=4)
+
+
+# Export results to the long csv format
+def export_csv(data, path, timesteps=None, columns=METRICS):
+    """
+    Write a (run, timestep, metric) array in the original csv layout with one row per run and timestep
+    :param data: the results array
+    :param path: path of the csv file
+    :param timesteps: the timesteps of the rows of every run (None for every timestep)
+    :param columns: the names of the columns
+    """
+    n_runs, n_rows, _ = data.shape
+    if timesteps is None:
+        timesteps = np.arange(n_rows)
+    runs, steps = np.meshgrid(np.arange(n_runs), timesteps, indexing='ij')
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(RESULT_COLUMNS[:2] + list(columns))
+        rows = np.column_stack((runs.ravel(), steps.ravel(), data.reshape(n_runs * n_rows, -1)))
+        np.savetxt(f, rows, delimiter=',', fmt=['%d', '%d'] + ['%.17g'] * len(columns))
+
+
+# Convert results to a DataFrame in the long format
+def to_dataframe(data, timesteps=None, columns=METRICS):
+    """
+    Convert a (run, timestep, metric) array to a DataFrame with the columns of the csv format
+    :param data: the results array
+    :param timesteps: the timesteps of the rows of every run (None for every timestep)
+    :param columns: the names of the columns
+    """
+    import pandas as pd
+
+    n_runs, n_rows, _ = data.shape
+    if timesteps is None:
+        timesteps = np.arange(n_rows)
+    frame = pd.DataFrame(data.reshape(n_runs * n_rows, -1), columns=list(columns))
+    frame.insert(0, 'timestep', np.tile(timesteps, n_runs))
+    frame.insert(0, 'run', np.repeat(np.arange(n_runs), n_rows))
+    return frame
+
+
+# Load a results file
+def load_results(path, mmap=False):
+    """
+    Load a results file and return the (run, timestep, metric) array and the metadata
+    :param path: path of the results file
+    :param mmap: memory-map the data instead of reading it (npy format only)
+    """
+    extension = os.path.splitext(path)[1]
+    metadata_path = os.path.splitext(path)[0] + '.json'
+
+    metadata = {}
+    if extension != '.npz' and os.path.exists(metadata_path):
+        with open(metadata_path, encoding='utf-8') as f:
+            metadata = json.load(f)
+
+    if extension == '.npz':
+        with np.load(path) as archive:
+            return archive['data'], json.loads(str(archive['metadata']))
+
+    if extension == '.npy':
+        return np.load(path, mmap_mode='r' if mmap else None), metadata
+
+    # Long formats: one row per run and timestep, sorted by run and timestep
+    if extension == '.parquet':
+        import pandas as pd
+        rows = pd.read_parquet(path).to_numpy(dtype=float)
+    else:
+        rows = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+
+    n_runs = int(rows[:, 0].max()) + 1 if len(rows) else 0
+    return rows[:, 2:].reshape(n_runs, -1, rows.shape[1] - 2), metadata
+
+
+# Layout of the rows of a run
+def output_layout(t_max, output=None):
+    """
+    Return the timesteps of the rows and the names of the columns that reduce_results keeps of a run. The first
+    columns are always the METRICS (the means of the windows of the windowed output), so the analysis functions work
+    on every layout.
+    :param t_max: the maximum number of timesteps
+    :param output: None for every timestep, {'every': k} for every k-th timestep, {'window': w, 'stats': ['mean',
+                   'min', 'max', 'std']} for statistics of consecutive windows of w timesteps (the row of a window
+                   is its last timestep) or {'final': True} for the final state only; the final timestep is always
+                   kept
+    """
+    if output is None:
+        return np.arange(t_max), METRICS
+
+    if 'every' in output or 'window' in output:
+        step = output.get('every', output.get('window'))
+        timesteps = np.arange(step - 1, t_max, step)
+        if len(timesteps) == 0 or timesteps[-1] != t_max - 1:
+            timesteps = np.append(timesteps, t_max - 1)
+        if 'every' in output:
+            return timesteps, METRICS
+
+        stats = output.get('stats', OUTPUT_STATS)
+        unknown = [stat for stat in stats if stat not in OUTPUT_STATS]
+        if unknown:
+            raise ValueError(f"Unknown window statistics {unknown}, choose from {OUTPUT_STATS}")
+        return timesteps, METRICS + [f'{metric} {stat}' for stat in stats if stat != 'mean' for metric in METRICS]
+
+    if output.get('final'):
+        return np.array([t_max - 1]), METRICS
+
+    raise ValueError(f"Unknown output {output}, use 'every', 'window' or 'final'")
+
+
+# Number of simulated timesteps of a run
+def simulated_steps(results):
+    """
+    The number of timesteps a run simulated, fewer than t_max if it stopped early in steady state. The timesteps
+    after the stop have missing values, except for the extended cumulative metrics.
+    :param results: the (timestep, metric) results of the run
+    """
+    return int(np.count_nonzero(~np.isnan(results).any(axis=1)))
+
+
+# Reduce the results of a run
+def reduce_results(results, output=None):
+    """
+    Reduce the (timestep, metric) results of a run to the rows and columns of output_layout. Missing timesteps of a
+    run that stopped early are skipped, the final state is the last value of every metric (the extended value of a
+    cumulative metric, the last simulated timestep of the others).
+    :param results: the results of the run
+    :param output: the output granularity, see output_layout
+    """
+    if output is None:
+        return results
+
+    timesteps, columns = output_layout(len(results), output)
+    if 'every' in output:
+        return results[timesteps]
+
+    if 'window' in output:
+        # Pad the last window with missing timesteps
+        window = output['window']
+        padded = np.full((len(timesteps) * window, results.shape[1]), np.nan)
+        padded[:len(results)] = results
+        windows = padded.reshape(len(timesteps), window, -1)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            aggregates = {
+                'mean': lambda: np.nanmean(windows, axis=1),
+                'min': lambda: np.nanmin(windows, axis=1),
+                'max': lambda: np.nanmax(windows, axis=1),
+                'std': lambda: np.nanstd(windows, axis=1)
+            }
+            stats = ['mean'] + [stat for stat in output.get('stats', OUTPUT_STATS) if stat != 'mean']
+            return np.concatenate([aggregates[stat]() for stat in stats], axis=1)
+
+    # Last value of every metric, the first timestep for metrics without any
+    last = len(results) - 1 - np.argmax(~np.isnan(results[::-1]), axis=0)
+    return results[last, np.arange(results.shape[1])][np.newaxis]
+
+
+# Write agent snapshots
+def write_snapshots(path, days, balances, quantiles=None):
+    """
+    Write the snapshots of the agent balances of all runs to a compressed .npz file
+    :param path: path of the snapshot file
+    :param days: the days of the snapshots
+    :param balances: array of shape (run, snapshot, agent) with the balance of every agent, or (run, snapshot,
+                     quantile) with the quantiles of the balances
+    :param quantiles: the quantiles of the balances (None if every agent is kept)
+    """
+    part = path + '.part'
+    with open(part, 'wb') as f:
+        np.savez_compressed(f, days=days, balances=balances, quantiles=np.asarray(quantiles if quantiles is not None else [], dtype=float))
+    os.replace(part, path)
+
+
+# Load agent snapshots
+def load_snapshots(path):
+    """
+    Load a snapshot file, returns the days, the balances and the quantiles (None if every agent is kept)
+    :param path: path of the snapshot file
+    """
+    with np.load(path) as archive:
+        quantiles = archive['quantiles']
+        return archive['days'], archive['balances'], quantiles if len(quantiles) else None
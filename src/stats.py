@@ -0,0 +1,225 @@
+"""
+Streaming statistics over the runs of a simulation.
+RunningStats keeps per-timestep accumulators for every metric (Welford mean and variance, minimum, maximum and
+optionally a reservoir of runs for quantiles), so cross-run summaries never need the full run-level data in memory.
+Missing values (NaN, e.g. the timesteps after a run stopped in steady state) are skipped, so every timestep has its
+own number of runs. SteadyState detects when a run has stopped changing.
+"""
+
+import csv
+import warnings
+
+import numpy as np
+
+# Default z value of the confidence intervals (95%)
+Z = 1.96
+
+
+# Running statistics class
+class RunningStats():
+
+    # Initialize the running statistics
+    def __init__(self, shape, quantiles=None, reservoir_size=100, seed=0):
+        """
+        :param shape: shape of one sample, e.g. (t_max, number of metrics)
+        :param quantiles: quantiles to estimate, e.g. [0.05, 0.5, 0.95] (None to disable the reservoir)
+        :param reservoir_size: the number of runs kept in the reservoir for the quantiles
+        :param seed: seed of the reservoir sampling
+        """
+        self.n = 0
+        self.counts = np.zeros(shape, dtype=int)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+        # Reservoir sample of whole runs, a bounded sketch of the distribution for the quantiles
+        self.quantiles = quantiles
+        self.reservoir = None
+        if quantiles is not None:
+            self.reservoir = np.empty((reservoir_size,) + tuple(shape))
+            self.rng = np.random.default_rng(seed)
+
+    # Method to add a sample
+    def add(self, sample):
+        """
+        Add the results of one run
+        :param sample: array with the shape given at initialization
+        """
+        self.n += 1
+        valid = ~np.isnan(sample)
+        self.counts += valid
+        delta = np.where(valid, sample - self.mean, 0)
+        self.mean += delta / np.maximum(self.counts, 1)
+        self.m2 += delta * np.where(valid, sample - self.mean, 0)
+        np.fmin(self.min, sample, out=self.min)
+        np.fmax(self.max, sample, out=self.max)
+
+        if self.reservoir is not None:
+            if self.n <= len(self.reservoir):
+                self.reservoir[self.n - 1] = sample
+            else:
+                idx = self.rng.integers(self.n)
+                if idx < len(self.reservoir):
+                    self.reservoir[idx] = sample
+
+    # Method to merge with other running statistics
+    def merge(self, other):
+        """
+        Combine the statistics of another set of runs into these statistics (Chan et al. parallel update)
+        :param other: RunningStats over the other runs
+        """
+        if other.n == 0:
+            return
+        counts = self.counts + other.counts
+        n = np.maximum(counts, 1)
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.counts * other.counts / n
+        self.mean += delta * other.counts / n
+        self.counts = counts
+        self.n += other.n
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+
+    # Method to get the sample variance
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 1, self.m2 / (self.counts - 1), np.nan)
+
+    # Method to get the sample standard deviation
+    def std(self):
+        return np.sqrt(self.variance())
+
+    # Method to get the half width of the confidence interval of the mean
+    def ci(self, z=Z):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return z * self.std() / np.sqrt(self.counts)
+
+    # Method to estimate quantiles from the reservoir
+    def quantile(self, q):
+        """
+        Estimate a quantile over the runs (exact as long as all runs fit in the reservoir)
+        :param q: the quantile, between 0 and 1
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanquantile(self.reservoir[:min(self.n, len(self.reservoir))], q, axis=0)
+
+    # Method to get all statistics
+    def summary(self, z=Z):
+        """
+        Return a dictionary of statistic name to array with the shape of one sample
+        :param z: z value of the confidence interval
+        """
+        summary = {
+            'mean': self.mean,
+            'std': self.std(),
+            'ci': self.ci(z),
+            'min': self.min,
+            'max': self.max
+        }
+        for q in self.quantiles or []:
+            summary[f'q{q:g}'] = self.quantile(q)
+
+        # Timesteps that no run reached have no statistics
+        empty = self.counts == 0
+        if empty.any():
+            summary = {name: np.where(empty, np.nan, values) for name, values in summary.items()}
+        return summary
+
+
+# Steady state detection class
+class SteadyState():
+
+    # Initialize the detection
+    def __init__(self, window=365, tolerance=0.001, min_windows=2):
+        """
+        A run is in steady state when the averages of the average price and of the sell prices of the agents over
+        one window (a year by default, so the seasons cancel out) change less than the tolerance, relative to their
+        value, from one window to the next
+        :param window: the number of timesteps of a window
+        :param tolerance: the maximum relative change of the window averages
+        :param min_windows: the minimum number of windows before a run can be in steady state
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.min_windows = min_windows
+        self.n_windows = 0
+        self.n_steps = 0
+        self.sums = np.zeros(2)
+        self.previous = None
+
+    # Method to add a timestep
+    def update(self, avg_price, sell_price):
+        """
+        Add the average price and the mean sell price of the agents of a timestep, returns whether the run is in
+        steady state
+        :param avg_price: the average price of the timestep
+        :param sell_price: the mean sell price of the agents
+        """
+        self.sums += (avg_price, sell_price)
+        self.n_steps += 1
+        if self.n_steps < self.window:
+            return False
+
+        averages = self.sums / self.window
+        steady = (
+            self.previous is not None and self.n_windows + 1 >= self.min_windows
+            and np.all(np.abs(averages - self.previous) <= self.tolerance * np.abs(self.previous))
+        )
+        self.previous = averages
+        self.n_windows += 1
+        self.n_steps = 0
+        self.sums[:] = 0
+        return bool(steady)
+
+    # Method to extend a cumulative metric after the run stopped
+    def extend(self, series, n_steps):
+        """
+        Fill the timesteps after the run stopped with the values of a cumulative metric, e.g. the average balance,
+        that it would reach if every later window changed it as much as the last one did. Left missing, its final
+        value would be taken from the stop and be lower than those of runs that did not stop early.
+        :param series: the values of the metric at every timestep, the timesteps from n_steps on are filled in place
+        :param n_steps: the number of simulated timesteps, at least two windows in steady state
+        """
+        step = np.arange(len(series) - n_steps)
+        change = series[n_steps - 1] - series[n_steps - 1 - self.window]
+        series[n_steps:] = series[n_steps - self.window + step % self.window] + (step // self.window + 1) * change
+
+
+# Write a summary table
+def write_summary(stats, metrics, path, z=Z, timesteps=None):
+    """
+    Write the per-timestep summary of running statistics over (timestep, metric) samples as a csv table with one
+    row per timestep and one column per metric and statistic, e.g. 'average balance mean'
+    :param stats: the RunningStats
+    :param metrics: the names of the metrics
+    :param path: path of the csv file
+    :param z: z value of the confidence interval
+    :param timesteps: the timesteps of the rows (None for every timestep)
+    """
+    summary = stats.summary(z)
+    t_max = stats.mean.shape[0]
+
+    header = ['timestep', 'n_runs']
+    columns = [np.arange(t_max) if timesteps is None else timesteps, stats.counts.min(axis=1)]
+    for m, metric in enumerate(metrics):
+        for name, values in summary.items():
+            header.append(f'{metric} {name}')
+            columns.append(values[:, m])
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(header)
+        np.savetxt(f, np.column_stack(columns), delimiter=',', fmt=['%d', '%d'] + ['%.17g'] * (len(header) - 2))
+
+
+# Read a summary table
+def read_summary(path):
+    """
+    Read a summary table written by write_summary into a dictionary of column name to array
+    :param path: path of the csv file
+    """
+    with open(path, encoding='utf-8') as f:
+        header = next(csv.reader(f))
+    values = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    return {name: values[:, i] for i, name in enumerate(header)}
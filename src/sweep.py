@@ -0,0 +1,239 @@
+"""
+Parameter sweep scheduler for the simulation.
+A sweep is a declarative grid of configurations (modes x sensitivity ranges x panel production x agent counts).
+The configurations run concurrently in a bounded process pool, configurations with a complete results file are
+skipped, and a manifest records which configuration ran with which seed, so a crashed sweep can simply be rerun.
+"""
+
+import json
+import os
+import time
+import zlib
+from itertools import product
+
+import numpy as np
+
+from main import simulation
+from results import result_name
+
+
+# Build the grid of configurations
+def build_grid(modes, sens_ranges, panel_prods, agent_counts=[200]):
+    """
+    Build the list of configurations of a sweep
+    :param modes: the modes of the simulation ('centralised' and/or 'distributed')
+    :param sens_ranges: the sensitivity ranges for the agents
+    :param panel_prods: the production factors of the solar panels
+    :param agent_counts: the numbers of agents
+    """
+    grid = []
+    for mode, sens_range, panel_prod, n_agents in product(modes, sens_ranges, panel_prods, agent_counts):
+        # Only add the agent count to the name when it varies
+        name = result_name(mode, sens_range, panel_prod, n_agents if len(agent_counts) > 1 else None)
+
+        grid.append({
+            'name': name,
+            'mode': mode,
+            'sens_range': sens_range,
+            'panel_prod': panel_prod,
+            'n_agents': n_agents
+        })
+
+    return grid
+
+
+# Derive the seed of a configuration
+def config_seed(seed, config):
+    """
+    Derive the seed of a configuration from the master seed of the sweep. The seed only depends on the name of the
+    configuration, so it stays the same when the grid is extended or the sweep is resumed.
+    :param seed: master seed of the sweep
+    :param config: the configuration
+    """
+    return int(np.random.SeedSequence([seed, zlib.crc32(config['name'].encode())]).generate_state(1)[0])
+
+
+# Derive the entropy of the populations of a configuration
+def population_entropy(seed, config):
+    """
+    Derive the entropy of the populations of a configuration from the master seed of the sweep (see get_population).
+    Unlike config_seed it does not depend on the mode, so the configurations of both modes draw the same households
+    and share their cached populations.
+    :param seed: master seed of the sweep
+    :param config: the configuration
+    """
+    key = json.dumps([config['n_agents'], list(config['sens_range']), config['panel_prod']])
+    return int(np.random.SeedSequence([seed, zlib.crc32(key.encode())]).generate_state(1)[0])
+
+
+# Write the manifest of a sweep
+def write_manifest(manifest, manifest_path):
+    """
+    Write the manifest atomically, so a crash never leaves a half written manifest behind
+    :param manifest: the manifest
+    :param manifest_path: path of the manifest file
+    """
+    with open(manifest_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_path + '.part', manifest_path)
+
+
+# Record the outcome of a configuration
+def finish_config(entry, get_result, failed):
+    """
+    Mark a configuration of the manifest as done or failed
+    :param entry: the manifest entry of the configuration
+    :param get_result: function returning the result of the simulation, raises its exception if it failed
+    :param failed: list of the names of the failed configurations
+    """
+    try:
+        get_result()
+        entry.update(status='done', finished=time.time())
+        print(f"Finished {entry['name']}")
+    except Exception as e:
+        entry.update(status='failed', error=repr(e))
+        failed.append(entry['name'])
+        print(f"Failed {entry['name']}: {e!r}")
+
+
+# Run the pending configurations of a sweep in batches
+def run_batched(pending, n_runs, t_max, n_workers, engine, out_format, options, manifest, manifest_path, failed):
+    """
+    Split the pending configurations into one batch per worker and run every batch with batched_simulation
+    :param pending: the manifest entries of the pending configurations with the arguments of simulation()
+    :param n_runs: the number of runs per configuration
+    :param t_max: the maximum number of timesteps
+    :param n_workers: the number of batches running at the same time (None for the number of cores)
+    :param engine: the prosumer engine, must be 'vectorized'
+    :param out_format: the format of the results files
+    :param options: further keyword arguments of simulation()
+    :param manifest: the manifest of the sweep
+    :param manifest_path: path of the manifest file
+    :param failed: list of the names of the failed configurations
+    """
+    from batch import batch_options, batched_simulation
+
+    kwargs = dict(batch_options(options), engine=engine, out_format=out_format)
+    kwargs.pop('population', None)
+    n_batches = min(len(pending), n_workers or os.cpu_count() or 1)
+    batches = [pending[i::n_batches] for i in range(n_batches)]
+    configs = [
+        [{'mode': entry['mode'], 'n_agents': entry['n_agents'], 'sens_range': entry['sens_range'],
+          'panel_prod': entry['panel_prod'], 'seed': entry['seed'], 'out_file': entry['file'],
+          'population': config_kwargs.get('population')} for entry, _, config_kwargs in batch]
+        for batch in batches
+    ]
+
+    # Every configuration of a batch finishes or fails with its batch
+    def finish_batch(batch, get_result):
+        error = None
+        try:
+            get_result()
+        except Exception as e:
+            error = e
+
+        def result():
+            if error is not None:
+                raise error
+
+        for entry, _, _ in batch:
+            finish_config(entry, result, failed)
+        write_manifest(manifest, manifest_path)
+
+    if n_batches <= 1:
+        for batch, batch_configs in zip(batches, configs):
+            finish_batch(batch, lambda: batched_simulation(batch_configs, n_runs, t_max, **kwargs))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(max_workers=n_batches) as executor:
+            futures = {executor.submit(batched_simulation, batch_configs, n_runs, t_max, **kwargs): batch
+                       for batch, batch_configs in zip(batches, configs)}
+            for future in as_completed(futures):
+                finish_batch(futures[future], future.result)
+
+
+# Run a sweep
+def run_sweep(grid, n_runs=100, t_max=365*5, seed=0, n_workers=None, engine='object', out_dir='../data', manifest_path=None, out_format='npz', options=None, batched=False, centralised_engine=None):
+    """
+    Run all configurations of the grid that do not have a complete results file yet. With checkpoint_every in the
+    options, the runs of an interrupted configuration continue from their checkpoints, otherwise they start over
+    :param grid: the configurations, see build_grid
+    :param n_runs: the number of runs per configuration
+    :param t_max: the maximum number of timesteps
+    :param seed: master seed of the sweep
+    :param n_workers: the maximum number of configurations running at the same time (None for the number of cores,
+                      1 to run them one after another in this process)
+    :param engine: the prosumer engine ('object' or 'vectorized')
+    :param out_dir: the folder of the results files
+    :param manifest_path: path of the manifest file (None for sweep_manifest.json in out_dir)
+    :param out_format: the format of the results files ('npz', 'npy', 'parquet' or 'csv')
+    :param options: further keyword arguments of simulation(), e.g. {'n_workers': 4, 'interval': 1}
+    :param batched: simulate the runs of many configurations together with batched_simulation (vectorized engine
+                    only), every worker gets an equal share of the configurations
+    :param centralised_engine: the engine of the centralised configurations, e.g. 'closed-form' (None for engine)
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(out_dir, 'sweep_manifest.json')
+    options = options or {}
+
+    # Continue from the manifest of a previous sweep
+    manifest = {'configurations': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+
+    manifest.update({'seed': seed, 'n_runs': n_runs, 't_max': t_max, 'engine': engine, 'out_format': out_format})
+
+    pending = []
+    for config in grid:
+        out_file = os.path.join(out_dir, f"{config['name']}.{out_format}")
+        entry = manifest['configurations'].setdefault(config['name'], {})
+
+        # Results files only get their final name once they are complete
+        if os.path.exists(out_file):
+            print(f"Skipping {config['name']}, results already complete")
+            if entry.get('status') != 'done':
+                entry.update(config, file=out_file, status='done')
+            continue
+
+        config_engine = centralised_engine if centralised_engine and config['mode'] == 'centralised' else engine
+        entry.update(config, file=out_file, seed=config_seed(seed, config), engine=config_engine, status='running',
+                     started=time.time())
+        args = (config['mode'], config['n_agents'], n_runs, t_max, False, config['sens_range'], config['panel_prod'],
+                config_engine, entry['seed'])
+        kwargs = dict(options, out_file=out_file, show_progress=False, out_format=out_format)
+        if options.get('checkpoint_every'):
+            kwargs.setdefault('resume', True)
+        if options.get('population') is not None:
+            kwargs['population'] = dict(options['population'], entropy=population_entropy(seed, config))
+        pending.append((entry, args, kwargs))
+
+    os.makedirs(out_dir, exist_ok=True)
+    write_manifest(manifest, manifest_path)
+
+    failed = []
+    if batched:
+        # Configurations with another engine, e.g. closed-form centralised ones, run on their own
+        run_batched([item for item in pending if item[0]['engine'] == engine], n_runs, t_max, n_workers, engine,
+                    out_format, options, manifest, manifest_path, failed)
+        pending = [item for item in pending if item[0]['engine'] != engine]
+
+    if n_workers == 1:
+        # One configuration at a time in this process, without the start up cost of a process pool
+        for entry, args, kwargs in pending:
+            finish_config(entry, lambda: simulation(*args, **kwargs), failed)
+            write_manifest(manifest, manifest_path)
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(simulation, *args, **kwargs): entry for entry, args, kwargs in pending}
+            for future in as_completed(futures):
+                finish_config(futures[future], future.result, failed)
+                write_manifest(manifest, manifest_path)
+
+    if failed:
+        print(f"{len(failed)} configurations failed, rerun the sweep to retry them: {failed}")
+
+    return manifest
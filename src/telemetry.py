@@ -0,0 +1,281 @@
+"""
+Live telemetry of running simulations.
+Every run publishes the metrics of its timesteps (average balance, central energy sold, average price and the
+throughput in agent-days per second) as small JSON datagrams to a local UDP port. Sending a datagram never waits
+for a reader, so runs in worker processes publish the same way as runs in the main process, and a missing or busy
+collector only costs the dropped records.
+The TelemetryServer collects the datagrams with asyncio on a background thread and streams them to any number of
+subscribers on a TCP port of the same number, as JSON lines for plain sockets or as server-sent events for HTTP
+clients, e.g. curl http://127.0.0.1:8765/. Every subscriber has its own bounded queue that drops its oldest records
+when the subscriber falls behind, so a slow consumer never stalls the collector or the simulation. Run it on its
+own with python telemetry.py --port 8765 and pass telemetry={'address': ('127.0.0.1', 8765)} to simulation().
+"""
+
+import json
+import socket
+import threading
+from time import perf_counter
+
+# Default address of the telemetry server
+HOST = '127.0.0.1'
+PORT = 8765
+
+
+# Telemetry publisher class, sends the metrics of a run to a TelemetryServer
+class TelemetryPublisher():
+    enabled = True
+
+    # Initialize the publisher
+    def __init__(self, address, run=0, mode=None, config=None, n_agents=0, every=1):
+        """
+        :param address: (host, port) of the TelemetryServer
+        :param run: the index of the run, added to every record
+        :param mode: the mode of the run, added to every record
+        :param config: name of the configuration, e.g. the name of the results file, added to every record
+        :param n_agents: the number of agents, for the throughput
+        :param every: publish every this many timesteps
+        """
+        self.address = tuple(address)
+        self.run = run
+        self.mode = mode
+        self.config = config
+        self.n_agents = n_agents
+        self.every = every
+        self.dropped = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.last_time = perf_counter()
+        self.last_step = 0
+
+    # Method to publish the metrics of a timestep
+    def publish(self, step, metrics):
+        """
+        Send the metrics of a timestep, unless the step is skipped or the datagram cannot be sent right away
+        :param step: the index of the timestep
+        :param metrics: the row of the results of the timestep (see METRICS)
+        """
+        if (step + 1) % self.every:
+            return
+
+        now = perf_counter()
+        elapsed = now - self.last_time
+        throughput = self.n_agents * (step + 1 - self.last_step) / elapsed if elapsed > 0 else 0
+        self.last_time = now
+        self.last_step = step + 1
+
+        record = {
+            'config': self.config,
+            'mode': self.mode,
+            'run': self.run,
+            'step': step,
+            'average balance': float(metrics[0]),
+            'central energy sold': float(metrics[2]),
+            'average price': float(metrics[4]),
+            'agent-days per second': throughput
+        }
+        try:
+            self.socket.sendto(json.dumps(record).encode(), self.address)
+        except OSError:
+            self.dropped += 1
+
+    # Method to release the socket
+    def close(self):
+        self.socket.close()
+
+
+# Telemetry publisher that sends nothing
+class NullPublisher(TelemetryPublisher):
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def publish(self, step, metrics):
+        pass
+
+    def close(self):
+        pass
+
+
+# Shared instance for disabled telemetry
+NULL_TELEMETRY = NullPublisher()
+
+
+# Telemetry server class, collects the records of the publishers and streams them to the subscribers
+class TelemetryServer():
+
+    # Initialize the server
+    def __init__(self, host=HOST, port=0, queue_size=1024):
+        """
+        :param host: the address the server listens on
+        :param port: the UDP port of the publishers and TCP port of the subscribers (0 for a free port)
+        :param queue_size: the number of records kept per subscriber that falls behind
+        """
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.handlers = set()
+        self.received = 0
+        self.dropped = 0
+        self.loop = None
+        self.thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    # The address publishers send to
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    # Method to start the server on a background thread
+    def start(self):
+        """
+        Start collecting and streaming on a daemon thread, returns the server once it listens
+        """
+        self.thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    # Method to stop the server
+    def stop(self):
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            self.thread.join()
+
+    # Method to run the server in the current thread
+    def serve_forever(self):
+        import asyncio
+
+        asyncio.run(self._serve())
+
+    def _run(self):
+        import asyncio
+
+        try:
+            asyncio.run(self._serve())
+        except Exception as error:
+            self._error = error
+            self._ready.set()
+
+    async def _serve(self):
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        # The TCP port is bound first, so port 0 picks a number that is then also used for UDP
+        server = await asyncio.start_server(self._subscribe, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: _Collector(self), local_addr=(self.host, self.port))
+        self._ready.set()
+
+        try:
+            await self._stopped.wait()
+        finally:
+            transport.close()
+            server.close()
+
+            # Subscribers end their streams on a None record, cancelled handlers are reported as errors by asyncio
+            for queue in self.subscribers:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            if self.handlers:
+                await asyncio.wait(self.handlers, timeout=1)
+            await server.wait_closed()
+
+    # Method to pass a record to every subscriber
+    def broadcast(self, data):
+        """
+        Queue a record for every subscriber, dropping the oldest record of subscribers whose queue is full
+        :param data: the JSON encoded record
+        """
+        self.received += 1
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(data)
+
+    async def _subscribe(self, reader, writer):
+        import asyncio
+
+        task = asyncio.current_task()
+        self.handlers.add(task)
+
+        # HTTP clients send a request first, plain socket clients only listen
+        http = False
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=0.2)
+            http = request.startswith(b'GET ')
+            while http and (await reader.readline()).strip():
+                pass
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+        if http:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        try:
+            while not self._stopped.is_set():
+                data = await queue.get()
+                if data is None:
+                    break
+                writer.write(b'data: ' + data + b'\n\n' if http else data + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(queue)
+            self.handlers.discard(task)
+            writer.close()
+
+
+# Datagram protocol of the TelemetryServer
+class _Collector():
+
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.server.broadcast(data)
+
+    def error_received(self, error):
+        pass
+
+    def connection_lost(self, error):
+        pass
+
+
+# Subscribe to a telemetry server
+def subscribe(host=HOST, port=PORT):
+    """
+    Yield the records streamed by a TelemetryServer as dictionaries, until the server closes the connection
+    :param host: the address of the server
+    :param port: the port of the server
+    """
+    with socket.create_connection((host, port)) as connection:
+        for line in connection.makefile('rb'):
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Collect the telemetry of simulations and stream it to subscribers')
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='UDP port of the simulations and TCP port of the subscribers')
+    parser.add_argument('--queue-size', type=int, default=1024, help='records kept per subscriber that falls behind')
+    args = parser.parse_args()
+
+    print(f"Streaming telemetry on {args.host}:{args.port}")
+    TelemetryServer(args.host, args.port, args.queue_size).serve_forever()
@@ -0,0 +1,318 @@
+"""
+Statistical equivalence harness for the engines of the simulation.
+A faster engine draws its random numbers in a different order than the reference, so its results cannot be compared
+bit for bit. Instead the reference and a candidate engine run the same configurations for many seeds, independent
+seeds for the two engines as the two-sample tests assume, and at a number of checkpoint timesteps the distributions
+over runs of every metric are compared: a Welch t-test on the mean and a two-sample Kolmogorov-Smirnov test on the
+whole distribution, with a Holm correction over all tests. A check only fails when its difference (of the means, or
+the Wasserstein distance of the distributions) is significant and larger than the tolerance in standard deviations
+of the reference, so rounding level differences do not fail it.
+Besides the distributions, invariants that every engine has to keep are checked on the results (prices between the
+central prices, the deficit of the agents covered by the central agent) and, for engines with a RunState, on the
+agents of every day (energy conservation, the demand of every agent met and the money balancing out with the
+central agent). Run python validate.py --candidate vectorized for a pass/fail report, it exits with 1 on a failure.
+"""
+
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+from data import get_average_difference_in_seasons
+from main import CENTRAL_BUY_PRICE, CENTRAL_SELL_PRICE, DATA_YEAR, RunState, simulation
+from results import METRICS, load_results
+
+# Engines with a RunState, whose agents are checked every day
+STATE_ENGINES = ['object', 'vectorized']
+
+# Configurations validated by default
+CONFIGS = [
+    {'mode': 'distributed', 'n_agents': 200, 'sens_range': [0.005, 0.02], 'panel_prod': 1},
+    {'mode': 'centralised', 'n_agents': 200, 'sens_range': [0.005, 0.02], 'panel_prod': 1}
+]
+
+# Absolute tolerance of the invariants, on top of a relative tolerance of 1e-9
+ATOL = 1e-6
+
+
+# Run an engine
+def run_engine(engine, config, n_runs, t_max, seed):
+    """
+    Simulate a configuration with an engine and return its (run, timestep, metric) array
+    :param engine: 'object', 'vectorized', 'closed-form', 'batched' or a function taking the configuration, n_runs,
+                   t_max and seed
+                   and returning the results array
+    :param config: the configuration, a dictionary with the mode, n_agents, sens_range and panel_prod
+    :param n_runs: the number of runs
+    :param t_max: the number of timesteps
+    :param seed: the master seed
+    """
+    if callable(engine):
+        return np.asarray(engine(config, n_runs, t_max, seed))
+
+    with tempfile.TemporaryDirectory() as folder:
+        out_file = os.path.join(folder, 'results.npz')
+        if engine == 'batched':
+            from batch import batched_simulation
+
+            batched_simulation([dict(config, seed=seed, out_file=out_file)], n_runs, t_max, summary=False)
+        else:
+            simulation(config['mode'], config['n_agents'], n_runs, t_max, False, config['sens_range'],
+                       config['panel_prod'], engine, seed, out_file=out_file, show_progress=False, summary=False)
+        return load_results(out_file)[0]
+
+
+# Name of an engine in the report
+def engine_name(engine):
+    return engine if isinstance(engine, str) else getattr(engine, '__name__', 'candidate')
+
+
+# Apply the Holm correction
+def holm(p_values, alpha):
+    """
+    Return which of the p values are significant at a family-wise error rate of alpha (Holm-Bonferroni)
+    :param p_values: the p values of all tests
+    :param alpha: the family-wise error rate
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    significant = np.zeros(len(p_values), dtype=bool)
+    order = np.argsort(p_values)
+    for rank, i in enumerate(order):
+        if not p_values[i] < alpha / (len(p_values) - rank):
+            break
+        significant[i] = True
+    return significant
+
+
+# Compare the distributions of two engines
+def compare_distributions(reference, candidate, checkpoints, tolerance=0.1):
+    """
+    Test the distribution over runs of every metric at the checkpoint timesteps, returns a list of checks without
+    their outcome, which needs the correction over all tests (see validate)
+    :param reference: the (run, timestep, metric) array of the reference engine
+    :param candidate: the (run, timestep, metric) array of the candidate engine
+    :param checkpoints: the timesteps to compare
+    :param tolerance: the largest difference that passes, in standard deviations of the reference
+    """
+    from scipy.stats import ks_2samp, ttest_ind, wasserstein_distance
+
+    checks = []
+    for timestep in checkpoints:
+        for m, metric in enumerate(METRICS):
+            a = reference[:, timestep, m]
+            b = candidate[:, timestep, m]
+            a = a[~np.isnan(a)]
+            b = b[~np.isnan(b)]
+            scale = a.std(ddof=1)
+            # Differences below the threshold pass even when significant, e.g. rounding leftovers of the matching
+            threshold = tolerance * scale + ATOL + 1e-9 * abs(a.mean())
+
+            # Constant metrics, e.g. the first day of every run, have no spread to test against
+            if scale == 0 and b.std(ddof=1) == 0:
+                p_mean = p_distribution = 1.0 if a[0] == b[0] else 0.0
+            else:
+                # Nearly identical samples, e.g. of an engine given the seeds of the reference, make scipy warn
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    p_mean = ttest_ind(a, b, equal_var=False).pvalue
+                    p_distribution = ks_2samp(a, b).pvalue
+
+            for check, value, p_value in [('mean', b.mean() - a.mean(), p_mean),
+                                          ('distribution', wasserstein_distance(a, b), p_distribution)]:
+                checks.append({'check': check, 'metric': metric, 'timestep': int(timestep), 'value': value,
+                               'effect': abs(value) / scale if scale > 0 else np.nan, 'threshold': threshold,
+                               'p_value': p_value})
+    return checks
+
+
+# Check the invariants of a results array
+def check_results(data):
+    """
+    Check the invariants every engine keeps in its results, returns a list of checks
+    :param data: the (run, timestep, metric) array of an engine
+    """
+    _, demand, central_sold, produced, price = (data[..., METRICS.index(metric)] for metric in METRICS)
+    valid = ~np.isnan(price)
+    tolerance = ATOL + 1e-9 * np.abs(demand)
+
+    # The average price is 0 (no trades) or lies between the prices of the central agent
+    in_range = (price == 0) | ((price >= CENTRAL_BUY_PRICE - ATOL) & (price <= CENTRAL_SELL_PRICE + ATOL))
+    # The central agent sells at least the deficit of all agents together
+    covered = central_sold >= demand - produced - tolerance
+    # Production is not included, the seasonal model lets it fall below 0 in winter
+    non_negative = (demand >= 0) & (central_sold >= -tolerance)
+
+    checks = []
+    for name, holds in [('price range', in_range), ('deficit covered', covered), ('non-negative', non_negative)]:
+        failures = np.count_nonzero(valid & ~holds)
+        checks.append({'check': name, 'metric': None, 'timestep': None, 'value': failures, 'effect': None,
+                       'p_value': None, 'passed': failures == 0})
+    return checks
+
+
+# Check the invariants of the agents of an engine
+def check_states(engine, config, n_runs, t_max, seed):
+    """
+    Step runs of an engine with a RunState and check the agents after every day, returns a list of checks
+    :param engine: the prosumer engine ('object' or 'vectorized')
+    :param config: the configuration
+    :param n_runs: the number of runs to check
+    :param t_max: the number of timesteps
+    :param seed: the master seed
+    """
+    _, _, percentage_diff = get_average_difference_in_seasons(DATA_YEAR)
+    errors = {'energy conservation': 0.0, 'demand met': 0.0, 'money conservation': 0.0}
+
+    for run, run_seed in enumerate(np.random.SeedSequence(seed).spawn(n_runs)):
+        state = RunState(run, config['mode'], config['n_agents'], t_max, False, config['sens_range'],
+                         config['panel_prod'], engine, percentage_diff, run_seed)
+        central_agent = state.central_agent
+        for day in range(t_max):
+            sold, bought = central_agent.energy_sold, central_agent.energy_bought
+            state.step()
+            _, total_demand, _, total_produced, _ = state.results[day]
+
+            if state.population is not None:
+                production = state.population.energy_production
+                demand = state.population.energy_demand
+                balances = state.population.balance.sum()
+            else:
+                production = np.array([agent.energy_production for agent in state.agent_list])
+                demand = np.array([agent.energy_demand for agent in state.agent_list])
+                balances = sum(agent.balance for agent in state.agent_list)
+
+            # Energy only comes from the panels and the central agent and all of it is used
+            supplied = total_produced + (central_agent.energy_sold - sold) - (central_agent.energy_bought - bought)
+            errors['energy conservation'] = max(errors['energy conservation'],
+                                                abs(supplied - total_demand) / (1 + abs(total_demand)))
+            # Every agent ends the day with at least its demand
+            errors['demand met'] = max(errors['demand met'], np.max(demand - production, initial=0))
+            # What the agents pay, the central agent or other agents receive
+            errors['money conservation'] = max(errors['money conservation'],
+                                               abs(balances + central_agent.balance) / (1 + np.abs(balances)))
+
+    return [{'check': name, 'metric': None, 'timestep': None, 'value': error, 'effect': None, 'p_value': None,
+             'passed': error <= ATOL} for name, error in errors.items()]
+
+
+# Validate a candidate engine against the reference
+def validate(candidate, reference='object', configs=CONFIGS, n_runs=30, t_max=365, seed=0, n_checkpoints=10,
+             alpha=0.01, tolerance=0.1, state_runs=2):
+    """
+    Run the reference and the candidate engine on the same configurations, with independent seeds derived from the
+    master seed, compare the distributions of their metrics and check the invariants of both. Returns the report, a
+    dictionary with 'passed' and the list of 'checks' of every configuration.
+    :param candidate: the candidate engine, see run_engine
+    :param reference: the reference engine, see run_engine
+    :param configs: the configurations to validate, see CONFIGS
+    :param n_runs: the number of runs (seeds) per configuration and engine
+    :param t_max: the number of timesteps
+    :param seed: the master seed, the seeds of the reference and the candidate are derived from it
+    :param n_checkpoints: the number of timesteps compared, evenly spaced up to the final timestep
+    :param alpha: the family-wise error rate of the statistical tests
+    :param tolerance: the largest difference of the means (and the Wasserstein distance of the distributions) that
+                      passes, in standard deviations of the reference
+    :param state_runs: the number of runs whose agents are checked every day (engines with a RunState only)
+    """
+    checkpoints = np.unique(np.linspace(0, t_max - 1, n_checkpoints).round().astype(int))
+
+    # Runs of both engines with the same seeds would be correlated samples, e.g. the same agents
+    reference_seed, candidate_seed = (int(state) for state in np.random.SeedSequence(seed).generate_state(2))
+
+    checks = []
+    for config in configs:
+        name = f"{config['mode']} {config['n_agents']} agents sens {config['sens_range']} panel {config['panel_prod']}"
+        reference_data = run_engine(reference, config, n_runs, t_max, reference_seed)
+        candidate_data = run_engine(candidate, config, n_runs, t_max, candidate_seed)
+
+        config_checks = compare_distributions(reference_data, candidate_data, checkpoints, tolerance)
+        for engine, data, engine_seed in [(reference, reference_data, reference_seed),
+                                          (candidate, candidate_data, candidate_seed)]:
+            engine_checks = check_results(data)
+            if engine in STATE_ENGINES and state_runs:
+                engine_checks += check_states(engine, config, state_runs, t_max, engine_seed)
+            for check in engine_checks:
+                check['check'] = f'{engine_name(engine)}: {check["check"]}'
+            config_checks += engine_checks
+
+        for check in config_checks:
+            check['config'] = name
+        checks += config_checks
+
+    # The statistical tests of all configurations form one family
+    tests = [check for check in checks if 'passed' not in check]
+    significant = holm([check['p_value'] for check in tests], alpha)
+    for check, is_significant in zip(tests, significant):
+        check['passed'] = bool(not is_significant or abs(check['value']) <= check['threshold'])
+
+    return {'passed': all(check['passed'] for check in checks), 'checks': checks, 'candidate': engine_name(candidate),
+            'reference': engine_name(reference), 'n_runs': n_runs, 't_max': t_max, 'seed': seed, 'alpha': alpha,
+            'tolerance': tolerance}
+
+
+# Format a validation report
+def format_report(report, verbose=False):
+    """
+    Format a report of validate as text, with every failed check (every check when verbose)
+    :param report: the report of validate
+    :param verbose: list the checks that passed as well
+    """
+    checks = report['checks']
+    failed = [check for check in checks if not check['passed']]
+    lines = [f"{report['candidate']} vs {report['reference']}: {'PASS' if report['passed'] else 'FAIL'} "
+             f"({len(checks) - len(failed)}/{len(checks)} checks passed, {report['n_runs']} runs, "
+             f"{report['t_max']} timesteps, alpha {report['alpha']}, tolerance {report['tolerance']})"]
+
+    for check in checks if verbose else failed:
+        where = f" {check['metric']} at {check['timestep']}" if check['metric'] is not None else ''
+        p_value = f", p {check['p_value']:.3g}" if check['p_value'] is not None else ''
+        effect = f", effect {check['effect']:.3g}" if check['effect'] is not None else ''
+        lines.append(f"  {'ok  ' if check['passed'] else 'FAIL'} {check['config']}: {check['check']}{where}: "
+                     f"{check['value']:.3g}{effect}{p_value}")
+    return '\n'.join(lines)
+
+
+# Write a validation report
+def write_report(report, path):
+    """
+    Write the checks of a report as csv
+    :param report: the report of validate
+    :param path: path of the csv file
+    """
+    import csv
+
+    columns = ['config', 'check', 'metric', 'timestep', 'value', 'effect', 'threshold', 'p_value', 'passed']
+    with open(path + '.part', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(report['checks'])
+    os.replace(path + '.part', path)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Validate a candidate engine against the reference engine')
+    parser.add_argument('--candidate', default='vectorized', choices=['object', 'vectorized', 'closed-form', 'batched'])
+    parser.add_argument('--reference', default='object', choices=['object', 'vectorized', 'closed-form', 'batched'])
+    parser.add_argument('--runs', type=int, default=30, help='number of runs (seeds) per configuration and engine')
+    parser.add_argument('--t-max', type=int, default=365, help='number of timesteps')
+    parser.add_argument('--seed', type=int, default=0, help='master seed')
+    parser.add_argument('--alpha', type=float, default=0.01, help='family-wise error rate of the statistical tests')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='largest difference that passes, in standard deviations of the reference')
+    parser.add_argument('--report', default=None, help='write the checks to this csv file')
+    parser.add_argument('--verbose', action='store_true', help='list every check')
+    args = parser.parse_args()
+
+    # The closed-form engine only simulates the centralised mode
+    configs = [config for config in CONFIGS
+               if 'closed-form' not in (args.candidate, args.reference) or config['mode'] == 'centralised']
+    report = validate(args.candidate, args.reference, configs, n_runs=args.runs, t_max=args.t_max, seed=args.seed,
+                      alpha=args.alpha, tolerance=args.tolerance)
+    print(format_report(report, args.verbose))
+    if args.report:
+        write_report(report, args.report)
+    sys.exit(0 if report['passed'] else 1)